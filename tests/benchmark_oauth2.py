@@ -0,0 +1,52 @@
+'''Micro-benchmark for the OpenID Connect token endpoint
+
+Not collected by the regular test run. Run it with
+
+	python3 -m unittest -v tests.benchmark_oauth2
+
+to compare the token endpoint throughput with ID tokens signed with each of
+OAuth2Key.ALGORITHMS. Set BENCHMARK_REQUESTS to change the number of token
+requests per algorithm.'''
+import os
+import time
+
+import jwt
+from flask import url_for
+
+from uffd.database import db
+from uffd.models import Service, OAuth2Client, OAuth2Grant, OAuth2Key, Session
+
+from tests.utils import UffdTestCase
+from tests.models.test_oauth2 import TEST_JWK
+
+class BenchmarkOAuth2Token(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(OAuth2Key(**TEST_JWK))
+		db.session.add(OAuth2Key.generate_ec_key())
+		if 'EdDSA' in OAuth2Key.ALGORITHMS:
+			db.session.add(OAuth2Key.generate_ed25519_key())
+		db.session.add(OAuth2Client(service=Service(name='test', limit_access=False), client_id='test', client_secret='testsecret', redirect_uris=['https://service/callback']))
+
+	def benchmark(self, algorithm, count):
+		client = OAuth2Client.query.filter_by(client_id='test').one()
+		client.id_token_signed_response_alg = algorithm
+		session = Session(user=self.get_user())
+		grants = [OAuth2Grant(session=session, client=client, redirect_uri='https://service/callback', scopes=['openid']) for _ in range(count)]
+		db.session.add_all(grants)
+		db.session.commit()
+		codes = [grant.code for grant in grants]
+		data = {'grant_type': 'authorization_code', 'redirect_uri': 'https://service/callback', 'client_id': 'test', 'client_secret': 'testsecret'}
+		# Warm up key ring and other caches
+		r = self.client.post(path=url_for('oauth2.token'), data=dict(data, code=codes.pop()))
+		self.assertEqual(jwt.get_unverified_header(r.json['id_token'])['alg'], algorithm)
+		start = time.perf_counter()
+		for code in codes:
+			r = self.client.post(path=url_for('oauth2.token'), data=dict(data, code=code))
+			self.assertEqual(r.status_code, 200)
+		return len(codes) / (time.perf_counter() - start)
+
+	def test_token_throughput(self):
+		count = int(os.environ.get('BENCHMARK_REQUESTS', '200'))
+		print()
+		for algorithm in OAuth2Key.ALGORITHMS:
+			print(f'{algorithm:>6}: {self.benchmark(algorithm, count):7.1f} token requests/s')
@@ -0,0 +1,39 @@
+'''Micro-benchmark for the SQL ratelimit backend
+
+Not collected by the regular test run. Run it with
+
+	python3 -m unittest -v tests.benchmark_ratelimit
+
+to check that the latency of Ratelimit.get_delay does not grow with the
+number of unrelated events in the ratelimit_event table.'''
+import datetime
+import statistics
+import time
+
+from uffd.database import db
+from uffd.models.ratelimit import Ratelimit, RatelimitEvent
+
+from tests.utils import UffdTestCase
+
+class BenchmarkRatelimit(UffdTestCase):
+	def measure_get_delay(self, ratelimit, key, rounds=50):
+		timings = []
+		for _ in range(rounds):
+			start = time.perf_counter()
+			ratelimit.get_delay(key)
+			timings.append(time.perf_counter() - start)
+		return statistics.median(timings)
+
+	def test_flat_latency(self):
+		ratelimit = Ratelimit('login', 60, 3)
+		for _ in range(10):
+			ratelimit.log('testuser')
+		baseline = self.measure_get_delay(ratelimit, 'testuser')
+		expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+		rows = [{'name': 'login', 'key': f'user{i}', 'expires': expires, 'timestamp': datetime.datetime.utcnow()} for i in range(100000)]
+		db.session.execute(db.insert(RatelimitEvent.__table__), rows)
+		db.session.commit()
+		loaded = self.measure_get_delay(ratelimit, 'testuser')
+		# Without the index, get_delay scans the whole table and is about 20
+		# times slower.
+		self.assertLess(loaded, baseline * 3, f'get_delay with 10 events: {baseline*1000:.3f}ms, with additional 100k events: {loaded*1000:.3f}ms')
@@ -0,0 +1,33 @@
+from uffd.database import db
+from uffd.models import User, Role, RoleGroup
+
+from tests.utils import UffdTestCase
+
+class TestGroupUpdatesCLI(UffdTestCase):
+	def setUp(self):
+		super().setUp()
+		self.app.config['GROUP_UPDATE_WORKER'] = 'external'
+		role = Role(name='base', is_default=True)
+		role.groups[self.get_admin_group()] = RoleGroup(group=self.get_admin_group())
+		db.session.add(role)
+		role.update_member_groups()
+		db.session.commit()
+		self.client.__exit__(None, None, None)
+
+	def test_status(self):
+		result = self.app.test_cli_runner().invoke(args=['group-updates', 'status'])
+		self.assertEqual(result.exit_code, 0)
+		self.assertEqual(result.output, 'Pending group updates: 2\n')
+
+	def test_wait_timeout(self):
+		result = self.app.test_cli_runner().invoke(args=['group-updates', 'wait', '--timeout', '0'])
+		self.assertEqual(result.exit_code, 1)
+
+	def test_process(self):
+		result = self.app.test_cli_runner().invoke(args=['group-updates', 'process', '--batch-size', '1'])
+		self.assertEqual(result.exit_code, 0)
+		self.assertEqual(result.output, 'Processed group updates: 2\n')
+		result = self.app.test_cli_runner().invoke(args=['group-updates', 'wait', '--timeout', '0'])
+		self.assertEqual(result.exit_code, 0)
+		with self.app.test_request_context():
+			self.assertIn('uffd_admin', [group.name for group in User.query.filter_by(loginname='testuser').one().groups])
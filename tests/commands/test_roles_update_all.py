@@ -0,0 +1,91 @@
+from uffd.database import db
+from uffd.models import User, Role, RoleGroup, TOTPMethod, ChangelogEntry, GenerationCounter
+
+from tests.utils import UffdTestCase
+
+def add_roles(test_case):
+	role = Role(name='base', is_default=True)
+	role.groups[test_case.get_users_group()] = RoleGroup(group=test_case.get_users_group())
+	role.groups[test_case.get_access_group()] = RoleGroup(group=test_case.get_access_group())
+	db.session.add(role)
+	role = Role(name='admin', members=[test_case.get_admin()])
+	role.groups[test_case.get_admin_group()] = RoleGroup(group=test_case.get_admin_group(), requires_mfa=True)
+	db.session.add(role)
+
+class TestRolesUpdateAllCLI(UffdTestCase):
+	def setUp(self):
+		super().setUp()
+		add_roles(self)
+		db.session.add(User(loginname='service', is_service_user=True, primary_email_address='service@example.com', displayname='Service'))
+		db.session.commit()
+		self.client.__exit__(None, None, None)
+
+	def get_group_names(self):
+		with self.app.test_request_context():
+			return {user.loginname: {group.name for group in user.groups} for user in User.query}
+
+	def test_check_only(self):
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only'])
+		self.assertEqual(result.exit_code, 1)
+		self.assertIn('Removing groups [uffd_admin] from user testadmin', result.output)
+		self.assertIn('Error: Groups are not consistent with roles in database', result.output)
+		self.assertNotIn('testuser', result.output)
+		self.assertNotIn('service', result.output)
+		self.assertEqual(self.get_group_names()['testadmin'], {'users', 'uffd_access', 'uffd_admin'})
+
+	def test_update(self):
+		with self.app.test_request_context():
+			cursor = ChangelogEntry.get_cursor()
+			generation = GenerationCounter.directory.value
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all'])
+		self.assertEqual(result.exit_code, 0)
+		self.assertEqual(self.get_group_names(), {
+			'testuser': {'users', 'uffd_access'},
+			'testadmin': {'users', 'uffd_access'},
+			'service': set(),
+		})
+		with self.app.test_request_context():
+			entries = ChangelogEntry.query.filter(ChangelogEntry.id > cursor).all()
+			self.assertEqual(len(entries), 2)
+			self.assertGreater(GenerationCounter.directory.value, generation)
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only'])
+		self.assertEqual(result.exit_code, 0)
+		self.assertEqual(result.output, '')
+
+	def test_update_mfa(self):
+		with self.app.test_request_context():
+			db.session.add(TOTPMethod(User.query.filter_by(loginname='testadmin').one()))
+			db.session.commit()
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only'])
+		self.assertEqual(result.exit_code, 0)
+		self.assertEqual(result.output, '')
+
+	def test_consistent_with_update_groups(self):
+		self.app.test_cli_runner().invoke(args=['roles-update-all'])
+		with self.app.test_request_context():
+			for user in User.query:
+				self.assertEqual(user.update_groups(), (set(), set()))
+
+class TestRolesUpdateAllJobsCLI(UffdTestCase):
+	# Each job uses its own database connection
+	DISABLE_SQLITE_MEMORY_DB = True
+
+	def setUp(self):
+		super().setUp()
+		add_roles(self)
+		for i in range(20):
+			db.session.add(User(loginname=f'user{i}', primary_email_address=f'user{i}@example.com', displayname='User'))
+		db.session.commit()
+		self.client.__exit__(None, None, None)
+
+	def test_jobs(self):
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only', '--jobs', '3'])
+		self.assertEqual(result.exit_code, 1)
+		expected = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only']).output
+		self.assertEqual(result.output, expected)
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--jobs', '3'])
+		self.assertEqual(result.exit_code, 0)
+		with self.app.test_request_context():
+			self.assertEqual({group.name for group in User.query.filter_by(loginname='user1').one().groups}, {'users', 'uffd_access'})
+		result = self.app.test_cli_runner().invoke(args=['roles-update-all', '--check-only', '--jobs', '3'])
+		self.assertEqual(result.exit_code, 0)
@@ -11,7 +11,7 @@ from uffd.models import (
 	Invite, InviteGrant, InviteSignup,
 	DeviceLoginConfirmation,
 	Service,
-	OAuth2Client, OAuth2LogoutURI, OAuth2Grant, OAuth2Token, OAuth2DeviceLoginInitiation,
+	OAuth2Client, OAuth2LogoutURI, OAuth2Grant, OAuth2Token, OAuth2DeviceLoginInitiation, OAuth2RedeemedCode,
 	PasswordToken,
 	Session,
 )
@@ -72,6 +72,7 @@ class TestFuzzy(MigrationTestCase):
 		db.session.add(OAuth2Grant(session=session, client=oauth2_client, _code='testcode', redirect_uri='http://example.com/callback', expires=datetime.datetime.now()))
 		db.session.add(OAuth2Token(session=session, client=oauth2_client, token_type='Bearer', _access_token='testcode', _refresh_token='testcode', expires=datetime.datetime.now()))
 		db.session.add(OAuth2DeviceLoginInitiation(client=oauth2_client, confirmations=[DeviceLoginConfirmation(session=session)]))
+		db.session.add(OAuth2RedeemedCode(id='testcode', expires=datetime.datetime.now()))
 		db.session.add(PasswordToken(user=user))
 		db.session.commit()
 		revs = [s.split('_', 1)[0] for s in os.listdir('uffd/migrations/versions') if '_' in s and s.endswith('.py')]
@@ -1,5 +1,5 @@
 from uffd.database import db
-from uffd.models.misc import lock_table, Lock
+from uffd.models.misc import lock_table, Lock, generation_counter_table, GenerationCounter
 
 from tests.utils import MigrationTestCase
 
@@ -14,3 +14,14 @@ class TestForMissingLockRows(MigrationTestCase):
 #  conn = op.get_bind()
 #  lock_table = sa.table('lock', sa.column('name'))
 #  conn.execute(sa.insert(lock_table).values(name='NAME'))
+
+class TestForMissingGenerationCounterRows(MigrationTestCase):
+	def test_check_missing_generation_counter_rows(self):
+		self.upgrade('head')
+		existing_counters = {row[0] for row in db.session.execute(db.select([generation_counter_table.c.name])).fetchall()}
+		for name in GenerationCounter.ALL_COUNTERS - existing_counters:
+			self.fail(f'GenerationCounter "{name}" is missing. Make sure to add a migration that inserts it.')
+
+# Add something like this:
+#  generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+#  op.execute(sa.insert(generation_counter_table).values(name='NAME', value=0))
@@ -4,7 +4,7 @@ import threading
 from sqlalchemy.exc import IntegrityError
 
 from uffd.database import db
-from uffd.models import FeatureFlag, Lock
+from uffd.models import FeatureFlag, Lock, GenerationCounter, User
 from uffd.models.misc import feature_flag_table
 
 from tests.utils import ModelTestCase
@@ -82,3 +82,36 @@ class TestLock(ModelTestCase):
 		self.assertEqual(self.run_lock_test(), ['bar', 'foo'])
 		self.lock.acquire()
 		self.assertEqual(self.run_lock_test(), ['foo', 'bar'])
+
+class TestGenerationCounter(ModelTestCase):
+	def test_bump(self):
+		counter = GenerationCounter.directory
+		value = counter.value
+		counter.bump()
+		self.assertEqual(counter.value, value + 1)
+		db.session.rollback()
+		self.assertEqual(counter.value, value)
+
+	def test_get_values(self):
+		GenerationCounter.oauth2_keys.bump()
+		self.assertEqual(
+			GenerationCounter.get_values(GenerationCounter.directory, GenerationCounter.oauth2_keys),
+			[GenerationCounter.directory.value, GenerationCounter.oauth2_keys.value]
+		)
+		self.assertEqual(GenerationCounter.get_values(), [])
+
+	def test_directory_changes(self):
+		counter = GenerationCounter.directory
+		value = counter.value
+		user = User(loginname='test', displayname='Test', primary_email_address='test@example.com')
+		db.session.add(user)
+		db.session.commit()
+		self.assertGreater(counter.value, value)
+		value = counter.value
+		user.displayname = 'Test2'
+		db.session.commit()
+		self.assertGreater(counter.value, value)
+		value = counter.value
+		db.session.execute(db.select([1]))
+		db.session.commit()
+		self.assertEqual(counter.value, value)
@@ -1,10 +1,14 @@
 import unittest
 import datetime
+import json
 
 import jwt
+import sqlalchemy
+from flask import current_app
 
 from uffd.database import db
-from uffd.models import OAuth2Key
+from uffd.models import OAuth2Key, OAuth2Client, OAuth2Grant, OAuth2RedeemedCode, OAuth2LogoutURI, Service, Session
+from uffd.models.oauth2 import OAuth2KeyRing, StatelessOAuth2Grant, OAuth2ClientRegistry
 
 from tests.utils import UffdTestCase
 
@@ -157,3 +161,170 @@ class TestOAuth2Key(UffdTestCase):
 	def test_generate_rsa_key(self):
 		key = OAuth2Key.generate_rsa_key()
 		self.assertEqual(key.algorithm, 'RS256')
+
+	def test_generate_ec_key(self):
+		key = OAuth2Key.generate_ec_key()
+		self.assertEqual(key.algorithm, 'ES256')
+		db.session.add(key)
+		db.session.flush()
+		jwtdata = key.encode_jwt({'aud': 'test'})
+		self.assertEqual(jwt.get_unverified_header(jwtdata)['alg'], 'ES256')
+		self.assertEqual(jwt.decode(jwtdata, key=key.public_key, algorithms=['ES256'], audience='test'), {'aud': 'test'})
+		self.assertEqual(key.public_key_jwks_dict['crv'], 'P-256')
+		self.assertEqual(len(key.oidc_hash(b'test')), 22) # SHA-256
+
+	def test_ec_key_padding(self):
+		from cryptography.hazmat.primitives.asymmetric import ec
+		from cryptography.hazmat.backends import default_backend
+		key = OAuth2Key(algorithm='ES256', private_key=ec.derive_private_key(1, ec.SECP256R1(), default_backend()))
+		self.assertEqual(json.loads(key.private_key_jwk)['d'], 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAE')
+		self.assertEqual(key.private_key.private_numbers().private_value, 1)
+
+	@unittest.skipUnless('EdDSA' in OAuth2Key.ALGORITHMS, 'EdDSA not supported by pyjwt version')
+	def test_generate_ed25519_key(self):
+		key = OAuth2Key.generate_ed25519_key()
+		self.assertEqual(key.algorithm, 'EdDSA')
+		db.session.add(key)
+		db.session.flush()
+		jwtdata = key.encode_jwt({'aud': 'test'})
+		self.assertEqual(jwt.get_unverified_header(jwtdata)['alg'], 'EdDSA')
+		self.assertEqual(jwt.decode(jwtdata, key=key.public_key, algorithms=['EdDSA'], audience='test'), {'aud': 'test'})
+		self.assertEqual(key.public_key_jwks_dict['crv'], 'Ed25519')
+		self.assertEqual(len(key.oidc_hash(b'test')), 43) # SHA-512
+
+	def test_get_available_algorithms(self):
+		self.assertEqual(OAuth2Key.get_available_algorithms(), ['RS256'])
+		db.session.add(OAuth2Key.generate_ec_key())
+		db.session.commit()
+		self.assertEqual(OAuth2Key.get_available_algorithms(), ['RS256', 'ES256'])
+
+	def test_get_id_token_key(self):
+		client = OAuth2Client(service=Service(name='test'), client_id='test', client_secret='testsecret', id_token_signed_response_alg='ES256')
+		db.session.add(client)
+		db.session.commit()
+		with self.assertLogs(current_app.logger, 'WARNING'):
+			self.assertEqual(client.get_id_token_key().id, self.key.id)
+		key = OAuth2Key.generate_ec_key()
+		db.session.add(key)
+		db.session.commit()
+		self.assertEqual(client.get_id_token_key().id, key.id)
+
+	def test_key_ring(self):
+		ring = OAuth2KeyRing.get()
+		self.assertIs(OAuth2KeyRing.get(), ring)
+		self.assertEqual(OAuth2Key.get_preferred_key().id, self.key.id)
+		self.assertEqual(json.loads(ring.jwks), {'keys': [self.key.public_key_jwks_dict, self.key_oidc_spec.public_key_jwks_dict]})
+		jwtdata = OAuth2Key.get_preferred_key().encode_jwt({'aud': 'test', 'foo': 'bar'})
+		self.assertEqual(OAuth2Key.decode_jwt(jwtdata, audience='test'), {'aud': 'test', 'foo': 'bar'})
+		with self.assertRaises(jwt.exceptions.InvalidKeyError):
+			# private_key_jwk is invalid
+			ring.get_key('1e9gdk7').encode_jwt({'aud': 'test'})
+		# Uncommitted changes are only visible within the transaction
+		self.key.active = False
+		self.assertEqual(OAuth2Key.get_preferred_key().id, '1e9gdk7')
+		with self.assertRaises(jwt.exceptions.InvalidKeyError):
+			OAuth2Key.decode_jwt(jwtdata, audience='test')
+		self.assertIs(current_app.extensions['uffd_oauth2_key_ring'], ring)
+		db.session.commit()
+		self.assertIsNot(OAuth2KeyRing.get(), ring)
+		self.assertEqual(OAuth2Key.get_preferred_key().id, '1e9gdk7')
+		self.assertEqual(json.loads(OAuth2KeyRing.get().jwks), {'keys': [self.key_oidc_spec.public_key_jwks_dict]})
+
+class TestStatelessOAuth2Grant(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(OAuth2Client(service=Service(name='test', limit_access=False), client_id='test', client_secret='testsecret', redirect_uris=['http://localhost:5009/callback']))
+
+	def make_grant(self, **kwargs):
+		session = Session(user=self.get_user())
+		db.session.add(session)
+		db.session.flush()
+		client = OAuth2Client.query.filter_by(client_id='test').one()
+		return StatelessOAuth2Grant(session=session, client=client, redirect_uri='http://localhost:5009/callback', nonce='testnonce', scopes=['openid', 'profile'], claims={'userinfo': {'email': None}}, **kwargs)
+
+	def test_roundtrip(self):
+		grant = self.make_grant()
+		code = grant.code
+		self.assertTrue(code.startswith('s.'))
+		self.assertNotEqual(code, grant.code)
+		loaded = OAuth2Grant.get_by_authorization_code(code)
+		self.assertIsInstance(loaded, StatelessOAuth2Grant)
+		self.assertEqual(loaded.session, grant.session)
+		self.assertEqual(loaded.client, grant.client)
+		self.assertEqual(loaded.redirect_uri, 'http://localhost:5009/callback')
+		self.assertEqual(loaded.nonce, 'testnonce')
+		self.assertEqual(loaded.scopes, ('openid', 'profile'))
+		self.assertEqual(loaded.claims, {'userinfo': {'email': None}})
+		self.assertEqual(loaded.code_id, grant.code_id)
+		self.assertEqual(loaded.service_user.user, self.get_user())
+
+	def test_tampered(self):
+		code = self.make_grant().code
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code(code[:-2] + ('AA' if code[-2:] != 'AA' else 'BB')))
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code('s.invalid'))
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code('s.'))
+		self.app.secret_key = 'othersecret'
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code(code))
+
+	def test_expired(self):
+		code = self.make_grant(expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)).code
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code(code))
+
+	def test_deactivated_user(self):
+		code = self.make_grant().code
+		self.get_user().is_deactivated = True
+		self.assertIsNone(OAuth2Grant.get_by_authorization_code(code))
+
+	def test_invalidate(self):
+		code = self.make_grant().code
+		OAuth2Grant.get_by_authorization_code(code).invalidate()
+		db.session.commit()
+		self.assertEqual(OAuth2RedeemedCode.query.count(), 1)
+		OAuth2Grant.get_by_authorization_code(code).invalidate()
+		with self.assertRaises(sqlalchemy.exc.IntegrityError):
+			db.session.commit()
+
+class TestOAuth2ClientRegistry(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(OAuth2Client(
+			service=Service(name='test', limit_access=False),
+			client_id='test',
+			client_secret='testsecret',
+			redirect_uris=['http://localhost:5009/callback'],
+			logout_uris=[OAuth2LogoutURI(method='GET', uri='http://localhost:5009/logout')],
+		))
+
+	def test_get_client(self):
+		registry = OAuth2ClientRegistry.get()
+		self.assertIsNone(registry.get_client('unknown'))
+		client = registry.get_client('test')
+		db_client = OAuth2Client.query.filter_by(client_id='test').one()
+		self.assertEqual(client.db_id, db_client.db_id)
+		self.assertEqual(registry.clients_by_db_id[db_client.db_id], client)
+		self.assertEqual(client.service_name, 'test')
+		self.assertEqual(client.redirect_uris, ('http://localhost:5009/callback',))
+		self.assertEqual(client.default_redirect_uri, 'http://localhost:5009/callback')
+		self.assertEqual(json.loads(client.logout_uris_json), [['GET', 'http://localhost:5009/logout']])
+		self.assertTrue(client.client_secret.verify('testsecret'))
+		self.assertFalse(client.client_secret.verify('wrongsecret'))
+		self.assertTrue(client.access_allowed(self.get_user()))
+		self.assertIs(OAuth2ClientRegistry.get(), registry)
+
+	def test_invalidation(self):
+		registry = OAuth2ClientRegistry.get()
+		db_client = OAuth2Client.query.filter_by(client_id='test').one()
+		db_client.redirect_uris.append('http://localhost:5009/callback2')
+		# Uncommitted changes are only visible within the transaction
+		local_registry = OAuth2ClientRegistry.get()
+		self.assertIsNot(local_registry, registry)
+		self.assertEqual(len(local_registry.get_client('test').redirect_uris), 2)
+		self.assertIs(current_app.extensions['uffd_oauth2_client_registry'], registry)
+		db.session.rollback()
+		self.assertIs(OAuth2ClientRegistry.get(), registry)
+		OAuth2Client.query.filter_by(client_id='test').one().service.name = 'renamed'
+		db.session.commit()
+		new_registry = OAuth2ClientRegistry.get()
+		self.assertIsNot(new_registry, registry)
+		self.assertEqual(new_registry.get_client('test').service_name, 'renamed')
+		db.session.delete(OAuth2Client.query.filter_by(client_id='test').one())
+		db.session.commit()
+		self.assertIsNone(OAuth2ClientRegistry.get().get_client('test'))
@@ -1,8 +1,11 @@
 import unittest
+from unittest import mock
+
+import sqlalchemy
 
 from uffd.database import db
 from uffd.models import User, Role, RoleGroup, TOTPMethod
-from uffd.models.role import flatten_recursive
+from uffd.models.role import flatten_recursive, RoleGraph, PendingGroupUpdate, enqueue_group_updates, process_group_updates, get_group_update_queue_length, wait_for_group_updates
 
 from tests.utils import UffdTestCase
 
@@ -77,6 +80,70 @@ class TestUserRoleAttributes(UffdTestCase):
 		self.assertSetEqual(groups_removed, set())
 		self.assertSetEqual(set(user.groups), {group1})
 
+class TestRoleGraph(UffdTestCase):
+	def setUpDB(self):
+		group1 = self.get_users_group()
+		group2 = self.get_access_group()
+		group3 = self.get_admin_group()
+		default_role = Role(name='default', is_default=True, groups={group1: RoleGroup(group=group1)})
+		cycle_role1 = Role(name='cycle1', groups={group2: RoleGroup(group=group2)})
+		cycle_role2 = Role(name='cycle2', included_roles=[cycle_role1], groups={group3: RoleGroup(group=group3, requires_mfa=True)})
+		cycle_role1.included_roles.append(cycle_role2)
+		db.session.add_all([default_role, cycle_role1, cycle_role2, Role(name='other')])
+
+	def test_graph(self):
+		graph = RoleGraph.get()
+		self.assertIs(RoleGraph.get(), graph)
+		roles = {role.name: role.id for role in Role.query.all()}
+		self.assertEqual(graph.get_closure(roles['cycle1']), {roles['cycle1'], roles['cycle2']})
+		self.assertEqual(graph.get_effective_role_ids([roles['other']], include_default=False), {roles['other']})
+		self.assertEqual(graph.get_effective_role_ids([roles['other']]), {roles['other'], roles['default']})
+		self.assertEqual(graph.get_effective_groups([roles['cycle2']]), {self.get_users_group(), self.get_access_group(), self.get_admin_group()})
+		self.assertEqual(graph.get_effective_groups([roles['cycle2']], mfa=False), {self.get_users_group(), self.get_access_group()})
+		self.assertEqual(graph.get_effective_groups([], include_default=False), set())
+
+	def test_invalidation(self):
+		graph = RoleGraph.get()
+		Role.query.filter_by(name='other').one().description = 'changed'
+		self.assertIs(RoleGraph.get(), graph)
+		Role.query.filter_by(name='other').one().is_default = True
+		self.assertIsNot(RoleGraph.get(), graph)
+		self.assertEqual(len(RoleGraph.get().default_role_ids), 2)
+		graph = RoleGraph.get()
+		db.session.commit()
+		self.assertIsNot(RoleGraph.get(), graph)
+		graph = RoleGraph.get()
+		Role.query.filter_by(name='other').one().including_roles.append(Role.query.filter_by(name='default').one())
+		self.assertIsNot(RoleGraph.get(), graph)
+		graph = RoleGraph.get()
+		db.session.delete(Role.query.filter_by(name='other').one())
+		self.assertIsNot(RoleGraph.get(), graph)
+
+	def test_get_does_not_scan_session(self):
+		graph = RoleGraph.get()
+		for user in User.query.all():
+			user.displayname = 'changed'
+		with mock.patch('uffd.models.role.role_graph_changed') as role_graph_changed:
+			for _ in range(10):
+				self.assertIs(RoleGraph.get(), graph)
+			role_graph_changed.assert_not_called()
+
+	def test_compute_groups_queries(self):
+		user = self.get_user()
+		user.roles.append(Role.query.filter_by(name='cycle1').one())
+		self.assertEqual(user.compute_groups(), {self.get_users_group(), self.get_access_group()})
+		statements = []
+		def count_statement(*args): # pylint: disable=unused-argument
+			statements.append(args)
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+		try:
+			for _ in range(10):
+				user.compute_groups()
+				user.roles_effective # pylint: disable=pointless-statement
+		finally:
+			sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+		self.assertEqual(statements, [])
+
 class TestRoleModel(UffdTestCase):
 	def test_members_effective(self):
 		db.session.add(User(loginname='service', is_service_user=True, primary_email_address='service@example.com', displayname='Service'))
@@ -95,6 +162,22 @@ class TestRoleModel(UffdTestCase):
 		self.assertSetEqual(direct_role.members_effective, {user1, user2, service})
 		self.assertSetEqual(empty_role.members_effective, set())
 
+	def test_members_effective_ids(self):
+		db.session.add(User(loginname='service', is_service_user=True, primary_email_address='service@example.com', displayname='Service'))
+		db.session.commit()
+		user1 = self.get_user()
+		user2 = self.get_admin()
+		service = User.query.filter_by(loginname='service').one()
+		included_role = Role(name='included')
+		default_role = Role(name='default', is_default=True, included_roles=[included_role])
+		direct_role = Role(name='direct', members=[service], included_roles=[included_role])
+		empty_role = Role(name='empty')
+		db.session.add_all([included_role, default_role, direct_role, empty_role])
+		self.assertEqual(included_role.members_effective_ids, {user1.id, user2.id, service.id})
+		self.assertEqual(default_role.members_effective_ids, {user1.id, user2.id})
+		self.assertEqual(direct_role.members_effective_ids, {service.id})
+		self.assertEqual(empty_role.members_effective_ids, set())
+
 	def test_included_roles_recursive(self):
 		baserole = Role(name='base')
 		role1 = Role(name='role1', included_roles=[baserole])
@@ -127,9 +210,61 @@ class TestRoleModel(UffdTestCase):
 		db.session.add_all([baserole, role1])
 		baserole.update_member_groups()
 		role1.update_member_groups()
+		# Group updates are queued and processed on commit (GROUP_UPDATE_WORKER="inline")
+		db.session.commit()
 		self.assertSetEqual(set(user1.groups), {group1})
 		self.assertSetEqual(set(user2.groups), {group1, group2})
 		baserole.groups[group3] = RoleGroup()
 		baserole.update_member_groups()
+		db.session.commit()
 		self.assertSetEqual(set(user1.groups), {group1, group3})
 		self.assertSetEqual(set(user2.groups), {group1, group2, group3})
+
+class TestGroupUpdateQueue(UffdTestCase):
+	def setUpDB(self):
+		role = Role(name='base', is_default=True)
+		role.groups[self.get_admin_group()] = RoleGroup(group=self.get_admin_group())
+		db.session.add(role)
+
+	def test_inline(self):
+		Role.query.filter_by(name='base').one().update_member_groups()
+		self.assertEqual(get_group_update_queue_length(), 2)
+		db.session.commit()
+		self.assertEqual(get_group_update_queue_length(), 0)
+		self.assertIn(self.get_admin_group(), self.get_user().groups)
+
+	def test_external(self):
+		self.app.config['GROUP_UPDATE_WORKER'] = 'external'
+		Role.query.filter_by(name='base').one().update_member_groups()
+		db.session.commit()
+		self.assertEqual(get_group_update_queue_length(), 2)
+		self.assertNotIn(self.get_admin_group(), self.get_user().groups)
+		self.assertFalse(wait_for_group_updates(timeout=0))
+		self.assertEqual(process_group_updates(batch_size=1), 2)
+		self.assertEqual(get_group_update_queue_length(), 0)
+		self.assertIn(self.get_admin_group(), self.get_user().groups)
+		self.assertTrue(wait_for_group_updates(timeout=0))
+
+	def test_enqueue_again(self):
+		self.app.config['GROUP_UPDATE_WORKER'] = 'external'
+		user = self.get_user()
+		enqueue_group_updates(User.id == user.id)
+		self.assertEqual(PendingGroupUpdate.query.get(user.id).version, 0)
+		enqueue_group_updates(User.id == user.id)
+		db.session.expire_all()
+		self.assertEqual(PendingGroupUpdate.query.get(user.id).version, 1)
+		self.assertEqual(get_group_update_queue_length(), 1)
+
+class TestGroupUpdateQueueThread(UffdTestCase):
+	# The worker thread uses its own database connection
+	DISABLE_SQLITE_MEMORY_DB = True
+
+	def setUpDB(self):
+		TestGroupUpdateQueue.setUpDB(self)
+
+	def test_thread(self):
+		self.app.config['GROUP_UPDATE_WORKER'] = 'thread'
+		Role.query.filter_by(name='base').one().update_member_groups()
+		db.session.commit()
+		self.assertTrue(wait_for_group_updates(timeout=10))
+		self.assertIn(self.get_admin_group(), self.get_user().groups)
@@ -3,7 +3,8 @@ import itertools
 from uffd.remailer import remailer
 from uffd.tasks import cleanup_task
 from uffd.database import db
-from uffd.models import Service, ServiceUser, User, UserEmail, RemailerMode
+from uffd.models import Service, ServiceUser, User, UserEmail, RemailerMode, get_services
+from uffd.models.service import ServicesCache
 
 from tests.utils import UffdTestCase
 
@@ -103,6 +104,27 @@ class TestServiceUser(UffdTestCase):
 		self.assertEqual(ServiceUser.get_by_remailer_email(remailer_email), service_user)
 		self.assertIsNone(ServiceUser.get_by_remailer_email('invalid'))
 
+	def test_get_by_remailer_emails(self):
+		user = self.get_user()
+		admin = self.get_admin()
+		service1 = Service.query.filter_by(name='service1').first()
+		service2 = Service.query.filter_by(name='service2').first()
+		self.app.config['REMAILER_DOMAIN'] = 'remailer.example.com'
+		email1 = remailer.build_v1_address(service1.id, user.id)
+		email2 = remailer.build_v2_address(service2.id, admin.id)
+		# Valid signature, but no such ServiceUser
+		email3 = remailer.build_v1_address(service1.id, 12345)
+		addresses = [email1, email2, email3, user.primary_email.address, 'invalid']
+		self.assertEqual(ServiceUser.get_by_remailer_emails(addresses), {
+			email1: ServiceUser.query.get((service1.id, user.id)),
+			email2: ServiceUser.query.get((service2.id, admin.id)),
+			email3: None,
+			user.primary_email.address: None,
+			'invalid': None,
+		})
+		self.app.config['REMAILER_DOMAIN'] = ''
+		self.assertEqual(ServiceUser.get_by_remailer_emails([email1]), {email1: None})
+
 	def test_email(self):
 		user = self.get_user()
 		service = Service.query.filter_by(name='service1').first()
@@ -184,3 +206,106 @@ class TestServiceUser(UffdTestCase):
 			b = set(ServiceUser.filter_query_by_email(ServiceUser.query, value).all())
 			if a != b:
 				self.fail(f'{a} != {b} with ' + repr(options))
+
+	def test_add_email_columns(self):
+		service = Service.query.filter_by(name='service1').first()
+		user = self.get_user()
+		email1 = user.primary_email
+		email2 = UserEmail(user=user, address='test2@example.com', verified=True)
+		db.session.add(email2)
+		service_user = ServiceUser.query.get((service.id, user.id))
+		cases = itertools.product(
+			# REMAILER_DOMAIN config
+			[None, 'remailer.example.com'],
+			# REMAILER_LIMIT config
+			[None, ['testuser', 'otheruser'], ['testadmin', 'otheruser']],
+			# service.remailer_mode
+			[RemailerMode.DISABLED, RemailerMode.ENABLED_V1, RemailerMode.ENABLED_V2],
+			# service.enable_email_preferences
+			[True, False],
+			# service.limit_access, service.access_group
+			[(False, None), (True, None), (True, self.get_admin_group()), (True, self.get_users_group())],
+			# service_user.service_email
+			[None, email1, email2],
+			# service_user.remailer_overwrite_mode
+			[None, RemailerMode.DISABLED, RemailerMode.ENABLED_V1, RemailerMode.ENABLED_V2],
+		)
+		for options in cases:
+			self.app.config['REMAILER_DOMAIN'] = options[0]
+			self.app.config['REMAILER_LIMIT_TO_USERS'] = options[1]
+			service.remailer_mode = options[2]
+			service.enable_email_preferences = options[3]
+			service.limit_access, service.access_group = options[4]
+			service_user.service_email = options[5]
+			service_user.remailer_overwrite_mode = options[6]
+			for row in ServiceUser.add_email_columns(ServiceUser.query):
+				self.assertEqual(row.has_access, row[0].has_access, repr(options))
+				self.assertEqual(row[0].get_email(row.remailer_mode, row.real_email), row[0].email, repr(options))
+
+class TestGetServices(UffdTestCase):
+	def setUpApp(self):
+		self.app.config['SERVICES'] = [
+			{
+				'title': 'Service',
+				'title_de': 'Dienst',
+				'required_group': 'users',
+				'permission_levels': [
+					{'name': 'Moderator', 'required_group': [['users', 'uffd_access']]},
+					{'name': 'Admin', 'required_group': 'uffd_admin'},
+					{'required_group': 'users'},
+				],
+				'groups': [
+					{'name': 'Admins', 'required_group': 'uffd_admin'},
+					{'name': 'Everyone'},
+				],
+				'infos': [
+					{'title': 'Info', 'html': '<p>Info</p>', 'required_group': ['uffd_admin', 'users']},
+					{'title': 'Empty', 'html': ''},
+				],
+				'links': [
+					{'title': 'Link', 'url': '#', 'required_group': 'uffd_admin'},
+				],
+			},
+			{'title': 'Confidential', 'confidential': True, 'required_group': 'uffd_admin'},
+			{'description': 'No title'},
+		]
+
+	def test_guest(self):
+		self.assertEqual(get_services(), [{
+			'title': 'Service', 'subtitle': '', 'description': '', 'url': '', 'logo_url': '',
+			'has_access': False, 'permission': '',
+			'groups': [{'name': 'Everyone'}], 'infos': [], 'links': [],
+		}])
+		self.app.config['SERVICES_PUBLIC'] = False
+		self.assertEqual(get_services(), [])
+
+	def test_user(self):
+		services = get_services(self.get_user())
+		self.assertEqual(len(services), 1)
+		self.assertTrue(services[0]['has_access'])
+		self.assertEqual(services[0]['permission'], 'Moderator')
+		self.assertEqual(services[0]['groups'], [{'name': 'Everyone'}])
+		self.assertEqual(services[0]['infos'], [{'title': 'Info', 'button_text': 'Info', 'html': '<p>Info</p>', 'id': '0-0'}])
+		self.assertEqual(services[0]['links'], [])
+
+	def test_admin(self):
+		services = get_services(self.get_admin())
+		self.assertEqual([service['title'] for service in services], ['Service', 'Confidential'])
+		self.assertEqual(services[0]['permission'], 'Admin')
+		self.assertEqual(services[0]['groups'], [{'name': 'Admins', 'required_group': 'uffd_admin'}, {'name': 'Everyone'}])
+		self.assertEqual(services[0]['links'], [{'title': 'Link', 'url': '#', 'required_group': 'uffd_admin'}])
+		self.assertTrue(services[1]['has_access'])
+
+	def test_cache(self):
+		self.assertIs(get_services(self.get_user()), get_services(self.get_user()))
+		# Users with the same relevant groups share cache entries
+		user = User(loginname='other', displayname='Other', primary_email_address='other@example.com')
+		user.groups = list(self.get_user().groups)
+		self.assertIs(get_services(user), get_services(self.get_user()))
+		caches = self.app.extensions['uffd_lru_caches']
+		old_token = ServicesCache.get().results.token
+		self.app.config['SERVICES'] = [{'title': 'New'}]
+		self.assertEqual([service['title'] for service in get_services(self.get_user())], ['New'])
+		# Entries of the replaced cache are freed
+		self.assertNotIn(old_token, caches)
+		self.assertIn(ServicesCache.get().results.token, caches)
@@ -32,6 +32,32 @@ class TestUserModel(UffdTestCase):
 		self.assertFalse(user_.has_permission(['uffd_admin', ['users', 'notagroup']]))
 		self.assertTrue(admin.has_permission(['uffd_admin', ['users', 'notagroup']]))
 
+	def test_group_sets(self):
+		user = self.get_user()
+		users = Group.query.filter_by(name='users').one()
+		admin_group = Group.query.filter_by(name='uffd_admin').one()
+		self.assertEqual(user.group_names, {'users', 'uffd_access'})
+		self.assertIn(users.id, user.group_ids)
+		statements = []
+		def count_statement(*args): # pylint: disable=unused-argument
+			statements.append(args)
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+		try:
+			for _ in range(10):
+				self.assertTrue(user.has_permission([['users', 'uffd_access']]))
+				self.assertFalse(user.is_in_group('uffd_admin'))
+		finally:
+			sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+		self.assertEqual(statements, [])
+		user.groups.append(admin_group)
+		self.assertTrue(user.is_in_group('uffd_admin'))
+		users.members.remove(user)
+		self.assertFalse(user.is_in_group('users'))
+		admin_group.name = 'renamed'
+		self.assertEqual(user.group_names, {'uffd_access', 'renamed'})
+		db.session.commit()
+		self.assertEqual(user.group_ids, {admin_group.id, Group.query.filter_by(name='uffd_access').one().id})
+
 	def test_unix_uid_generation(self):
 		self.app.config['USER_MIN_UID'] = 10000
 		self.app.config['USER_MAX_UID'] = 18999
@@ -0,0 +1,36 @@
+import unittest
+
+from flask import Flask, request
+
+from uffd.navbar import request_memoized
+
+class TestRequestMemoized(unittest.TestCase):
+	def setUp(self):
+		self.app = Flask(__name__)
+		self.calls = []
+
+		@request_memoized
+		def check():
+			self.calls.append(request.user)
+			return request.user == 'admin'
+		self.check = check
+
+	def test_memoized(self):
+		with self.app.test_request_context():
+			request.user = 'admin'
+			self.assertTrue(self.check())
+			self.assertTrue(self.check())
+			self.assertEqual(self.calls, ['admin'])
+			request.user = 'user'
+			self.assertFalse(self.check())
+			self.assertFalse(self.check())
+			self.assertEqual(self.calls, ['admin', 'user'])
+		with self.app.test_request_context():
+			request.user = 'admin'
+			self.assertTrue(self.check())
+			self.assertEqual(self.calls, ['admin', 'user', 'admin'])
+
+	def test_no_request_context(self):
+		with self.app.app_context():
+			with self.assertRaises(RuntimeError):
+				self.check()
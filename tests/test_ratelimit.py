@@ -1,4 +1,11 @@
-from uffd.models.ratelimit import get_addrkey, format_delay, Ratelimit
+import tempfile
+import time
+from unittest import mock
+
+import sqlalchemy
+
+from uffd.database import db
+from uffd.models.ratelimit import get_addrkey, format_delay, Ratelimit, MemoryRatelimitBackend
 
 from tests.utils import UffdTestCase
 
@@ -44,3 +51,57 @@ class TestRatelimit(UffdTestCase):
 		self.assertIsInstance(format_delay(120), str)
 		self.assertIsInstance(format_delay(3600), str)
 		self.assertIsInstance(format_delay(4000), str)
+
+class TestMemoryRatelimit(TestRatelimit):
+	def setUpApp(self):
+		self.app.config['RATELIMIT_BACKEND'] = 'memory'
+
+	def test_sliding_window(self):
+		ratelimit = Ratelimit('test', 60, 3)
+		now = time.time()
+		with mock.patch('time.time', return_value=now):
+			for _ in range(4):
+				ratelimit.log('key')
+		# 90 seconds later, the first window ended 30 seconds ago, so half of
+		# its events are estimated to be within the last interval
+		with mock.patch('time.time', return_value=now + 90):
+			count, _ = self.app.extensions['uffd_ratelimit_backends']['memory'].get_stats('test', 'key', 60)
+			self.assertAlmostEqual(count, 2)
+		with mock.patch('time.time', return_value=now + 120):
+			self.assertEqual(ratelimit.get_delay('key'), 0)
+		self.assertEqual(ratelimit.get_delay('other'), 0)
+
+	def test_shared_file(self):
+		with tempfile.NamedTemporaryFile() as f:
+			self.app.config['RATELIMIT_MEMORY_PATH'] = f.name
+			backend1 = MemoryRatelimitBackend(self.app)
+			backend2 = MemoryRatelimitBackend(self.app)
+			backend1.log('test', 'key', 60)
+			backend1.log('test', 'key', 60)
+			self.assertEqual(backend2.get_stats('test', 'key', 60)[0], 2)
+			self.assertEqual(backend2.get_stats('test', None, 60)[0], 0)
+
+	def test_full_table(self):
+		self.app.config['RATELIMIT_MEMORY_SLOTS'] = 4
+		backend = MemoryRatelimitBackend(self.app)
+		for i in range(10):
+			backend.log('test', str(i), 60)
+		self.assertEqual(backend.get_stats('test', '9', 60)[0], 1)
+
+class TestSQLRatelimitBackend(UffdTestCase):
+	def test_get_stats_uses_index(self):
+		if db.engine.dialect.name != 'sqlite':
+			self.skipTest('Query plan check is only implemented for SQLite')
+		statements = []
+		def record_statement(conn, cursor, statement, parameters, context, executemany): # pylint: disable=unused-argument,too-many-arguments
+			statements.append((statement, parameters))
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record_statement)
+		try:
+			Ratelimit('login', 60, 3).get_delay('testuser')
+		finally:
+			sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record_statement)
+		statement, parameters = [item for item in statements if 'FROM ratelimit_event' in item[0]][0]
+		cursor = db.session.connection().connection.cursor()
+		cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+		plan = ' '.join(row[-1] for row in cursor.fetchall())
+		self.assertIn('INDEX ix_ratelimit_event_name_key_expires', plan)
@@ -1,3 +1,7 @@
+from unittest import mock
+
+import itsdangerous
+
 from uffd.remailer import remailer
 
 from tests.utils import UffdTestCase
@@ -52,6 +56,27 @@ class TestRemailer(UffdTestCase):
 		self.app.config['REMAILER_SECRET_KEY'] = 'REMAILER-DEBUGKEY'
 		self.assertNotEqual(remailer.build_v2_address(SERVICE1_ID, USER_ID), ADDR_V2_S1)
 
+	def test_build_v2_addresses(self):
+		self.app.config['REMAILER_DOMAIN'] = 'remailer.example.com'
+		self.assertEqual(remailer.build_v2_addresses([]), [])
+		self.assertEqual(remailer.build_v2_addresses([(SERVICE1_ID, USER_ID), (SERVICE2_ID, USER_ID)]), [ADDR_V2_S1, ADDR_V2_S2])
+
+	def test_get_serializer(self):
+		self.assertIs(remailer.get_serializer(), remailer.get_serializer())
+		serializer = remailer.get_serializer()
+		self.app.config['REMAILER_SECRET_KEY'] = 'REMAILER-DEBUGKEY'
+		self.assertIsNot(remailer.get_serializer(), serializer)
+		self.assertEqual(remailer.get_serializer().loads(remailer.get_serializer().dumps([1, 2])), [1, 2])
+
+	def test_parse_payload_key_cache(self):
+		self.app.config['REMAILER_DOMAIN'] = 'remailer.example.com'
+		# Derive and cache the keys
+		self.assertEqual(remailer.parse_address(ADDR_V1_S1), (SERVICE1_ID, USER_ID))
+		with mock.patch.object(itsdangerous.Signer, 'derive_key', autospec=True) as derive_key:
+			self.assertEqual(remailer.parse_address(ADDR_V1_S1), (SERVICE1_ID, USER_ID))
+			self.assertEqual(remailer.parse_address(ADDR_V2_S2), (SERVICE2_ID, USER_ID))
+			derive_key.assert_not_called()
+
 	def test_parse_address(self):
 		# REMAILER_DOMAIN behaviour
 		self.app.config['REMAILER_DOMAIN'] = None
@@ -5,8 +5,8 @@ from flask import url_for
 from uffd.password_hash import PlaintextPasswordHash
 from uffd.remailer import remailer
 from uffd.database import db
-from uffd.models import APIClient, Service, User, RemailerMode
-from uffd.views.api import apikey_required
+from uffd.models import APIClient, Service, User, Group, Mail, RemailerMode, ChangelogEntry
+from uffd.views.api import apikey_required, stream_json_list, auth_cache, REMAILER_BATCH_MAX_ADDRESSES
 from tests.utils import UffdTestCase, db_flush
 
 def basic_auth(username, password):
@@ -62,6 +62,52 @@ class TestAPIAuth(UffdTestCase):
 		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test3', 'testsecret3')], follow_redirects=True)
 		self.assertEqual(r.status_code, 200)
 
+	def test_auth_cache(self):
+		r = self.client.get(path=url_for('testendpoint2'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		# Changes that bypass the ORM are not noticed, so the cache is used
+		db.session.execute(db.update(APIClient.__table__).where(APIClient.auth_username == 'test1').values(perm_users=False))
+		db.session.commit()
+		r = self.client.get(path=url_for('testendpoint2'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		# Wrong passwords are never cached
+		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test1', 'testsecret2')], follow_redirects=True)
+		self.assertEqual(r.status_code, 401)
+		APIClient.query.filter_by(auth_username='test2').one().perm_metrics = True
+		db.session.commit()
+		r = self.client.get(path=url_for('testendpoint2'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 403)
+
+	def test_auth_cache_delete(self):
+		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		db.session.delete(APIClient.query.filter_by(auth_username='test1').one())
+		db.session.commit()
+		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 401)
+
+	def test_auth_cache_delete_core(self):
+		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		# Deletion by another process, the cache of this process is not cleared
+		db.session.execute(db.delete(APIClient.__table__).where(APIClient.auth_username == 'test1'))
+		db.session.commit()
+		self.assertEqual(len(auth_cache.entries), 1)
+		r = self.client.get(path=url_for('testendpoint1'), headers=[basic_auth('test1', 'testsecret1')], follow_redirects=True)
+		self.assertEqual(r.status_code, 401)
+		self.assertEqual(len(auth_cache.entries), 0)
+
+class TestStreamJSONList(UffdTestCase):
+	def test(self):
+		query = User.query.order_by(User.unix_uid)
+		resp = stream_json_list(query, lambda user: user.loginname, yield_per=1)
+		self.assertTrue(resp.is_streamed)
+		self.assertEqual(resp.get_json(), ['testuser', 'testadmin'])
+
+	def test_empty(self):
+		resp = stream_json_list(User.query.filter_by(loginname='notauser'), lambda user: user.loginname)
+		self.assertEqual(resp.get_json(), [])
+
 class TestAPIGetmails(UffdTestCase):
 	def setUpDB(self):
 		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_mail_aliases=True))
@@ -225,6 +271,19 @@ class TestAPIGetusers(UffdTestCase):
 			{'displayname': 'Test Admin', 'email': 'admin@example.com', 'id': 10001, 'loginname': 'testadmin', 'groups': ['uffd_access', 'uffd_admin', 'users']}
 		])
 
+	def test_etag(self):
+		r = self.client.get(path=url_for('api.getusers'), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		etag = r.headers['ETag']
+		r = self.client.get(path=url_for('api.getusers'), headers=[basic_auth('test', 'test'), ('If-None-Match', etag)], follow_redirects=True)
+		self.assertEqual(r.status_code, 304)
+		self.get_user().displayname = 'New Name'
+		db.session.commit()
+		r = self.client.get(path=url_for('api.getusers'), headers=[basic_auth('test', 'test'), ('If-None-Match', etag)], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertNotEqual(r.headers['ETag'], etag)
+		self.assertEqual(self.fix_result(r.json)[0]['displayname'], 'New Name')
+
 class TestAPIGetgroups(UffdTestCase):
 	def setUpDB(self):
 		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_users=True))
@@ -316,6 +375,156 @@ class TestAPIGetgroups(UffdTestCase):
 		self.assertEqual(r.status_code, 200)
 		self.assertEqual(self.fix_result(r.json), [])
 
+	def test_etag(self):
+		r = self.client.get(path=url_for('api.getgroups'), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		etag = r.headers['ETag']
+		r = self.client.get(path=url_for('api.getgroups'), headers=[basic_auth('test', 'test'), ('If-None-Match', etag)], follow_redirects=True)
+		self.assertEqual(r.status_code, 304)
+		group = self.get_admin_group()
+		group.members.remove(self.get_admin())
+		db.session.commit()
+		r = self.client.get(path=url_for('api.getgroups'), headers=[basic_auth('test', 'test'), ('If-None-Match', etag)], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertNotEqual(r.headers['ETag'], etag)
+		self.assertEqual(self.fix_result(r.json)[2], {'id': 20003, 'members': [], 'name': 'uffd_admin'})
+
+class TestAPIChanges(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_users=True, perm_mail_aliases=True))
+		db.session.add(APIClient(service=Service(name='test2'), auth_username='test2', auth_password='test2', perm_mail_aliases=True))
+		db.session.add(APIClient(service=Service(name='test3'), auth_username='test3', auth_password='test3', perm_checkpassword=True))
+
+	def get_cursor(self):
+		r = self.client.get(path=url_for('api.changes'), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json['cursor']
+
+	def get_changes(self, since, auth=('test', 'test')):
+		r = self.client.get(path=url_for('api.changes', since=since), headers=[basic_auth(*auth)], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json
+
+	def test_no_changes(self):
+		cursor = self.get_cursor()
+		self.assertEqual(self.get_changes(cursor), {
+			'cursor': cursor,
+			'users': {'created': [], 'updated': [], 'deleted': []},
+			'groups': {'created': [], 'updated': [], 'deleted': []},
+			'mails': {'created': [], 'updated': [], 'deleted': []},
+		})
+
+	def test_user_changes(self):
+		cursor = self.get_cursor()
+		self.get_user().displayname = 'New Name'
+		db.session.add(User(loginname='newuser', displayname='New User', primary_email_address='new@example.com'))
+		db.session.delete(self.get_admin())
+		db.session.commit()
+		result = self.get_changes(cursor)
+		self.assertGreater(result['cursor'], cursor)
+		self.assertEqual(result['users']['created'], [
+			{'displayname': 'New User', 'email': 'new@example.com', 'id': 10002, 'loginname': 'newuser', 'groups': []},
+		])
+		self.assertEqual(len(result['users']['updated']), 1)
+		self.assertEqual(result['users']['updated'][0]['displayname'], 'New Name')
+		self.assertEqual(result['users']['deleted'], [10001])
+		# Members of the deleted user's groups changed
+		self.assertEqual(sorted(group['name'] for group in result['groups']['updated']), ['uffd_access', 'uffd_admin', 'users'])
+		self.assertEqual(self.get_changes(result['cursor'])['users'], {'created': [], 'updated': [], 'deleted': []})
+
+	def test_created_and_deleted(self):
+		cursor = self.get_cursor()
+		db.session.add(User(loginname='newuser', displayname='New User', primary_email_address='new@example.com'))
+		db.session.commit()
+		db.session.delete(User.query.filter_by(loginname='newuser').one())
+		db.session.commit()
+		self.assertEqual(self.get_changes(cursor)['users'], {'created': [], 'updated': [], 'deleted': []})
+
+	def test_group_changes(self):
+		cursor = self.get_cursor()
+		group = self.get_admin_group()
+		group.members.remove(self.get_admin())
+		db.session.add(Group(name='newgroup'))
+		db.session.commit()
+		result = self.get_changes(cursor)
+		self.assertEqual(result['groups']['created'], [{'id': 20000, 'members': [], 'name': 'newgroup'}])
+		self.assertEqual(result['groups']['updated'], [{'id': 20003, 'members': [], 'name': 'uffd_admin'}])
+		self.assertEqual([user['loginname'] for user in result['users']['updated']], ['testadmin'])
+		cursor = result['cursor']
+		db.session.delete(Group.query.filter_by(name='newgroup').one())
+		db.session.commit()
+		self.assertEqual(self.get_changes(cursor)['groups'], {'created': [], 'updated': [], 'deleted': [20000]})
+		cursor = self.get_cursor()
+		db.session.delete(self.get_access_group())
+		db.session.commit()
+		result = self.get_changes(cursor)
+		self.assertEqual(result['groups'], {'created': [], 'updated': [], 'deleted': [20002]})
+		# Members of the deleted group changed
+		self.assertEqual(sorted(user['loginname'] for user in result['users']['updated']), ['testadmin', 'testuser'])
+
+	def test_deactivated(self):
+		Service.query.filter_by(name='test').one().hide_deactivated_users = True
+		db.session.commit()
+		cursor = self.get_cursor()
+		self.get_user().is_deactivated = True
+		db.session.commit()
+		result = self.get_changes(cursor)
+		self.assertEqual(result['users'], {'created': [], 'updated': [], 'deleted': [10000]})
+		self.assertEqual(sorted(group['name'] for group in result['groups']['updated']), ['uffd_access', 'users'])
+		self.assertEqual(result['groups']['updated'][0]['members'], ['testadmin'])
+
+	def test_service_settings(self):
+		cursor = self.get_cursor()
+		Service.query.filter_by(name='test').one().hide_deactivated_users = True
+		db.session.commit()
+		result = self.get_changes(cursor)
+		self.assertEqual(len(result['users']['updated']), 2)
+		self.assertEqual(len(result['groups']['updated']), 3)
+
+	def test_mail_changes(self):
+		cursor = self.get_cursor()
+		mail = Mail.query.filter_by(uid='test').one()
+		mail.receivers.append('test3@example.com')
+		db.session.add(Mail(uid='new', receivers=['new@example.com'], destinations=['new@mail.example.com']))
+		db.session.commit()
+		result = self.get_changes(cursor, auth=('test2', 'test2'))
+		self.assertEqual(set(result.keys()), {'cursor', 'mails'})
+		self.assertEqual(result['mails'], {
+			'created': [{'name': 'new', 'receive_addresses': ['new@example.com'], 'destination_addresses': ['new@mail.example.com']}],
+			'updated': [{'name': 'test', 'receive_addresses': ['test1@example.com', 'test2@example.com', 'test3@example.com'], 'destination_addresses': ['testuser@mail.example.com']}],
+			'deleted': [],
+		})
+		cursor = result['cursor']
+		db.session.delete(Mail.query.filter_by(uid='test').one())
+		db.session.commit()
+		self.assertEqual(self.get_changes(cursor, auth=('test2', 'test2'))['mails'], {'created': [], 'updated': [], 'deleted': ['test']})
+
+	def test_expired_cursor(self):
+		cursor = self.get_cursor()
+		self.get_user().displayname = 'New Name'
+		db.session.commit()
+		# Simulate cleanup of old entries
+		ChangelogEntry.query.filter(ChangelogEntry.id <= cursor).delete()
+		db.session.commit()
+		r = self.client.get(path=url_for('api.changes', since=cursor), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 410)
+		r = self.client.get(path=url_for('api.changes', since=0), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 410)
+		r = self.client.get(path=url_for('api.changes', since=cursor + 100), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 410)
+
+	def test_invalid(self):
+		r = self.client.get(path=url_for('api.changes', since='foo'), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		r = self.client.get(path=url_for('api.changes', since=-1), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		r = self.client.get(path=url_for('api.changes', since=[1, 2]), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		r = self.client.get(path=url_for('api.changes', foo='bar'), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		r = self.client.get(path=url_for('api.changes'), headers=[basic_auth('test3', 'test3')], follow_redirects=True)
+		self.assertEqual(r.status_code, 403)
+
 class TestAPIRemailerResolve(UffdTestCase):
 	def setUpDB(self):
 		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_remailer=True))
@@ -340,6 +549,32 @@ class TestAPIRemailerResolve(UffdTestCase):
 		r = self.client.get(path=url_for('api.resolve_remailer', foo='bar'), headers=[basic_auth('test', 'test')], follow_redirects=True)
 		self.assertEqual(r.status_code, 400)
 
+	def test_batch(self):
+		self.app.config['REMAILER_DOMAIN'] = 'remailer.example.com'
+		service = Service.query.filter_by(name='service2').one()
+		email1 = remailer.build_v1_address(service.id, self.get_user().id)
+		email2 = remailer.build_v2_address(service.id, self.get_admin().id)
+		r = self.client.post(path=url_for('api.resolve_remailer_batch'), data={'orig_address': [email1, email2, 'foo@bar']}, headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json, {'addresses': {
+			email1: self.get_user().primary_email.address,
+			email2: self.get_admin().primary_email.address,
+			'foo@bar': None,
+		}})
+		r = self.client.post(path=url_for('api.resolve_remailer_batch'), data={'foo': 'bar'}, headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+
+	def test_batch_limit(self):
+		self.app.config['REMAILER_DOMAIN'] = 'remailer.example.com'
+		service = Service.query.filter_by(name='service2').one()
+		addresses = [remailer.build_v1_address(service.id, user_id) for user_id in range(REMAILER_BATCH_MAX_ADDRESSES)]
+		r = self.client.post(path=url_for('api.resolve_remailer_batch'), data={'orig_address': addresses}, headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(len(r.json['addresses']), REMAILER_BATCH_MAX_ADDRESSES)
+		addresses.append(remailer.build_v1_address(service.id, REMAILER_BATCH_MAX_ADDRESSES))
+		r = self.client.post(path=url_for('api.resolve_remailer_batch'), data={'orig_address': addresses}, headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+
 class TestAPIMetricsPrometheus(UffdTestCase):
 	def setUpDB(self):
 		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_metrics=True))
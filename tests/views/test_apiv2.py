@@ -0,0 +1,116 @@
+from flask import url_for
+
+from uffd.database import db
+from uffd.models import APIClient, Service, User, Group, Mail
+
+from tests.utils import UffdTestCase
+from tests.views.test_api import basic_auth
+
+class TestAPIv2Users(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_users=True))
+
+	def get(self, **kwargs):
+		r = self.client.get(path=url_for('apiv2.users', **kwargs), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json
+
+	def test_all(self):
+		result = self.get()
+		self.assertEqual(result['next'], None)
+		for user in result['results']:
+			user['groups'].sort()
+		self.assertEqual(result['results'], [
+			{'displayname': 'Test User', 'email': 'test@example.com', 'id': 10000, 'loginname': 'testuser', 'groups': ['uffd_access', 'users']},
+			{'displayname': 'Test Admin', 'email': 'admin@example.com', 'id': 10001, 'loginname': 'testadmin', 'groups': ['uffd_access', 'uffd_admin', 'users']}
+		])
+
+	def test_pagination(self):
+		for i in range(3):
+			db.session.add(User(loginname=f'user{i}', displayname='User', primary_email_address=f'user{i}@example.com'))
+		db.session.commit()
+		result = self.get(limit=2, fields='id')
+		self.assertEqual(result, {'results': [{'id': 10000}, {'id': 10001}], 'next': 10001})
+		result = self.get(limit=2, fields='id', after=result['next'])
+		self.assertEqual(result, {'results': [{'id': 10002}, {'id': 10003}], 'next': 10003})
+		result = self.get(limit=2, fields='id', after=result['next'])
+		self.assertEqual(result, {'results': [{'id': 10004}], 'next': None})
+
+	def test_filters(self):
+		result = self.get(loginname=['testuser', 'testadmin'], group='uffd_admin', fields='loginname,id')
+		self.assertEqual(result['results'], [{'id': 10001, 'loginname': 'testadmin'}])
+		result = self.get(id=[10000, 10001], email='test@example.com', fields='loginname')
+		self.assertEqual(result['results'], [{'loginname': 'testuser'}])
+
+	def test_deactivated(self):
+		self.get_user().is_deactivated = True
+		Service.query.filter_by(name='test').one().hide_deactivated_users = True
+		db.session.commit()
+		self.assertEqual(self.get(fields='loginname')['results'], [{'loginname': 'testadmin'}])
+
+	def test_invalid(self):
+		invalid_params = [
+			{'foo': 'bar'}, {'fields': 'foo'}, {'fields': ''}, {'id': 'foo'}, {'after': 'foo'},
+			{'after': [1, 2]}, {'limit': 0}, {'limit': 1001}, {'email': ['a@example.com', 'b@example.com']},
+		]
+		for kwargs in invalid_params:
+			r = self.client.get(path=url_for('apiv2.users', **kwargs), headers=[basic_auth('test', 'test')], follow_redirects=True)
+			self.assertEqual(r.status_code, 400, kwargs)
+
+class TestAPIv2Groups(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_users=True))
+
+	def get(self, **kwargs):
+		r = self.client.get(path=url_for('apiv2.groups', **kwargs), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json
+
+	def test_all(self):
+		result = self.get()
+		for group in result['results']:
+			group['members'].sort()
+		self.assertEqual(result, {'next': None, 'results': [
+			{'id': 20001, 'members': ['testadmin', 'testuser'], 'name': 'users'},
+			{'id': 20002, 'members': ['testadmin', 'testuser'], 'name': 'uffd_access'},
+			{'id': 20003, 'members': ['testadmin'], 'name': 'uffd_admin'}
+		]})
+
+	def test_pagination(self):
+		self.assertEqual(self.get(limit=2, fields='name'), {'results': [{'name': 'users'}, {'name': 'uffd_access'}], 'next': 20002})
+		self.assertEqual(self.get(limit=2, fields='name', after=20002), {'results': [{'name': 'uffd_admin'}], 'next': None})
+
+	def test_filters(self):
+		db.session.add(Group(name='empty'))
+		db.session.commit()
+		self.assertEqual(self.get(member='testuser', fields='name')['results'], [{'name': 'users'}, {'name': 'uffd_access'}])
+		self.assertEqual(self.get(member='testuser', name=['users', 'uffd_admin', 'empty'], fields='name')['results'], [{'name': 'users'}])
+		self.assertEqual(self.get(id=[20003, 20004], fields='name')['results'], [{'name': 'uffd_admin'}])
+
+class TestAPIv2Mails(UffdTestCase):
+	def setUpDB(self):
+		db.session.add(APIClient(service=Service(name='test'), auth_username='test', auth_password='test', perm_mail_aliases=True))
+		db.session.add(Mail(uid='test2', receivers=['test3@example.com'], destinations=['other@mail.example.com']))
+
+	def get(self, **kwargs):
+		r = self.client.get(path=url_for('apiv2.mails', **kwargs), headers=[basic_auth('test', 'test')], follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json
+
+	def test_all(self):
+		result = self.get()
+		self.assertEqual(result['next'], None)
+		self.assertEqual(result['results'], [
+			{'name': 'test', 'receive_addresses': ['test1@example.com', 'test2@example.com'], 'destination_addresses': ['testuser@mail.example.com']},
+			{'name': 'test2', 'receive_addresses': ['test3@example.com'], 'destination_addresses': ['other@mail.example.com']},
+		])
+
+	def test_pagination(self):
+		result = self.get(limit=1, fields='name')
+		self.assertEqual(result['results'], [{'name': 'test'}])
+		self.assertEqual(self.get(limit=1, fields='name', after=result['next']), {'results': [{'name': 'test2'}], 'next': None})
+
+	def test_filters(self):
+		self.assertEqual(self.get(receive_address=['Test1@example.com', 'test3@example.com'], fields='name')['results'], [{'name': 'test'}, {'name': 'test2'}])
+		self.assertEqual(self.get(receive_address='test3@example.com', destination_address='testuser@mail.example.com')['results'], [])
+		self.assertEqual(self.get(name='test2', fields='destination_addresses')['results'], [{'destination_addresses': ['other@mail.example.com']}])
@@ -0,0 +1,45 @@
+import datetime
+
+import sqlalchemy
+from flask import url_for
+
+from uffd.database import db
+from uffd.models import User, Group, Role, RoleGroup, Invite, InviteGrant, InviteSignup, Mail
+
+from tests.utils import UffdTestCase
+
+class TestListViewQueryCount(UffdTestCase):
+	def count_queries(self, endpoint):
+		db.session.commit()
+		statements = []
+		def count_statement(*args): # pylint: disable=unused-argument
+			statements.append(args)
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+		try:
+			r = self.client.get(path=url_for(endpoint), follow_redirects=True)
+		finally:
+			sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+		self.assertEqual(r.status_code, 200)
+		return len(statements)
+
+	def add_rows(self, index):
+		testuser, testadmin = self.get_user(), self.get_admin()
+		group = Group(name=f'group{index}', members=[testuser, testadmin])
+		user = User(loginname=f'user{index}', displayname='User', primary_email_address=f'user{index}@example.com', groups=[group])
+		role = Role(name=f'role{index}', moderator_group=group, members=[user, testuser])
+		role.groups[group] = RoleGroup(group=group)
+		user.roles.append(Role(name=f'otherrole{index}'))
+		valid_until = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+		signup = InviteSignup(loginname=f'signup{index}', displayname='Signup', mail=f'signup{index}@example.com', password='Test1234!', user=user)
+		db.session.add(Invite(valid_until=valid_until, creator=user, roles=[role], grants=[InviteGrant(user=testuser)], signups=[signup]))
+		db.session.add(Mail(uid=f'mail{index}', receivers=[f'mail{index}@example.com'], destinations=[f'user{index}@mail.example.com']))
+
+	def test_constant_query_count(self):
+		self.login_as('admin')
+		endpoints = ['user.index', 'group.index', 'role.index', 'invite.index', 'mail.index']
+		self.add_rows(0)
+		counts = {endpoint: self.count_queries(endpoint) for endpoint in endpoints}
+		for index in range(1, 6):
+			self.add_rows(index)
+		for endpoint in endpoints:
+			self.assertEqual(self.count_queries(endpoint), counts[endpoint], endpoint)
@@ -1,13 +1,15 @@
 import unittest
+import warnings
 from urllib.parse import urlparse, parse_qs
 
 import jwt
+import sqlalchemy
 from flask import url_for, session
 
 from uffd.database import db
 from uffd.password_hash import PlaintextPasswordHash
 from uffd.remailer import remailer
-from uffd.models import DeviceLoginConfirmation, Service, OAuth2Client, OAuth2DeviceLoginInitiation, RemailerMode, OAuth2Key, Session
+from uffd.models import DeviceLoginConfirmation, Service, OAuth2Client, OAuth2DeviceLoginInitiation, RemailerMode, OAuth2Key, Session, OAuth2Grant, OAuth2RedeemedCode, OAuth2LogoutURI
 
 from tests.utils import dump, UffdTestCase
 from tests.models.test_oauth2 import TEST_JWK
@@ -60,13 +62,14 @@ class TestViews(UffdTestCase):
 		self.assert_authorization(r, mail=remailer.build_v1_address(service.id, self.get_user().id))
 
 	def test_authorization_client_secret_rehash(self):
-		OAuth2Client.query.delete()
-		db.session.add(OAuth2Client(service=Service(name='rehash_test', limit_access=False), client_id='test', client_secret=PlaintextPasswordHash.from_password('testsecret'), redirect_uris=['http://localhost:5009/callback', 'http://localhost:5009/callback2']))
-		db.session.commit()
-		self.assertIsInstance(OAuth2Client.query.filter_by(client_id='test').one().client_secret, PlaintextPasswordHash)
-		self.login_as('user')
-		r = self.client.get(path=url_for('oauth2.authorize', response_type='code', client_id='test', state='teststate', redirect_uri='http://localhost:5009/callback', scope='profile'), follow_redirects=False)
-		self.assert_authorization(r)
+		with warnings.catch_warnings():
+			warnings.simplefilter('error', sqlalchemy.exc.SAWarning)
+			OAuth2Client.query.filter_by(client_id='test').one().client_secret = PlaintextPasswordHash.from_password('testsecret')
+			db.session.commit()
+			self.assertIsInstance(OAuth2Client.query.filter_by(client_id='test').one().client_secret, PlaintextPasswordHash)
+			self.login_as('user')
+			r = self.client.get(path=url_for('oauth2.authorize', response_type='code', client_id='test', state='teststate', redirect_uri='http://localhost:5009/callback', scope='profile'), follow_redirects=False)
+			self.assert_authorization(r)
 		oauth2_client = OAuth2Client.query.filter_by(client_id='test').one()
 		self.assertIsInstance(oauth2_client.client_secret, OAuth2Client.client_secret.method_cls)
 		self.assertTrue(oauth2_client.client_secret.verify('testsecret'))
@@ -266,6 +269,102 @@ class TestViews(UffdTestCase):
 		r = self.client.get(path=url_for('oauth2.userinfo'), headers=[('Authorization', 'Bearer %s'%token)], follow_redirects=True)
 		self.assertEqual(r.status_code, 401)
 
+	def test_logout(self):
+		client = OAuth2Client.query.filter_by(client_id='test1').one()
+		client.logout_uris.append(OAuth2LogoutURI(method='GET', uri='http://localhost:5008/logout'))
+		db.session.commit()
+		# url_for would inject client_ids of the test request context's session
+		url = url_for('oauth2.logout', client_ids='test,test1')
+		invalid_url = url_for('oauth2.logout', client_ids='test,unknown')
+		self.login_as('user')
+		r = self.client.get(path=url, follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertIn(b'http://localhost:5008/logout', r.data)
+		self.assertIn(b'test1', r.data)
+		r = self.client.get(path=invalid_url, follow_redirects=True)
+		self.assertEqual(r.status_code, 404)
+
+class TestViewsStatelessCodes(TestViews):
+	def setUpApp(self):
+		self.app.config['OAUTH2_STATELESS_CODES'] = True
+
+	def test_code_not_stored(self):
+		code = self.get_auth_code()
+		self.assertTrue(code.startswith('s.'))
+		self.assertEqual(OAuth2Grant.query.count(), 0)
+		r = self.client.post(path=url_for('oauth2.token'),
+			data={'grant_type': 'authorization_code', 'code': code, 'redirect_uri': 'http://localhost:5009/callback', 'client_id': 'test', 'client_secret': 'testsecret'}, follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(OAuth2RedeemedCode.query.count(), 1)
+
+class TestViewsJWTAccessTokens(TestViews):
+	def setUpApp(self):
+		self.app.config['OAUTH2_JWT_ACCESS_TOKENS'] = True
+
+	def setUpDB(self):
+		super().setUpDB()
+		db.session.add(OAuth2Key(**TEST_JWK))
+
+	def get_access_token(self):
+		r = self.client.post(path=url_for('oauth2.token'),
+			data={'grant_type': 'authorization_code', 'code': self.get_auth_code(), 'redirect_uri': 'http://localhost:5009/callback', 'client_id': 'test', 'client_secret': 'testsecret'}, follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		return r.json['access_token']
+
+	def get_userinfo(self, token):
+		return self.client.get(path=url_for('oauth2.userinfo'), headers=[('Authorization', 'Bearer %s'%token)], follow_redirects=True)
+
+	def test_jwt_access_token(self):
+		token = self.get_access_token()
+		self.assertEqual(jwt.get_unverified_header(token)['typ'], 'at+jwt')
+		payload = OAuth2Key.decode_jwt(token, audience='test')
+		user = self.get_user()
+		self.assertEqual(payload['iss'], 'http://localhost')
+		self.assertEqual(payload['sub'], str(user.unix_uid))
+		self.assertEqual(payload['client_id'], 'test')
+		self.assertEqual(payload['scope'], 'profile')
+		self.assertEqual(payload['nickname'], user.loginname)
+		self.assertEqual(payload['email'], user.primary_email.address)
+		self.assertLessEqual(payload['exp'], payload['iat'] + 3600)
+		self.assertIn('jti', payload)
+
+	def test_userinfo_without_token_lookup(self):
+		token = self.get_access_token()
+		statements = []
+		def count_statement(*args): # pylint: disable=unused-argument
+			statements.append(args)
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+		try:
+			r = self.app.test_client().get(path=url_for('oauth2.userinfo'), headers=[('Authorization', 'Bearer %s'%token)])
+		finally:
+			sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json['nickname'], 'testuser')
+		# Only the generation counters of OAuth2KeyRing and access tokens
+		self.assertEqual(len(statements), 2)
+		for statement in statements:
+			self.assertIn('FROM generation_counter', statement[2])
+
+	def test_userinfo_user_changed(self):
+		token = self.get_access_token()
+		self.get_user().displayname = 'New Name'
+		db.session.commit()
+		r = self.get_userinfo(token)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json['name'], 'New Name')
+
+	def test_userinfo_session_revoked(self):
+		token = self.get_access_token()
+		self.assertEqual(self.get_userinfo(token).status_code, 200)
+		db.session.delete(Session.query.filter_by(user=self.get_user()).one())
+		db.session.commit()
+		self.assertEqual(self.get_userinfo(token).status_code, 401)
+
+	def test_userinfo_wrong_token_type(self):
+		token = self.get_access_token()
+		payload = OAuth2Key.decode_jwt(token, audience='test')
+		self.assertEqual(self.get_userinfo(OAuth2Key.get_preferred_key().encode_jwt(payload)).status_code, 401)
+
 class TestOIDCConfigurationProfile(UffdTestCase):
 	def setUpDB(self):
 		db.session.add(OAuth2Key(**TEST_JWK))
@@ -572,6 +671,27 @@ class TestOIDCBasicProfile(UffdTestCase):
 		self.validate_userinfo_response(r)
 		self.assertEqual(r.json['sub'], '10000')
 
+	def test_id_token_signing_algorithms(self):
+		db.session.add(OAuth2Key.generate_ec_key())
+		if 'EdDSA' in OAuth2Key.ALGORITHMS:
+			db.session.add(OAuth2Key.generate_ed25519_key())
+		db.session.commit()
+		r = self.client.get(path='/.well-known/openid-configuration')
+		self.assertEqual(r.json['id_token_signing_alg_values_supported'], OAuth2Key.ALGORITHMS)
+		r = self.client.get(path=url_for('oauth2.keys'))
+		self.assertEqual(sorted(key['alg'] for key in r.json['keys']), sorted(OAuth2Key.ALGORITHMS))
+		self.login_as('user')
+		for algorithm in OAuth2Key.ALGORITHMS:
+			OAuth2Client.query.filter_by(client_id='test').one().id_token_signed_response_alg = algorithm
+			db.session.commit()
+			r = self.do_auth_request(response_type='code')
+			args = self.validate_auth_response(r)
+			r = self.do_token_request(grant_type='authorization_code', code=args['code'])
+			id_token = self.validate_token_response(r)
+			self.assertEqual(jwt.get_unverified_header(r.json['id_token'])['alg'], algorithm)
+			key = OAuth2Key.get_preferred_key(algorithm)
+			self.assertEqual(id_token['at_hash'], key.oidc_hash(r.json['access_token'].encode('ascii')))
+
 	def test_notloggedin(self):
 		r = self.do_auth_request(response_type='code')
 		r = self.do_login(r)
@@ -942,3 +1062,11 @@ class TestOIDCBasicProfile(UffdTestCase):
 		self.assert_token_error(r2, 'invalid_grant')
 		r = self.do_userinfo_request(r1.json['access_token'])
 		self.assert_userinfo_error(r)
+
+class TestOIDCBasicProfileStatelessCodes(TestOIDCBasicProfile):
+	def setUpApp(self):
+		self.app.config['OAUTH2_STATELESS_CODES'] = True
+
+class TestOIDCBasicProfileJWTAccessTokens(TestOIDCBasicProfile):
+	def setUpApp(self):
+		self.app.config['OAUTH2_JWT_ACCESS_TOKENS'] = True
@@ -1,7 +1,7 @@
 from flask import url_for
 
 from uffd.database import db
-from uffd.models import Service, ServiceUser, OAuth2Client, APIClient, RemailerMode
+from uffd.models import Service, ServiceUser, OAuth2Client, OAuth2Key, APIClient, RemailerMode
 from tests.utils import dump, UffdTestCase
 
 class TestServices(UffdTestCase):
@@ -347,3 +347,39 @@ class TestServiceAdminViews(UffdTestCase):
 		dump('service_delete', r)
 		self.assertEqual(r.status_code, 200)
 		self.assertIsNone(Service.query.get(self.service_id))
+
+	def test_oauth2_show(self):
+		self.login_as('admin')
+		client = OAuth2Client.query.filter_by(client_id='test1_oauth2_client1').one()
+		r = self.client.get(path=url_for('service.oauth2_show', service_id=self.service_id, db_id=client.db_id), follow_redirects=True)
+		dump('service_oauth2_show', r)
+		self.assertEqual(r.status_code, 200)
+
+	def test_oauth2_edit_id_token_signed_response_alg(self):
+		self.login_as('admin')
+		db_id = OAuth2Client.query.filter_by(client_id='test1_oauth2_client1').one().db_id
+		data = {'client_id': 'test1_oauth2_client1', 'client_secret': '', 'redirect_uris': 'https://service/callback', 'logout_uris': ''}
+		# No active ES256 key
+		r = self.client.post(path=url_for('service.oauth2_submit', service_id=self.service_id, db_id=db_id),
+			data=dict(data, id_token_signed_response_alg='ES256'), follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		db.session.add(OAuth2Key.generate_ec_key())
+		db.session.commit()
+		r = self.client.post(path=url_for('service.oauth2_submit', service_id=self.service_id, db_id=db_id),
+			data=dict(data, id_token_signed_response_alg='ES256'), follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(OAuth2Client.query.get(db_id).id_token_signed_response_alg, 'ES256')
+		# Keeping the algorithm after the key was deactivated is allowed
+		OAuth2Key.query.filter_by(algorithm='ES256').one().active = False
+		db.session.commit()
+		r = self.client.post(path=url_for('service.oauth2_submit', service_id=self.service_id, db_id=db_id),
+			data=dict(data, id_token_signed_response_alg='ES256', redirect_uris='https://service/callback2'), follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(OAuth2Client.query.get(db_id).redirect_uris, ['https://service/callback2'])
+		r = self.client.post(path=url_for('service.oauth2_submit', service_id=self.service_id, db_id=db_id),
+			data=dict(data, id_token_signed_response_alg='HS256'), follow_redirects=True)
+		self.assertEqual(r.status_code, 400)
+		r = self.client.post(path=url_for('service.oauth2_submit', service_id=self.service_id, db_id=db_id),
+			data=dict(data, id_token_signed_response_alg=''), follow_redirects=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertIsNone(OAuth2Client.query.get(db_id).id_token_signed_response_alg)
@@ -1,12 +1,14 @@
 import time
+import datetime
 import unittest
 
 from flask import url_for, request
 
 from uffd.database import db
 from uffd.password_hash import PlaintextPasswordHash
-from uffd.models import DeviceLoginConfirmation, Service, OAuth2Client, OAuth2DeviceLoginInitiation, User, RecoveryCodeMethod, TOTPMethod
+from uffd.models import DeviceLoginConfirmation, Service, OAuth2Client, OAuth2DeviceLoginInitiation, User, RecoveryCodeMethod, TOTPMethod, Session, Role, RoleGroup
 from uffd.models.mfa import _hotp
+from uffd.models.session import SessionActivityWriter
 from uffd.views.session import login_required
 
 from tests.utils import dump, UffdTestCase, db_flush
@@ -149,6 +151,73 @@ class TestSession(UffdTestCase):
 		self.assertEqual(r.status_code, 200)
 		self.assertLoggedOut()
 
+	def test_session_cache(self):
+		self.login()
+		self.assertLoggedIn()
+		# Changes that bypass the ORM are not noticed, so the cache is used
+		db.session.execute(db.update(Session.__table__).values(secret='{plain}invalid'))
+		db.session.commit()
+		self.assertLoggedIn()
+		db.session.delete(Session.query.one())
+		db.session.commit()
+		self.assertLoggedOut()
+
+	def test_session_cache_role_groups(self):
+		role = Role(name='access', members=[self.get_user()])
+		role.groups[self.get_access_group()] = RoleGroup()
+		db.session.add(role)
+		db.session.commit()
+		self.login()
+		self.assertLoggedIn()
+		# Group memberships granted by roles are updated with Core statements
+		role = Role.query.filter_by(name='access').one()
+		del role.groups[self.get_access_group()]
+		role.update_member_groups()
+		db.session.commit()
+		self.assertFalse(self.get_user().is_in_group('uffd_access'))
+		self.assertLoggedOut()
+
+	def test_session_cache_disabled(self):
+		self.app.config['SESSION_CACHE_TTL_SECONDS'] = 0
+		self.login()
+		self.assertLoggedIn()
+		db.session.execute(db.update(Session.__table__).values(secret='{plain}invalid'))
+		db.session.commit()
+		self.assertLoggedOut()
+
+	def backdate_session(self):
+		db.session.execute(db.update(Session.__table__).values(
+			last_used=datetime.datetime.utcnow() - datetime.timedelta(seconds=120),
+			ip_address='192.0.2.1',
+		))
+		db.session.commit()
+
+	def test_session_activity(self):
+		self.app.config['SESSION_LIFETIME_SECONDS'] = 3600
+		self.app.config['SESSION_CACHE_TTL_SECONDS'] = 0
+		self.app.config['SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS'] = 3600
+		self.login()
+		self.backdate_session()
+		self.assertLoggedIn()
+		db.session.expire_all()
+		self.assertEqual(Session.query.one().ip_address, '192.0.2.1')
+		self.assertLoggedIn()
+		SessionActivityWriter.get().flush()
+		db.session.expire_all()
+		_session = Session.query.one()
+		self.assertEqual(_session.ip_address, '127.0.0.1')
+		self.assertGreater(_session.last_used, datetime.datetime.utcnow() - datetime.timedelta(seconds=60))
+
+	def test_session_activity_unbuffered(self):
+		self.app.config['SESSION_LIFETIME_SECONDS'] = 3600
+		self.app.config['SESSION_CACHE_TTL_SECONDS'] = 0
+		self.app.config['SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS'] = 0
+		self.login()
+		self.backdate_session()
+		self.assertLoggedIn()
+		db.session.expire_all()
+		self.assertEqual(Session.query.one().ip_address, '127.0.0.1')
+
 	def test_timeout(self):
 		self.login()
 		time.sleep(3)
@@ -0,0 +1,92 @@
+import collections
+import itertools
+import threading
+import time
+
+from flask import current_app
+
+from uffd.database import db
+
+class LRUCache:
+	'''Thread-safe, size-bounded in-process cache with optional expiry
+
+	Caches are local to the current process. Code using them must make sure
+	that stale entries are not served after changes made by other processes,
+	either by including a GenerationCounter value in the key or cached value,
+	or by setting a ttl short enough for staleness to be acceptable.
+
+	Entries are stored per Flask app, so apps (e.g. in tests) do not share
+	entries even if they use the same LRUCache object. Call discard to free
+	the entries of an LRUCache object that is no longer used.'''
+
+	# Unlike id(), tokens are never reused for new objects
+	tokens = itertools.count()
+
+	def __init__(self, maxsize=1024, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.token = next(self.tokens)
+
+	@property
+	def entries(self):
+		caches = current_app.extensions.setdefault('uffd_lru_caches', {})
+		return caches.setdefault(self.token, collections.OrderedDict())
+
+	def get(self, key, default=None):
+		entries = self.entries
+		with self.lock:
+			if key not in entries:
+				return default
+			expires, value = entries[key]
+			if expires is not None and expires < time.monotonic():
+				del entries[key]
+				return default
+			entries.move_to_end(key)
+			return value
+
+	def set(self, key, value, ttl=None):
+		ttl = self.ttl if ttl is None else ttl
+		expires = time.monotonic() + ttl if ttl is not None else None
+		entries = self.entries
+		with self.lock:
+			entries[key] = (expires, value)
+			entries.move_to_end(key)
+			while len(entries) > self.maxsize:
+				entries.popitem(last=False)
+
+	def pop(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def discard(self):
+		'''Remove the entries of the current app from memory'''
+		with self.lock:
+			current_app.extensions.get('uffd_lru_caches', {}).pop(self.token, None)
+
+	def clear_on_commit(self, *models):
+		'''Clear cache when a transaction that changed any objects of models is committed
+
+		Only affects the current process. Changes made with Core statements
+		(e.g. Query.delete) are not noticed.'''
+		info_key = f'lru_cache_{self.token}_changed'
+
+		@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+		def check_changes(session, flush_context): # pylint: disable=unused-argument
+			for obj in itertools.chain(session.new, session.dirty, session.deleted):
+				if isinstance(obj, models):
+					session.info[info_key] = True
+					return
+
+		@db.event.listens_for(db.Session, 'after_commit') # pylint: disable=no-member
+		def invalidate(session):
+			if session.info.pop(info_key, False):
+				self.clear()
+
+		@db.event.listens_for(db.Session, 'after_soft_rollback') # pylint: disable=no-member
+		def reset(session, previous_transaction): # pylint: disable=unused-argument
+			session.info.pop(info_key, None)
@@ -5,6 +5,7 @@ from .profile import profile_command
 from .gendevcert import gendevcert_command
 from .cleanup import cleanup_command
 from .roles_update_all import roles_update_all_command
+from .group_updates import group_updates_command
 from .unique_email_addresses import unique_email_addresses_command
 
 def init_app(app):
@@ -15,4 +16,5 @@ def init_app(app):
 	app.cli.add_command(profile_command)
 	app.cli.add_command(cleanup_command)
 	app.cli.add_command(roles_update_all_command)
+	app.cli.add_command(group_updates_command)
 	app.cli.add_command(unique_email_addresses_command)
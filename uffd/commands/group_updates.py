@@ -0,0 +1,44 @@
+import sys
+import time
+
+from flask import current_app
+from flask.cli import AppGroup
+import click
+
+from uffd.database import db
+from uffd.models.role import process_group_updates, get_group_update_queue_length, wait_for_group_updates
+
+group_updates_command = AppGroup('group-updates', help='Manage queued group membership updates caused by role changes')
+
+@group_updates_command.command(help='Show number of users with pending group updates')
+def status():
+	with current_app.test_request_context():
+		click.echo(f'Pending group updates: {get_group_update_queue_length()}')
+
+@group_updates_command.command(help='Process all pending group updates and exit')
+@click.option('--batch-size', type=click.IntRange(min=1), default=500, help='Number of users processed per transaction.')
+def process(batch_size):
+	with current_app.test_request_context():
+		count = process_group_updates(batch_size=batch_size)
+		click.echo(f'Processed group updates: {count}')
+
+@group_updates_command.command(help='Process pending group updates continuously (for GROUP_UPDATE_WORKER="external")')
+@click.option('--batch-size', type=click.IntRange(min=1), default=500, help='Number of users processed per transaction.')
+@click.option('--interval', type=click.FloatRange(min=0), default=5, help='Seconds to wait between checking the queue.')
+def worker(batch_size, interval):
+	with current_app.test_request_context():
+		while True:
+			try:
+				process_group_updates(batch_size=batch_size)
+			except Exception: # pylint: disable=broad-except
+				db.session.rollback()
+				current_app.logger.exception('Processing group updates failed')
+			time.sleep(interval)
+
+@group_updates_command.command(help='Wait until all pending group updates are processed')
+@click.option('--timeout', type=click.FloatRange(min=0), default=None, help='Exit with an error after this many seconds.')
+def wait(timeout):
+	with current_app.test_request_context():
+		if not wait_for_group_updates(timeout=timeout):
+			click.echo(f'Timeout: {get_group_update_queue_length()} group updates are still pending')
+			sys.exit(1)
@@ -5,11 +5,17 @@ import click
 
 from uffd.database import db
 from uffd.models import Group, Role, RoleGroup
+from uffd.models.role import enqueue_group_updates, process_group_updates
 
 role_command = AppGroup('role', help='Manage roles')
 
 # pylint: disable=too-many-arguments,too-many-locals
 
+def process_queued_group_updates():
+	# The worker thread would be killed when the command exits
+	if current_app.config['GROUP_UPDATE_WORKER'] == 'thread':
+		process_group_updates()
+
 def update_attrs(role, description=None, default=None,
                  moderator_group=None, clear_moderator_group=False,
                  clear_groups=False, add_group=tuple(), remove_group=tuple(),
@@ -89,6 +95,7 @@ def create(name, description, default, moderator_group, add_group, add_role):
 			db.session.add(role)
 			role.update_member_groups()
 			db.session.commit()
+			process_queued_group_updates()
 		except IntegrityError:
 			# pylint: disable=raise-missing-from
 			raise click.ClickException(f'A role with name "{name}" already exists')
@@ -111,14 +118,13 @@ def update(name, description, default, moderator_group, no_moderator_group,
 		role = Role.query.filter_by(name=name).one_or_none()
 		if role is None:
 			raise click.ClickException(f'Role {name} not found')
-		old_members = set(role.members_effective)
+		enqueue_group_updates(role.get_members_effective_filter())
 		update_attrs(role, description, default, moderator_group,
 		             no_moderator_group, clear_groups, add_group, remove_group,
 		             clear_roles, add_role, remove_role)
-		for user in old_members:
-			user.update_groups()
 		role.update_member_groups()
 		db.session.commit()
+		process_queued_group_updates()
 
 @role_command.command(help='Delete role')
 @click.argument('name')
@@ -127,8 +133,7 @@ def delete(name):
 		role = Role.query.filter_by(name=name).one_or_none()
 		if role is None:
 			raise click.ClickException(f'Role {name} not found')
-		old_members = set(role.members_effective)
+		enqueue_group_updates(role.get_members_effective_filter())
 		db.session.delete(role)
-		for user in old_members:
-			user.update_groups()
 		db.session.commit()
+		process_queued_group_updates()
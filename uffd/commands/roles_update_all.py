@@ -1,29 +1,44 @@
 import sys
+import concurrent.futures
 
 from flask import current_app
 from flask.cli import with_appcontext
 import click
 
 from uffd.database import db
-from uffd.models import User
+from uffd.models import User, Group
+from uffd.models.role import compute_all_user_group_changes, apply_user_group_changes
+
+def compute_partition_changes(app, jobs, partition):
+	with app.app_context():
+		try:
+			return list(compute_all_user_group_changes(user_filter=(User.id % jobs == partition)))
+		finally:
+			db.session.remove()
 
 @click.command('roles-update-all', help='Update group memberships for all users based on their roles')
 @click.option('--check-only', is_flag=True)
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help='Number of threads used to compute changes (each uses its own database connection)')
 @with_appcontext
-def roles_update_all_command(check_only): #pylint: disable=unused-variable
-	consistent = True
+def roles_update_all_command(check_only, jobs): #pylint: disable=unused-variable
 	with current_app.test_request_context():
-		for user in User.query.all():
-			groups_added, groups_removed = user.update_groups()
-			if groups_added:
-				consistent = False
-				print('Adding groups [%s] to user %s'%(', '.join([group.name for group in groups_added]), user.loginname))
-			if groups_removed:
-				consistent = False
-				print('Removing groups [%s] from user %s'%(', '.join([group.name for group in groups_removed]), user.loginname))
+		if jobs == 1:
+			changes = list(compute_all_user_group_changes())
+		else:
+			app = current_app._get_current_object() # pylint: disable=protected-access
+			with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+				partitions = executor.map(lambda partition: compute_partition_changes(app, jobs, partition), range(jobs))
+				changes = sorted([change for partition in partitions for change in partition], key=lambda change: change.user_id)
+		group_names = dict(db.session.execute(db.select([Group.id, Group.name])).fetchall())
+		for change in changes:
+			if change.group_ids_added:
+				print('Adding groups [%s] to user %s'%(', '.join(sorted(group_names[group_id] for group_id in change.group_ids_added)), change.loginname))
+			if change.group_ids_removed:
+				print('Removing groups [%s] from user %s'%(', '.join(sorted(group_names[group_id] for group_id in change.group_ids_removed)), change.loginname))
 		if not check_only:
+			apply_user_group_changes(changes)
 			db.session.commit()
-		if check_only and not consistent:
+		if check_only and changes:
 			print('No changes were made because --check-only is set')
 			print()
 			print('Error: Groups are not consistent with roles in database')
@@ -0,0 +1,25 @@
+"""Generation counters
+
+Revision ID: 5089c9730a9f
+Revises: e71e29cc605a
+Create Date: 2026-10-18 09:12:41.204519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '5089c9730a9f'
+down_revision = 'e71e29cc605a'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	generation_counter_table = op.create_table('generation_counter',
+		sa.Column('name', sa.String(length=32), nullable=False),
+		sa.Column('value', sa.Integer(), nullable=False),
+		sa.PrimaryKeyConstraint('name', name=op.f('pk_generation_counter'))
+	)
+	op.execute(sa.insert(generation_counter_table).values(name='directory', value=0))
+
+def downgrade():
+	op.drop_table('generation_counter')
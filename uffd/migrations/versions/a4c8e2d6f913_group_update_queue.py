@@ -0,0 +1,31 @@
+"""Queue for group membership updates
+
+Revision ID: a4c8e2d6f913
+Revises: d1f7a6b0c2e4
+Create Date: 2026-10-18 16:42:13.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'a4c8e2d6f913'
+down_revision = 'd1f7a6b0c2e4'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	op.create_table('pending_group_update',
+		sa.Column('user_id', sa.Integer(), nullable=False),
+		sa.Column('version', sa.Integer(), nullable=False),
+		sa.ForeignKeyConstraint(['user_id'], ['user.id'], name=op.f('fk_pending_group_update_user_id_user'), onupdate='CASCADE', ondelete='CASCADE'),
+		sa.PrimaryKeyConstraint('user_id', name=op.f('pk_pending_group_update'))
+	)
+	conn = op.get_bind()
+	lock_table = sa.table('lock', sa.column('name'))
+	conn.execute(sa.insert(lock_table).values(name='pending_group_update'))
+
+def downgrade():
+	conn = op.get_bind()
+	lock_table = sa.table('lock', sa.column('name'))
+	conn.execute(sa.delete(lock_table).where(lock_table.c.name == 'pending_group_update'))
+	op.drop_table('pending_group_update')
@@ -0,0 +1,34 @@
+"""API changelog
+
+Revision ID: b3a4f2c1d9e7
+Revises: 5089c9730a9f
+Create Date: 2026-10-18 11:03:27.518342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'b3a4f2c1d9e7'
+down_revision = '5089c9730a9f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	op.create_table('changelog',
+		sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+		sa.Column('created', sa.DateTime(), nullable=False),
+		sa.Column('object_type', sa.Enum('USER', 'GROUP', 'MAIL', create_constraint=True, name='changelogobjecttype'), nullable=False),
+		sa.Column('object_id', sa.Integer(), nullable=False),
+		sa.Column('action', sa.Enum('CREATED', 'UPDATED', 'DELETED', create_constraint=True, name='changelogaction'), nullable=False),
+		sa.Column('object_key', sa.String(length=128), nullable=True),
+		sa.PrimaryKeyConstraint('id', name=op.f('pk_changelog'))
+	)
+	conn = op.get_bind()
+	lock_table = sa.table('lock', sa.column('name'))
+	conn.execute(sa.insert(lock_table).values(name='changelog'))
+
+def downgrade():
+	conn = op.get_bind()
+	lock_table = sa.table('lock', sa.column('name'))
+	conn.execute(sa.delete(lock_table).where(lock_table.c.name == 'changelog'))
+	op.drop_table('changelog')
@@ -0,0 +1,22 @@
+"""Generation counter for OAuth2 tokens
+
+Revision ID: b7d3f9a1c6e4
+Revises: f4a2d8c6e0b1
+Create Date: 2026-10-18 22:24:11.093417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'b7d3f9a1c6e4'
+down_revision = 'f4a2d8c6e0b1'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.insert(generation_counter_table).values(name='oauth2_tokens', value=0))
+
+def downgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.delete(generation_counter_table).where(generation_counter_table.c.name == 'oauth2_tokens'))
@@ -0,0 +1,22 @@
+"""Generation counter for OAuth2 keys
+
+Revision ID: c5e1b7f3a2d8
+Revises: a4c8e2d6f913
+Create Date: 2026-10-18 19:05:37.718204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'c5e1b7f3a2d8'
+down_revision = 'a4c8e2d6f913'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.insert(generation_counter_table).values(name='oauth2_keys', value=0))
+
+def downgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.delete(generation_counter_table).where(generation_counter_table.c.name == 'oauth2_keys'))
@@ -0,0 +1,20 @@
+"""Composite index for ratelimit events
+
+Revision ID: d1f7a6b0c2e4
+Revises: b3a4f2c1d9e7
+Create Date: 2026-10-18 14:21:09.638150
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'd1f7a6b0c2e4'
+down_revision = 'b3a4f2c1d9e7'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	op.create_index('ix_ratelimit_event_name_key_expires', 'ratelimit_event', ['name', 'key', 'expires', 'timestamp'], unique=False)
+
+def downgrade():
+	op.drop_index('ix_ratelimit_event_name_key_expires', table_name='ratelimit_event')
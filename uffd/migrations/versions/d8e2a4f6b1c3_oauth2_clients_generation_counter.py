@@ -0,0 +1,22 @@
+"""Generation counter for OAuth2 clients
+
+Revision ID: d8e2a4f6b1c3
+Revises: b7d3f9a1c6e4
+Create Date: 2026-10-18 23:02:45.618204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'd8e2a4f6b1c3'
+down_revision = 'b7d3f9a1c6e4'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.insert(generation_counter_table).values(name='oauth2_clients', value=0))
+
+def downgrade():
+	generation_counter_table = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(sa.delete(generation_counter_table).where(generation_counter_table.c.name == 'oauth2_clients'))
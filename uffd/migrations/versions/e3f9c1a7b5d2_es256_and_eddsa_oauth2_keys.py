@@ -0,0 +1,112 @@
+"""ES256 and EdDSA keys for OpenID Connect
+
+Revision ID: e3f9c1a7b5d2
+Revises: c5e1b7f3a2d8
+Create Date: 2026-10-18 20:31:08.552361
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import base64
+import datetime
+import json
+import secrets
+import math
+import logging
+
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.backends import default_backend # Only required for Buster
+import jwt
+
+# pyjwt v1.7.x compat (Buster/Bullseye)
+if not hasattr(jwt, 'get_algorithm_by_name'):
+	jwt.get_algorithm_by_name = lambda name: jwt.algorithms.get_default_algorithms()[name]
+
+revision = 'e3f9c1a7b5d2'
+down_revision = 'c5e1b7f3a2d8'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration.e3f9c1a7b5d2')
+
+def token_with_alphabet(alphabet, nbytes=None):
+	'''Return random text token that consists of characters from `alphabet`'''
+	if nbytes is None:
+		nbytes = max(secrets.DEFAULT_ENTROPY, 32)
+	nbytes_per_char = math.log(len(alphabet), 256)
+	nchars = math.ceil(nbytes / nbytes_per_char)
+	return ''.join([secrets.choice(alphabet) for _ in range(nchars)])
+
+def token_urlfriendly(nbytes=None):
+	'''Return random text token that is urlsafe and works around common parsing bugs'''
+	alphabet = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+	return token_with_alphabet(alphabet, nbytes=nbytes)
+
+def ec_key_to_jwk(key, public_only=False):
+	# pyjwt does not pad EC values to the length required by RFC7518
+	def encode(value):
+		return base64.urlsafe_b64encode(value.to_bytes(32, 'big')).decode('ascii').rstrip('=')
+	public_numbers = key.public_key().public_numbers()
+	res = {'kty': 'EC', 'crv': 'P-256', 'x': encode(public_numbers.x), 'y': encode(public_numbers.y)}
+	if not public_only:
+		res['d'] = encode(key.private_numbers().private_value)
+	return json.dumps(res)
+
+def upgrade():
+	with op.batch_alter_table('oauth2client', schema=None) as batch_op:
+		batch_op.add_column(sa.Column('id_token_signed_response_alg', sa.String(length=32), nullable=True))
+
+	logger.info('Generating ECDSA P-256 (ES256) key pair for OpenID Connect support ...')
+	ec_private_key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+	keys = [{
+		'id': token_urlfriendly(),
+		'created': datetime.datetime.utcnow(),
+		'active': True,
+		'algorithm': 'ES256',
+		'private_key_jwk': ec_key_to_jwk(ec_private_key),
+		'public_key_jwk': ec_key_to_jwk(ec_private_key, public_only=True),
+	}]
+	# EdDSA requires pyjwt v2 (not available on Buster/Bullseye), so EdDSA is
+	# not offered and no key is generated with older versions.
+	if 'EdDSA' in jwt.algorithms.get_default_algorithms():
+		logger.info('Generating Ed25519 (EdDSA) key pair for OpenID Connect support ...')
+		ed25519_private_key = ed25519.Ed25519PrivateKey.generate()
+		eddsa_algorithm = jwt.get_algorithm_by_name('EdDSA')
+		keys.append({
+			'id': token_urlfriendly(),
+			'created': datetime.datetime.utcnow(),
+			'active': True,
+			'algorithm': 'EdDSA',
+			'private_key_jwk': eddsa_algorithm.to_jwk(ed25519_private_key),
+			'public_key_jwk': eddsa_algorithm.to_jwk(ed25519_private_key.public_key()),
+		})
+	else:
+		logger.info('Skipping Ed25519 (EdDSA) key pair, not supported by the installed pyjwt version')
+	oauth2_key = sa.table('oauth2_key',
+		sa.column('id'), sa.column('created'), sa.column('active'),
+		sa.column('algorithm'), sa.column('private_key_jwk'), sa.column('public_key_jwk'),
+	)
+	op.bulk_insert(oauth2_key, keys)
+	generation_counter = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(generation_counter.update().where(generation_counter.c.name == 'oauth2_keys').values(value=generation_counter.c.value + 1))
+
+def downgrade():
+	meta = sa.MetaData(bind=op.get_bind())
+	oauth2_key = sa.table('oauth2_key', sa.column('algorithm'))
+	op.execute(oauth2_key.delete().where(oauth2_key.c.algorithm.in_(['ES256', 'EdDSA'])))
+	generation_counter = sa.table('generation_counter', sa.column('name'), sa.column('value'))
+	op.execute(generation_counter.update().where(generation_counter.c.name == 'oauth2_keys').values(value=generation_counter.c.value + 1))
+
+	oauth2client = sa.Table('oauth2client', meta,
+		sa.Column('db_id', sa.Integer(), autoincrement=True, nullable=False),
+		sa.Column('service_id', sa.Integer(), nullable=False),
+		sa.Column('client_id', sa.String(length=40), nullable=False),
+		sa.Column('client_secret', sa.Text(), nullable=False),
+		sa.Column('id_token_signed_response_alg', sa.String(length=32), nullable=True),
+		sa.ForeignKeyConstraint(['service_id'], ['service.id'], name=op.f('fk_oauth2client_service_id_service'), onupdate='CASCADE', ondelete='CASCADE'),
+		sa.PrimaryKeyConstraint('db_id', name=op.f('pk_oauth2client')),
+		sa.UniqueConstraint('client_id', name=op.f('uq_oauth2client_client_id'))
+	)
+	with op.batch_alter_table('oauth2client', copy_from=oauth2client) as batch_op:
+		batch_op.drop_column('id_token_signed_response_alg')
@@ -0,0 +1,28 @@
+"""Redeemed stateless OAuth2 authorization codes
+
+Revision ID: f4a2d8c6e0b1
+Revises: e3f9c1a7b5d2
+Create Date: 2026-10-18 21:47:52.309126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'f4a2d8c6e0b1'
+down_revision = 'e3f9c1a7b5d2'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+	op.create_table('oauth2_redeemed_code',
+		sa.Column('id', sa.String(length=64), nullable=False),
+		sa.Column('expires', sa.DateTime(), nullable=False),
+		sa.PrimaryKeyConstraint('id', name=op.f('pk_oauth2_redeemed_code'))
+	)
+	with op.batch_alter_table('oauth2_redeemed_code', schema=None) as batch_op:
+		batch_op.create_index(batch_op.f('ix_oauth2_redeemed_code_expires'), ['expires'], unique=False)
+
+def downgrade():
+	with op.batch_alter_table('oauth2_redeemed_code', schema=None) as batch_op:
+		batch_op.drop_index(batch_op.f('ix_oauth2_redeemed_code_expires'))
+	op.drop_table('oauth2_redeemed_code')
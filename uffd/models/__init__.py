@@ -2,28 +2,30 @@ from .api import APIClient
 from .invite import Invite, InviteGrant, InviteSignup
 from .mail import Mail, MailReceiveAddress, MailDestinationAddress
 from .mfa import MFAType, MFAMethod, RecoveryCodeMethod, TOTPMethod, WebauthnMethod
-from .oauth2 import OAuth2Client, OAuth2RedirectURI, OAuth2LogoutURI, OAuth2Grant, OAuth2Token, OAuth2DeviceLoginInitiation, OAuth2Key
-from .role import Role, RoleGroup, RoleGroupMap
+from .oauth2 import OAuth2Client, OAuth2RedirectURI, OAuth2LogoutURI, OAuth2Grant, OAuth2Token, OAuth2DeviceLoginInitiation, OAuth2Key, OAuth2RedeemedCode
+from .role import Role, RoleGroup, RoleGroupMap, PendingGroupUpdate
 from .selfservice import PasswordToken
 from .service import RemailerMode, Service, ServiceUser, get_services
 from .session import Session, DeviceLoginType, DeviceLoginInitiation, DeviceLoginConfirmation
 from .signup import Signup
 from .user import User, UserEmail, Group, IDAllocator, IDRangeExhaustedError, IDAlreadyAllocatedError
 from .ratelimit import RatelimitEvent, Ratelimit, HostRatelimit, host_ratelimit, format_delay
-from .misc import FeatureFlag, Lock
+from .misc import FeatureFlag, Lock, GenerationCounter
+from .changelog import ChangelogObjectType, ChangelogAction, ChangelogEntry
 
 __all__ = [
 	'APIClient',
 	'Invite', 'InviteGrant', 'InviteSignup',
 	'Mail', 'MailReceiveAddress', 'MailDestinationAddress',
 	'MFAType', 'MFAMethod', 'RecoveryCodeMethod', 'TOTPMethod', 'WebauthnMethod',
-	'OAuth2Client', 'OAuth2RedirectURI', 'OAuth2LogoutURI', 'OAuth2Grant', 'OAuth2Token', 'OAuth2DeviceLoginInitiation',
-	'Role', 'RoleGroup', 'RoleGroupMap',
+	'OAuth2Client', 'OAuth2RedirectURI', 'OAuth2LogoutURI', 'OAuth2Grant', 'OAuth2Token', 'OAuth2DeviceLoginInitiation', 'OAuth2RedeemedCode',
+	'Role', 'RoleGroup', 'RoleGroupMap', 'PendingGroupUpdate',
 	'PasswordToken',
 	'RemailerMode', 'Service', 'ServiceUser', 'get_services',
 	'DeviceLoginType', 'DeviceLoginInitiation', 'DeviceLoginConfirmation',
 	'Signup',
 	'User', 'UserEmail', 'Group', 'IDAllocator', 'IDRangeExhaustedError', 'IDAlreadyAllocatedError',
 	'RatelimitEvent', 'Ratelimit', 'HostRatelimit', 'host_ratelimit', 'format_delay',
-	'FeatureFlag', 'Lock',
+	'FeatureFlag', 'Lock', 'GenerationCounter',
+	'ChangelogObjectType', 'ChangelogAction', 'ChangelogEntry',
 ]
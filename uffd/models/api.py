@@ -26,3 +26,10 @@ class APIClient(db.Model):
 
 	def has_permission(self, name):
 		return getattr(self, 'perm_' + name)
+
+	@property
+	def permissions(self):
+		return frozenset(
+			column.key[len('perm_'):] for column in self.__table__.columns
+			if column.key.startswith('perm_') and getattr(self, column.key)
+		)
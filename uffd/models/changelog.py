@@ -0,0 +1,184 @@
+import datetime
+import enum
+import itertools
+
+from flask import current_app
+from sqlalchemy import Column, Integer, String, DateTime, Enum
+
+from uffd.database import db
+from uffd.tasks import cleanup_task
+from .user import User, UserEmail, Group
+from .service import Service, ServiceUser
+from .mail import Mail, MailReceiveAddress, MailDestinationAddress
+from .misc import Lock
+
+class ChangelogObjectType(enum.Enum):
+	USER = 0
+	GROUP = 1
+	MAIL = 2
+
+class ChangelogAction(enum.Enum):
+	CREATED = 0
+	UPDATED = 1
+	DELETED = 2
+
+class ChangelogEntry(db.Model):
+	'''Log of changes to data exposed via the API (users, groups and mails)
+
+	Entries are created automatically on flush. The id of the most recent
+	entry serves as a cursor for incremental synchronization with the
+	/api/v1/changes endpoint.'''
+	__tablename__ = 'changelog'
+	id = Column(Integer(), primary_key=True, autoincrement=True)
+	created = Column(DateTime(), default=datetime.datetime.utcnow, nullable=False)
+	object_type = Column(Enum(ChangelogObjectType, create_constraint=True), nullable=False)
+	object_id = Column(Integer(), nullable=False)
+	action = Column(Enum(ChangelogAction, create_constraint=True), nullable=False)
+	# API-visible identifier (unix_uid, unix_gid or mail name) of deleted
+	# objects, NULL for other actions
+	object_key = Column(String(128), nullable=True)
+
+	# Entries must be committed in the order of their ids. Otherwise a client
+	# might receive a cursor that skips entries of a transaction that is
+	# committed later.
+	lock = Lock('changelog')
+
+	@classmethod
+	def get_cursor(cls):
+		return db.session.execute(db.select([db.func.max(cls.id)])).scalar() or 0
+
+	@classmethod
+	def is_valid_cursor(cls, cursor):
+		'''Return True if no entries after `cursor` were deleted by cleanup'''
+		if cursor == 0:
+			# Cursor 0 is only returned while there are no entries at all
+			min_id = db.session.execute(db.select([db.func.min(cls.id)])).scalar()
+			return min_id is None or min_id <= cls.get_first_id()
+		return db.session.execute(db.select([db.exists().where(cls.id == cursor)])).scalar()
+
+	@staticmethod
+	def get_first_id():
+		'''Return the id that the database assigns to the first entry'''
+		if db.engine.name in ('mysql', 'mariadb'):
+			return db.session.execute(db.text('SELECT @@auto_increment_offset')).scalar()
+		return 1
+
+# Always keep the most recent entry, so that the current cursor stays valid
+@cleanup_task.handler
+def cleanup_changelog():
+	max_retention = datetime.timedelta(days=current_app.config['API_CHANGES_RETENTION_DAYS'])
+	ChangelogEntry.query.filter(
+		ChangelogEntry.created < datetime.datetime.utcnow() - max_retention,
+		ChangelogEntry.id != ChangelogEntry.get_cursor(),
+	).delete(synchronize_session=False)
+
+def attributes_changed(obj, *names):
+	state = db.inspect(obj)
+	return any(state.attrs[name].history.has_changes() for name in names)
+
+# Changes to service settings affect the API output for all users and groups.
+SERVICE_ATTRIBUTES = ('limit_access', 'access_group_id', 'remailer_mode', 'enable_email_preferences', 'hide_deactivated_users')
+
+# Attributes of users that affect the API output for their groups and vice versa
+USER_GROUP_ATTRIBUTES = ('loginname', 'is_deactivated', 'groups')
+GROUP_USER_ATTRIBUTES = ('name', 'members')
+
+@db.event.listens_for(db.Session, 'before_flush') # pylint: disable=no-member
+def load_deleted_changelog_keys(session, flush_context, instances): # pylint: disable=unused-argument
+	# Attributes of deleted objects cannot be loaded after the flush
+	for obj in session.deleted:
+		if isinstance(obj, User):
+			_ = obj.unix_uid, obj.groups
+		elif isinstance(obj, Group):
+			_ = obj.unix_gid, obj.members
+		elif isinstance(obj, Mail):
+			_ = obj.uid
+
+# pylint: disable=too-many-branches
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def log_changes(session, flush_context): # pylint: disable=unused-argument
+	# pylint completely fails to understand SQLAlchemy's query functions
+	# pylint: disable=no-member
+	changes = {}
+	def add(object_type, object_id, action=ChangelogAction.UPDATED, object_key=None):
+		if object_id is None:
+			return
+		key = (object_type, object_id)
+		if key in changes and changes[key][0] != ChangelogAction.UPDATED:
+			return
+		changes[key] = (action, object_key)
+
+	log_all = False
+	for obj in session.deleted:
+		if isinstance(obj, User):
+			add(ChangelogObjectType.USER, obj.id, ChangelogAction.DELETED, str(obj.unix_uid))
+			for group in obj.groups:
+				add(ChangelogObjectType.GROUP, group.id)
+		elif isinstance(obj, Group):
+			add(ChangelogObjectType.GROUP, obj.id, ChangelogAction.DELETED, str(obj.unix_gid))
+			for user in obj.members:
+				add(ChangelogObjectType.USER, user.id)
+		elif isinstance(obj, Mail):
+			add(ChangelogObjectType.MAIL, obj.id, ChangelogAction.DELETED, obj.uid)
+	for obj in session.new:
+		if isinstance(obj, User):
+			add(ChangelogObjectType.USER, obj.id, ChangelogAction.CREATED)
+			for group in obj.groups:
+				add(ChangelogObjectType.GROUP, group.id)
+		elif isinstance(obj, Group):
+			add(ChangelogObjectType.GROUP, obj.id, ChangelogAction.CREATED)
+		elif isinstance(obj, Mail):
+			add(ChangelogObjectType.MAIL, obj.id, ChangelogAction.CREATED)
+	for obj in itertools.chain(session.new, session.dirty, session.deleted):
+		if obj in session.dirty and not session.is_modified(obj):
+			continue
+		if isinstance(obj, User) and obj in session.dirty:
+			add(ChangelogObjectType.USER, obj.id)
+			if attributes_changed(obj, *USER_GROUP_ATTRIBUTES):
+				history = db.inspect(obj).attrs.groups.load_history()
+				for group in itertools.chain(history.added, history.unchanged, history.deleted):
+					add(ChangelogObjectType.GROUP, group.id)
+		elif isinstance(obj, Group) and obj in session.dirty:
+			add(ChangelogObjectType.GROUP, obj.id)
+			if attributes_changed(obj, *GROUP_USER_ATTRIBUTES):
+				history = db.inspect(obj).attrs.members.load_history()
+				for user in itertools.chain(history.added, history.unchanged, history.deleted):
+					add(ChangelogObjectType.USER, user.id)
+		elif isinstance(obj, (UserEmail, ServiceUser)):
+			add(ChangelogObjectType.USER, obj.user_id)
+		elif isinstance(obj, Mail) and obj in session.dirty:
+			add(ChangelogObjectType.MAIL, obj.id)
+		elif isinstance(obj, (MailReceiveAddress, MailDestinationAddress)):
+			add(ChangelogObjectType.MAIL, obj.mail_id)
+		elif isinstance(obj, Service) and obj in session.dirty and attributes_changed(obj, *SERVICE_ATTRIBUTES):
+			log_all = True
+	if not changes and not log_all:
+		return
+	ChangelogEntry.lock.acquire()
+	if changes:
+		db.session.execute(db.insert(ChangelogEntry), [
+			{'object_type': object_type, 'object_id': object_id, 'action': action, 'object_key': object_key}
+			for (object_type, object_id), (action, object_key) in changes.items()
+		])
+	if log_all:
+		for object_type, model in [(ChangelogObjectType.USER, User), (ChangelogObjectType.GROUP, Group)]:
+			db.session.execute(db.insert(ChangelogEntry).from_select(
+				['object_type', 'object_id', 'action'],
+				db.select([db.literal(object_type.name), model.id, db.literal(ChangelogAction.UPDATED.name)])
+			))
+
+def log_core_updates(user_ids=(), group_ids=()):
+	'''Log updates to users and groups made with Core statements
+
+	Such statements bypass the ORM, so log_changes does not notice them.'''
+	entries = [
+		{'object_type': ChangelogObjectType.USER, 'object_id': user_id, 'action': ChangelogAction.UPDATED}
+		for user_id in sorted(user_ids)
+	] + [
+		{'object_type': ChangelogObjectType.GROUP, 'object_id': group_id, 'action': ChangelogAction.UPDATED}
+		for group_id in sorted(group_ids)
+	]
+	if not entries:
+		return
+	ChangelogEntry.lock.acquire()
+	db.session.execute(db.insert(ChangelogEntry), entries)
@@ -9,6 +9,8 @@ from sqlalchemy.orm import relationship
 from uffd.utils import token_urlfriendly
 from uffd.database import db
 from .signup import Signup
+from .user import User
+from .role import Role
 
 invite_roles = db.Table('invite_roles',
 	Column('invite_id', Integer(), ForeignKey('invite.id', onupdate='CASCADE', ondelete='CASCADE'), primary_key=True),
@@ -71,6 +73,17 @@ class Invite(db.Model):
 		self.disabled = False
 		self.used = False
 
+	@classmethod
+	def list_options(cls):
+		'''Query options to eager-load everything the invite list (invite.index)
+		shows, including what Invite.permitted checks'''
+		return [
+			db.selectinload(cls.creator).selectinload(User.groups),
+			db.selectinload(cls.roles).selectinload(Role.moderator_group),
+			db.selectinload(cls.signups).selectinload(InviteSignup.user),
+			db.selectinload(cls.grants).selectinload(InviteGrant.user),
+		]
+
 class InviteGrant(db.Model):
 	__tablename__ = 'invite_grant'
 	id = Column(Integer(), primary_key=True, autoincrement=True)
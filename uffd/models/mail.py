@@ -27,6 +27,11 @@ class Mail(db.Model):
 	_destinations = relationship('MailDestinationAddress', cascade='all, delete-orphan')
 	destinations = association_proxy('_destinations', 'address')
 
+	@classmethod
+	def list_options(cls):
+		'''Query options to eager-load everything the mail list (mail.index) shows'''
+		return [db.selectinload(cls._receivers), db.selectinload(cls._destinations)]
+
 	@property
 	def invalid_receivers(self):
 		return [addr for addr in self.receivers if not re.fullmatch(self.RECEIVER_REGEX_COMPILED, addr)]
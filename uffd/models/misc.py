@@ -76,3 +76,59 @@ def insert_lock_rows(target, connection, **kwargs): # pylint: disable=unused-arg
 	for name in Lock.ALL_LOCKS:
 		db.session.execute(db.insert(lock_table).values(name=name))
 	db.session.commit()
+
+generation_counter_table = db.Table('generation_counter',
+	db.Column('name', db.String(32), primary_key=True),
+	db.Column('value', db.Integer(), nullable=False, default=0),
+)
+
+class GenerationCounter:
+	'''Database-backed counter that is incremented whenever certain data changes
+
+	Process-local caches use the current value as part of their cache keys.
+	Since the counter is incremented within the same transaction as the
+	change itself, all processes see the new value as soon as the change is
+	committed and stop using outdated cache entries.'''
+	ALL_COUNTERS = set()
+
+	def __init__(self, name):
+		self.name = name
+		assert name not in self.ALL_COUNTERS
+		self.ALL_COUNTERS.add(name)
+
+	@property
+	def value(self):
+		return db.session.execute(
+			db.select([generation_counter_table.c.value])
+			.where(generation_counter_table.c.name == self.name)
+		).scalar() or 0
+
+	def bump(self):
+		db.session.execute(
+			db.update(generation_counter_table)
+			.where(generation_counter_table.c.name == self.name)
+			.values(value=generation_counter_table.c.value + 1)
+		)
+
+	@staticmethod
+	def get_values(*counters):
+		'''Return the current values of counters with a single query'''
+		values = dict(db.session.execute(
+			db.select([generation_counter_table.c.name, generation_counter_table.c.value])
+			.where(generation_counter_table.c.name.in_([counter.name for counter in counters]))
+		).fetchall())
+		return [values.get(counter.name) or 0 for counter in counters]
+
+GenerationCounter.directory = GenerationCounter('directory')
+GenerationCounter.oauth2_keys = GenerationCounter('oauth2_keys')
+GenerationCounter.oauth2_tokens = GenerationCounter('oauth2_tokens')
+GenerationCounter.oauth2_clients = GenerationCounter('oauth2_clients')
+
+# Only executed when generation_counter_table is created with db.create/
+# db.create_all (e.g. during testing). Otherwise the rows are inserted with
+# migrations.
+@db.event.listens_for(generation_counter_table, 'after_create') # pylint: disable=no-member
+def insert_generation_counter_rows(target, connection, **kwargs): # pylint: disable=unused-argument
+	for name in GenerationCounter.ALL_COUNTERS:
+		db.session.execute(db.insert(generation_counter_table).values(name=name, value=0))
+	db.session.commit()
@@ -2,7 +2,10 @@ import datetime
 import json
 import secrets
 import base64
+import itertools
+import threading
 
+from flask import current_app
 from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -13,8 +16,9 @@ from uffd.database import db, CommaSeparatedList
 from uffd.tasks import cleanup_task
 from uffd.password_hash import PasswordHashAttribute, HighEntropyPasswordHash
 from uffd.utils import token_urlfriendly
-from .session import DeviceLoginInitiation, DeviceLoginType
-from .service import ServiceUser
+from .session import Session, DeviceLoginInitiation, DeviceLoginType
+from .service import Service, ServiceUser
+from .misc import GenerationCounter
 
 # pyjwt v1.7.x compat (Buster/Bullseye)
 if not hasattr(jwt, 'get_algorithm_by_name'):
@@ -35,11 +39,24 @@ class OAuth2Client(db.Model):
 	_redirect_uris = relationship('OAuth2RedirectURI', cascade='all, delete-orphan')
 	redirect_uris = association_proxy('_redirect_uris', 'uri')
 	logout_uris = relationship('OAuth2LogoutURI', cascade='all, delete-orphan')
+	# One of OAuth2Key.ALGORITHMS or None for the default (RS256), named after
+	# the client metadata field from OpenID Connect Dynamic Client Registration
+	id_token_signed_response_alg = Column(String(32), nullable=True)
 
 	@property
 	def default_redirect_uri(self):
 		return self.redirect_uris[0] if len(self.redirect_uris) == 1 else None
 
+	def get_id_token_key(self):
+		algorithm = self.id_token_signed_response_alg or 'RS256'
+		key = OAuth2Key.get_preferred_key(algorithm)
+		if key is None and algorithm != 'RS256':
+			# Clients that check the algorithm reject the tokens, but failing
+			# would break clients that don't.
+			current_app.logger.warning('No active %s key for OAuth2 client %s, falling back to RS256', algorithm, self.client_id)
+			key = OAuth2Key.get_preferred_key('RS256')
+		return key
+
 	def access_allowed(self, user):
 		service_user = ServiceUser.query.get((self.service_id, user.id))
 		return service_user and service_user.has_access
@@ -107,6 +124,8 @@ class OAuth2Grant(db.Model):
 	@classmethod
 	def get_by_authorization_code(cls, code):
 		# pylint: disable=protected-access
+		if code.startswith(StatelessOAuth2Grant.CODE_PREFIX):
+			return StatelessOAuth2Grant.get_by_authorization_code(code)
 		if '-' not in code:
 			return None
 		grant_id, grant_code = code.split('-', 2)
@@ -128,6 +147,119 @@ class OAuth2Grant(db.Model):
 			**kwargs
 		)
 
+	def invalidate(self):
+		db.session.delete(self)
+
+class StatelessOAuth2Grant:
+	'''Authorization code grant that is not stored in the database
+
+	Used instead of OAuth2Grant if OAUTH2_STATELESS_CODES is enabled. All
+	attributes of the grant are contained in the code itself, encrypted and
+	authenticated with a key derived from SECRET_KEY. Codes can only be
+	redeemed once: invalidate adds the code's id to OAuth2RedeemedCode, which
+	fails with an IntegrityError on commit if the code was already redeemed.'''
+	CODE_PREFIX = 's.'
+	EXPIRES_IN = OAuth2Grant.EXPIRES_IN
+
+	def __init__(self, session, client, redirect_uri=None, nonce=None, scopes=tuple(), claims=None, code_id=None, expires=None): # pylint: disable=too-many-arguments
+		self.session = session
+		self.client = client
+		self.redirect_uri = redirect_uri
+		self.nonce = nonce
+		self.scopes = tuple(scopes)
+		self.claims = claims
+		self.code_id = code_id or token_urlfriendly()
+		self.expires = expires or datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(seconds=self.EXPIRES_IN)
+
+	@classmethod
+	def from_grant(cls, grant, client):
+		# client can be a LoadedOAuth2Client, since grant.client is not set if
+		# grant was created with client_db_id
+		return cls(session=grant.session, client=client, redirect_uri=grant.redirect_uri,
+		           nonce=grant.nonce, scopes=grant.scopes, claims=grant.claims)
+
+	@property
+	def client_db_id(self):
+		return self.client.db_id
+
+	@staticmethod
+	def get_cipher():
+		# pylint: disable=import-outside-toplevel
+		from cryptography.hazmat.primitives import hashes
+		from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+		from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+		from cryptography.hazmat.backends import default_backend # Only required for Buster
+		secret = current_app.secret_key
+		if isinstance(secret, str):
+			secret = secret.encode()
+		key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'uffd oauth2 authorization code', backend=default_backend()).derive(secret)
+		return AESGCM(key)
+
+	@property
+	def code(self):
+		payload = json.dumps({
+			'id': self.code_id,
+			'exp': int(self.expires.replace(tzinfo=datetime.timezone.utc).timestamp()),
+			'sid': self.session.id,
+			'cid': self.client.db_id,
+			'uri': self.redirect_uri,
+			'scp': list(self.scopes),
+			'nonce': self.nonce,
+			'claims': self.claims,
+		}, separators=(',', ':')).encode()
+		iv = secrets.token_bytes(12)
+		data = iv + self.get_cipher().encrypt(iv, payload, self.CODE_PREFIX.encode())
+		return self.CODE_PREFIX + base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+	@classmethod
+	def get_by_authorization_code(cls, code):
+		# pylint: disable=import-outside-toplevel
+		from cryptography.exceptions import InvalidTag
+		try:
+			data = base64.urlsafe_b64decode(code[len(cls.CODE_PREFIX):] + '==')
+			payload = json.loads(cls.get_cipher().decrypt(data[:12], data[12:], cls.CODE_PREFIX.encode()))
+		except (ValueError, InvalidTag):
+			return None
+		expires = datetime.datetime.utcfromtimestamp(payload['exp'])
+		if expires < datetime.datetime.utcnow():
+			return None
+		grant = cls(
+			session=Session.query.get(payload['sid']),
+			client=OAuth2Client.query.get(payload['cid']),
+			redirect_uri=payload['uri'],
+			nonce=payload['nonce'],
+			scopes=payload['scp'],
+			claims=payload['claims'],
+			code_id=payload['id'],
+			expires=expires,
+		)
+		if grant.session is None or grant.client is None:
+			return None
+		if grant.session.expired or grant.session.user.is_deactivated:
+			return None
+		if not grant.service_user or not grant.service_user.has_access:
+			return None
+		return grant
+
+	service_user = OAuth2Grant.service_user
+	make_token = OAuth2Grant.make_token
+
+	def invalidate(self):
+		db.session.add(OAuth2RedeemedCode(id=self.code_id, expires=self.expires))
+
+@cleanup_task.delete_by_attribute('expired')
+class OAuth2RedeemedCode(db.Model):
+	'''Ids of redeemed StatelessOAuth2Grant codes
+
+	Entries are only needed until the code expires.'''
+	__tablename__ = 'oauth2_redeemed_code'
+	id = Column(String(64), primary_key=True)
+	expires = Column(DateTime, nullable=False, index=True)
+
+	@hybrid_property
+	def expired(self):
+		return self.expires < datetime.datetime.utcnow()
+
 # OAuth2Token objects are cleaned-up when the session expires and is
 # auto-deleted (or the user manually revokes it).
 class OAuth2Token(db.Model):
@@ -169,14 +301,46 @@ class OAuth2Token(db.Model):
 	def expired(self):
 		return self.expires < datetime.datetime.utcnow()
 
+	@property
+	def jwt_expires(self):
+		'''Expiry time for JWT access tokens
+
+		Tokens stop being valid when their session expires, so JWT access tokens
+		must not be valid for longer than the session.'''
+		return min(
+			self.expires,
+			self.session.created + datetime.timedelta(seconds=current_app.config['SESSION_LIFETIME_SECONDS']),
+			self.session.last_used + current_app.permanent_session_lifetime,
+		)
+
+	@staticmethod
+	def decode_jwt_access_token(access_token):
+		'''Return payload of JWT access token (RFC 9068) or None if it is invalid
+
+		Only checks signature and expiry. The token might have been revoked.'''
+		try:
+			if jwt.get_unverified_header(access_token).get('typ') != 'at+jwt':
+				return None
+			return OAuth2Key.decode_jwt(access_token, options={'verify_aud': False})
+		except jwt.exceptions.PyJWTError:
+			return None
+
 	@classmethod
 	def get_by_access_token(cls, access_token):
 		# pylint: disable=protected-access
-		if '-' not in access_token:
-			return None
-		token_id, token_secret = access_token.split('-', 2)
-		token = cls.query.filter_by(id=token_id, expired=False).first()
-		if not token or not secrets.compare_digest(token._access_token, token_secret):
+		if access_token.count('.') == 2:
+			payload = cls.decode_jwt_access_token(access_token)
+			if payload is None or not str(payload.get('jti', '')).isdigit():
+				return None
+			token = cls.query.filter_by(id=int(payload['jti']), expired=False).first()
+			if not token:
+				return None
+		elif '-' in access_token:
+			token_id, token_secret = access_token.split('-', 2)
+			token = cls.query.filter_by(id=token_id, expired=False).first()
+			if not token or not secrets.compare_digest(token._access_token, token_secret):
+				return None
+		else:
 			return None
 		if token.session.expired or token.session.user.is_deactivated:
 			return None
@@ -204,27 +368,30 @@ class OAuth2Key(db.Model):
 	private_key_jwk = Column(Text(), nullable=False)
 	public_key_jwk = Column(Text(), nullable=False)
 
+	# RS256 is the default and must always be supported (OpenID Connect
+	# Discovery 1.0 section 3). ES256 and EdDSA signatures are much cheaper to
+	# compute than RS256 signatures with 3072 bit keys. EdDSA requires pyjwt
+	# v2 (not available on Buster/Bullseye).
+	ALGORITHMS = [
+		algorithm for algorithm in ['RS256', 'ES256', 'EdDSA']
+		if algorithm in jwt.algorithms.get_default_algorithms()
+	]
+
 	def __init__(self, **kwargs):
 		if kwargs.get('algorithm') and kwargs.get('private_key') \
 				and not kwargs.get('private_key_jwk') \
 				and not kwargs.get('public_key_jwk'):
-			algorithm = jwt.get_algorithm_by_name(kwargs['algorithm'])
 			private_key = kwargs.pop('private_key')
-			kwargs['private_key_jwk'] = algorithm.to_jwk(private_key)
-			kwargs['public_key_jwk'] = algorithm.to_jwk(private_key.public_key())
+			kwargs['private_key_jwk'] = key_to_jwk(kwargs['algorithm'], private_key)
+			kwargs['public_key_jwk'] = key_to_jwk(kwargs['algorithm'], private_key.public_key())
 		super().__init__(**kwargs)
 
 	@property
 	def private_key(self):
-		# pylint: disable=protected-access,import-outside-toplevel
 		# cryptography performs expensive checks when loading RSA private keys.
-		# Since we only load keys we generated ourselves with help of cryptography,
-		# these checks are unnecessary.
-		import cryptography.hazmat.backends.openssl
-		cryptography.hazmat.backends.openssl.backend._rsa_skip_check_key = True
-		res = jwt.get_algorithm_by_name(self.algorithm).from_jwk(self.private_key_jwk)
-		cryptography.hazmat.backends.openssl.backend._rsa_skip_check_key = False
-		return res
+		# OAuth2KeyRing loads each key only once per process, so use it instead
+		# of this property wherever performance matters.
+		return jwt.get_algorithm_by_name(self.algorithm).from_jwk(self.private_key_jwk)
 
 	@property
 	def public_key(self):
@@ -240,10 +407,10 @@ class OAuth2Key(db.Model):
 		res.pop('key_ops', None)
 		return res
 
-	def encode_jwt(self, payload):
+	def encode_jwt(self, payload, headers=None):
 		if not self.active:
 			raise jwt.exceptions.InvalidKeyError(f'Key {self.id} not active')
-		res = jwt.encode(payload, key=self.private_key, algorithm=self.algorithm, headers={'kid': self.id})
+		res = jwt.encode(payload, key=self.private_key, algorithm=self.algorithm, headers={**(headers or {}), 'kid': self.id})
 		# pyjwt pre-v2 compat (Buster/Bullseye)
 		if isinstance(res, bytes):
 			res = res.decode()
@@ -254,7 +421,12 @@ class OAuth2Key(db.Model):
 		# pylint: disable=import-outside-toplevel
 		from cryptography.hazmat.primitives import hashes
 		from cryptography.hazmat.backends import default_backend # Only required for Buster
-		hash_alg = jwt.get_algorithm_by_name(self.algorithm).hash_alg
+		if self.algorithm == 'EdDSA':
+			# EdDSA does not define a separate hash algorithm. Like other
+			# implementations, we use SHA-512, which Ed25519 uses internally.
+			hash_alg = hashes.SHA512
+		else:
+			hash_alg = jwt.get_algorithm_by_name(self.algorithm).hash_alg
 		digest = hashes.Hash(hash_alg(), backend=default_backend())
 		digest.update(value)
 		return base64.urlsafe_b64encode(
@@ -263,24 +435,19 @@ class OAuth2Key(db.Model):
 
 	@classmethod
 	def get_preferred_key(cls, algorithm='RS256'):
-		return cls.query.filter_by(active=True, algorithm=algorithm).order_by(OAuth2Key.created.desc()).first()
+		return OAuth2KeyRing.get().get_preferred_key(algorithm)
 
 	@classmethod
 	def get_available_algorithms(cls):
-		return ['RS256']
+		ring = OAuth2KeyRing.get()
+		return [algorithm for algorithm in cls.ALGORITHMS if algorithm == 'RS256' or ring.get_preferred_key(algorithm)]
 
 	@classmethod
-	def decode_jwt(cls, data, algorithms=('RS256',), **kwargs):
+	def decode_jwt(cls, data, algorithms=None, **kwargs):
 		headers = jwt.get_unverified_header(data)
 		if 'kid' not in headers:
 			raise jwt.exceptions.InvalidKeyError('JWT without kid')
-		kid = headers['kid']
-		key = cls.query.get(kid)
-		if not key:
-			raise jwt.exceptions.InvalidKeyError(f'Key {kid} not found')
-		if not key.active:
-			raise jwt.exceptions.InvalidKeyError(f'Key {kid} not active')
-		return jwt.decode(data, key=key.public_key, algorithms=algorithms, **kwargs)
+		return OAuth2KeyRing.get().get_key(headers['kid']).decode_jwt(data, algorithms=algorithms, **kwargs)
 
 	@classmethod
 	def generate_rsa_key(cls, public_exponent=65537, key_size=3072):
@@ -288,3 +455,250 @@ class OAuth2Key(db.Model):
 		from cryptography.hazmat.primitives.asymmetric import rsa
 		from cryptography.hazmat.backends import default_backend # Only required for Buster
 		return cls(algorithm='RS256', private_key=rsa.generate_private_key(public_exponent=public_exponent, key_size=key_size, backend=default_backend()))
+
+	@classmethod
+	def generate_ec_key(cls):
+		# pylint: disable=import-outside-toplevel
+		from cryptography.hazmat.primitives.asymmetric import ec
+		from cryptography.hazmat.backends import default_backend # Only required for Buster
+		return cls(algorithm='ES256', private_key=ec.generate_private_key(ec.SECP256R1(), backend=default_backend()))
+
+	@classmethod
+	def generate_ed25519_key(cls):
+		# pylint: disable=import-outside-toplevel
+		from cryptography.hazmat.primitives.asymmetric import ed25519
+		if 'EdDSA' not in cls.ALGORITHMS:
+			raise NotImplementedError('EdDSA is not supported by the installed pyjwt version')
+		return cls(algorithm='EdDSA', private_key=ed25519.Ed25519PrivateKey.generate())
+
+def key_to_jwk(algorithm, key):
+	# pylint: disable=import-outside-toplevel
+	from cryptography.hazmat.primitives.asymmetric import ec
+	if not isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+		return jwt.get_algorithm_by_name(algorithm).to_jwk(key)
+	# pyjwt (at least up to v2.6) does not pad the values of EC keys to the
+	# length required by RFC7518 section 6.2.1.2 and 6.2.2.1 and fails to load
+	# keys with shorter values.
+	size = (key.curve.key_size + 7) // 8
+	def encode(value):
+		return base64.urlsafe_b64encode(value.to_bytes(size, 'big')).decode('ascii').rstrip('=')
+	if isinstance(key, ec.EllipticCurvePrivateKey):
+		public_numbers = key.public_key().public_numbers()
+	else:
+		public_numbers = key.public_numbers()
+	res = {
+		'kty': 'EC',
+		'crv': {'secp256r1': 'P-256', 'secp384r1': 'P-384', 'secp521r1': 'P-521'}[key.curve.name],
+		'x': encode(public_numbers.x),
+		'y': encode(public_numbers.y),
+	}
+	if isinstance(key, ec.EllipticCurvePrivateKey):
+		res['d'] = encode(key.private_numbers().private_value)
+	return json.dumps(res)
+
+class LoadedOAuth2Key:
+	'''Session-independent copy of an OAuth2Key with deserialized key objects
+
+	Instances are not modified after creation and can be shared between
+	threads.'''
+	def __init__(self, key):
+		self.id = key.id
+		self.created = key.created
+		self.active = key.active
+		self.algorithm = key.algorithm
+		self.public_key_jwks_dict = key.public_key_jwks_dict
+		self._private_key = self._load(lambda: key.private_key)
+		self._public_key = self._load(lambda: key.public_key)
+
+	@staticmethod
+	def _load(func):
+		# Keys that cannot be deserialized are kept in the ring, but using them
+		# raises InvalidKeyError
+		try:
+			return func()
+		except (jwt.exceptions.InvalidKeyError, ValueError, KeyError, TypeError):
+			return None
+
+	@property
+	def private_key(self):
+		if self._private_key is None:
+			raise jwt.exceptions.InvalidKeyError(f'Key {self.id} has no valid private key')
+		return self._private_key
+
+	@property
+	def public_key(self):
+		if self._public_key is None:
+			raise jwt.exceptions.InvalidKeyError(f'Key {self.id} has no valid public key')
+		return self._public_key
+
+	encode_jwt = OAuth2Key.encode_jwt
+	oidc_hash = OAuth2Key.oidc_hash
+
+	def decode_jwt(self, data, algorithms=None, **kwargs):
+		if not self.active:
+			raise jwt.exceptions.InvalidKeyError(f'Key {self.id} not active')
+		if algorithms is None:
+			algorithms = [self.algorithm]
+		return jwt.decode(data, key=self.public_key, algorithms=algorithms, **kwargs)
+
+class OAuth2KeyRing:
+	'''Snapshot of all OAuth2 keys with deserialized key objects
+
+	Deserializing keys (especially RSA private keys) is expensive compared to
+	signing a single JWT. The ring is built once per process and reused until
+	GenerationCounter.oauth2_keys changes, which happens whenever OAuth2Key
+	objects are added, modified or deleted. Within a transaction that changed
+	keys, a transaction-local ring is used instead, so uncommitted changes are
+	never shared with other requests.'''
+	build_lock = threading.Lock()
+
+	def __init__(self, generation, keys):
+		self.generation = generation
+		self.keys = {key.id: LoadedOAuth2Key(key) for key in keys}
+		self.preferred_keys = {}
+		for key in sorted(self.keys.values(), key=lambda key: key.created):
+			if key.active:
+				self.preferred_keys[key.algorithm] = key
+		self.jwks = json.dumps({
+			'keys': [key.public_key_jwks_dict for key in self.keys.values() if key.active],
+		})
+
+	@classmethod
+	def get(cls):
+		session = db.session()
+		if any(isinstance(obj, OAuth2Key) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+			session.flush()
+		if session.info.get('uffd_oauth2_keys_changed'):
+			return cls(None, OAuth2Key.query.all())
+		generation = GenerationCounter.oauth2_keys.value
+		ring = current_app.extensions.get('uffd_oauth2_key_ring')
+		if ring is not None and ring.generation == generation:
+			return ring
+		with cls.build_lock:
+			ring = current_app.extensions.get('uffd_oauth2_key_ring')
+			if ring is None or ring.generation != generation:
+				ring = cls(generation, OAuth2Key.query.all())
+				current_app.extensions['uffd_oauth2_key_ring'] = ring
+		return ring
+
+	def get_key(self, kid):
+		if kid not in self.keys:
+			raise jwt.exceptions.InvalidKeyError(f'Key {kid} not found')
+		return self.keys[kid]
+
+	def get_preferred_key(self, algorithm='RS256'):
+		return self.preferred_keys.get(algorithm)
+
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def oauth2_keys_changed(session, flush_context): # pylint: disable=unused-argument
+	for obj in itertools.chain(session.new, session.dirty, session.deleted):
+		if isinstance(obj, OAuth2Key):
+			session.info['uffd_oauth2_keys_changed'] = True
+			GenerationCounter.oauth2_keys.bump()
+			return
+
+@db.event.listens_for(db.Session, 'after_commit') # pylint: disable=no-member
+def oauth2_keys_committed(session):
+	session.info.pop('uffd_oauth2_keys_changed', None)
+
+@db.event.listens_for(db.Session, 'after_soft_rollback') # pylint: disable=no-member
+def oauth2_keys_rolled_back(session, previous_transaction): # pylint: disable=unused-argument
+	session.info.pop('uffd_oauth2_keys_changed', None)
+
+class LoadedOAuth2Client:
+	'''Session-independent copy of an OAuth2Client and its URIs
+
+	Instances are not modified after creation and can be shared between
+	threads.'''
+	def __init__(self, client):
+		self.db_id = client.db_id
+		self.client_id = client.client_id
+		self.client_secret = client.client_secret
+		self.redirect_uris = tuple(client.redirect_uris)
+		self.logout_uris = tuple((item.method, item.uri) for item in client.logout_uris)
+		self.service_id = client.service_id
+		self.service_name = client.service.name
+		self.id_token_signed_response_alg = client.id_token_signed_response_alg
+
+	default_redirect_uri = OAuth2Client.default_redirect_uri
+	get_id_token_key = OAuth2Client.get_id_token_key
+	access_allowed = OAuth2Client.access_allowed
+
+	@property
+	def logout_uris_json(self):
+		return json.dumps([[method, uri] for method, uri in self.logout_uris])
+
+class OAuth2ClientRegistry:
+	'''Snapshot of all OAuth2 clients with their redirect and logout URIs
+
+	The authorize, token and logout endpoints look up clients by client_id on
+	every request and then lazy-load their URIs and service. The registry
+	bulk-loads all clients once per process and is reused until
+	GenerationCounter.oauth2_clients changes, which happens whenever clients,
+	their URIs or services are added, modified or deleted. Like with
+	OAuth2KeyRing, a transaction-local registry is used within a transaction
+	that changed clients.'''
+	build_lock = threading.Lock()
+
+	def __init__(self, generation, clients):
+		self.generation = generation
+		self.clients = {client.client_id: LoadedOAuth2Client(client) for client in clients}
+		self.clients_by_db_id = {client.db_id: client for client in self.clients.values()}
+
+	@staticmethod
+	def load_clients():
+		return OAuth2Client.query.options(
+			db.selectinload(OAuth2Client._redirect_uris), # pylint: disable=protected-access
+			db.selectinload(OAuth2Client.logout_uris),
+			db.joinedload(OAuth2Client.service),
+		).all()
+
+	@classmethod
+	def get(cls):
+		session = db.session()
+		if any(isinstance(obj, OAUTH2_CLIENT_REGISTRY_MODELS) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+			session.flush()
+		if session.info.get('uffd_oauth2_clients_changed'):
+			return cls(None, cls.load_clients())
+		generation = GenerationCounter.oauth2_clients.value
+		registry = current_app.extensions.get('uffd_oauth2_client_registry')
+		if registry is not None and registry.generation == generation:
+			return registry
+		with cls.build_lock:
+			registry = current_app.extensions.get('uffd_oauth2_client_registry')
+			if registry is None or registry.generation != generation:
+				registry = cls(generation, cls.load_clients())
+				current_app.extensions['uffd_oauth2_client_registry'] = registry
+		return registry
+
+	def get_client(self, client_id):
+		return self.clients.get(client_id)
+
+# Changes to objects of these models affect the data in OAuth2ClientRegistry
+OAUTH2_CLIENT_REGISTRY_MODELS = (OAuth2Client, OAuth2RedirectURI, OAuth2LogoutURI, Service)
+
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def oauth2_clients_changed(session, flush_context): # pylint: disable=unused-argument
+	for obj in itertools.chain(session.new, session.dirty, session.deleted):
+		if isinstance(obj, OAUTH2_CLIENT_REGISTRY_MODELS):
+			session.info['uffd_oauth2_clients_changed'] = True
+			GenerationCounter.oauth2_clients.bump()
+			return
+
+@db.event.listens_for(db.Session, 'after_commit') # pylint: disable=no-member
+def oauth2_clients_committed(session):
+	session.info.pop('uffd_oauth2_clients_changed', None)
+
+@db.event.listens_for(db.Session, 'after_soft_rollback') # pylint: disable=no-member
+def oauth2_clients_rolled_back(session, previous_transaction): # pylint: disable=unused-argument
+	session.info.pop('uffd_oauth2_clients_changed', None)
+
+# Bump GenerationCounter.oauth2_tokens when access tokens are revoked. Changes
+# to data embedded in JWT access tokens are covered by
+# GenerationCounter.directory.
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def bump_oauth2_tokens_generation(session, flush_context): # pylint: disable=unused-argument
+	for obj in session.deleted:
+		if isinstance(obj, (OAuth2Token, OAuth2Client, Session)):
+			GenerationCounter.oauth2_tokens.bump()
+			return
@@ -1,8 +1,16 @@
+import contextlib
 import datetime
+import fcntl
+import hashlib
 import ipaddress
 import math
+import mmap
+import os
+import struct
+import threading
+import time
 
-from flask import request
+from flask import request, current_app
 from flask_babel import gettext as _
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -13,6 +21,10 @@ from uffd.database import db
 @cleanup_task.delete_by_attribute('expired')
 class RatelimitEvent(db.Model):
 	__tablename__ = 'ratelimit_event'
+	__table_args__ = (
+		# Covers the aggregate query in SQLRatelimitBackend.get_stats
+		db.Index('ix_ratelimit_event_name_key_expires', 'name', 'key', 'expires', 'timestamp'),
+	)
 	id = Column(Integer(), primary_key=True, autoincrement=True)
 	timestamp = Column(DateTime(), default=datetime.datetime.utcnow, nullable=False)
 	expires = Column(DateTime(), nullable=False)
@@ -23,6 +35,145 @@ class RatelimitEvent(db.Model):
 	def expired(self):
 		return self.expires < datetime.datetime.utcnow()
 
+class SQLRatelimitBackend:
+	'''Default backend that stores each event as a RatelimitEvent
+
+	Backends implement log(name, key, interval) and get_stats(name, key,
+	interval). The latter returns the number of events within the last
+	interval and the UTC timestamp (datetime) of the earliest of them.'''
+	def __init__(self, app): # pylint: disable=unused-argument
+		pass
+
+	def log(self, name, key, interval):
+		db.session.add(RatelimitEvent(name=name, key=key, expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=interval)))
+		db.session.commit()
+
+	def get_stats(self, name, key, interval): # pylint: disable=unused-argument
+		# pylint: disable=no-member
+		count, first_timestamp = db.session.query(db.func.count(), db.func.min(RatelimitEvent.timestamp))\
+				.filter(db.not_(RatelimitEvent.expired))\
+				.filter(RatelimitEvent.name == name, RatelimitEvent.key == key)\
+				.one()
+		return count, first_timestamp
+
+class MemoryRatelimitBackend:
+	'''Backend that keeps compact sliding-window counters in shared memory
+
+	Instead of individual events, each (name, key) pair has counters for the
+	current and the previous fixed window of the ratelimit's interval. The
+	number of events within the last interval is estimated by weighting the
+	previous window's counter by its overlap with the sliding window. Both
+	log and get_stats are O(1) and do not touch the database.
+
+	Counters are stored in a fixed-size table (RATELIMIT_MEMORY_SLOTS) with
+	open addressing. If RATELIMIT_MEMORY_PATH is set, the table is a
+	memory-mapped file that is shared (and locked with flock) between all
+	worker processes. Otherwise it is anonymous memory private to the
+	current process. Since the backend is only created on first use, i.e.
+	after the web server forked its workers, each worker then counts events
+	on its own and clients may exceed the limits by a factor of the number
+	of workers. If the table is full, the least recently rotated entry near
+	the key's slot is replaced. Counters do not survive restarts when
+	RATELIMIT_MEMORY_PATH is unset.'''
+	# key digest, window start, previous count, current count, first timestamp
+	# in previous window, first timestamp in current window
+	SLOT = struct.Struct('<16sddddd')
+	PROBE_LENGTH = 8
+
+	def __init__(self, app):
+		self.slots = app.config['RATELIMIT_MEMORY_SLOTS']
+		self.lock = threading.Lock()
+		self.fd = None
+		size = self.slots * self.SLOT.size
+		path = app.config['RATELIMIT_MEMORY_PATH']
+		if path:
+			self.fd = os.open(path, os.O_RDWR|os.O_CREAT, 0o600)
+			if os.fstat(self.fd).st_size != size:
+				with self.locked():
+					os.ftruncate(self.fd, size)
+			self.data = mmap.mmap(self.fd, size)
+		else:
+			self.data = mmap.mmap(-1, size)
+
+	@contextlib.contextmanager
+	def locked(self):
+		with self.lock:
+			if self.fd is None:
+				yield
+				return
+			fcntl.flock(self.fd, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+	@staticmethod
+	def rotate(values, now, interval):
+		window_start, prev_count, cur_count, prev_first, cur_first = values
+		if now >= window_start + 2*interval:
+			return now, 0.0, 0.0, 0.0, 0.0
+		if now >= window_start + interval:
+			return window_start + interval, cur_count, 0.0, cur_first, 0.0
+		return values
+
+	def find_slot(self, digest, now, interval):
+		'''Return (offset, values) of the slot for digest or a free slot'''
+		start = int.from_bytes(digest[:8], 'little') % self.slots
+		candidate = None
+		for i in range(self.PROBE_LENGTH):
+			offset = ((start + i) % self.slots) * self.SLOT.size
+			slot_digest, *values = self.SLOT.unpack_from(self.data, offset)
+			if slot_digest == digest:
+				return offset, self.rotate(tuple(values), now, interval)
+			# Use an empty slot (window start 0) or replace the entry with the
+			# oldest window
+			if candidate is None or values[0] < candidate[1]:
+				candidate = (offset, values[0])
+		return candidate[0], (now, 0.0, 0.0, 0.0, 0.0)
+
+	def log(self, name, key, interval):
+		digest = self.get_digest(name, key)
+		now = time.time()
+		with self.locked():
+			offset, values = self.find_slot(digest, now, interval)
+			window_start, prev_count, cur_count, prev_first, cur_first = values
+			if not cur_count:
+				cur_first = now
+			self.SLOT.pack_into(self.data, offset, digest, window_start, prev_count, cur_count + 1, prev_first, cur_first)
+
+	def get_stats(self, name, key, interval):
+		digest = self.get_digest(name, key)
+		now = time.time()
+		with self.locked():
+			_, values = self.find_slot(digest, now, interval)
+		window_start, prev_count, cur_count, prev_first, cur_first = values
+		prev_weight = max(0.0, 1 - (now - window_start)/interval)
+		count = prev_count * prev_weight + cur_count
+		if prev_count and prev_weight:
+			first = max(prev_first, now - interval)
+		elif cur_count:
+			first = cur_first
+		else:
+			return 0, None
+		return count, datetime.datetime.utcfromtimestamp(first)
+
+	@staticmethod
+	def get_digest(name, key):
+		key = b'\0' if key is None else str(key).encode()
+		return hashlib.blake2b(name.encode() + b'\0' + key, digest_size=16).digest()
+
+RATELIMIT_BACKENDS = {
+	'sql': SQLRatelimitBackend,
+	'memory': MemoryRatelimitBackend,
+}
+
+def get_ratelimit_backend():
+	backends = current_app.extensions.setdefault('uffd_ratelimit_backends', {})
+	name = current_app.config['RATELIMIT_BACKEND']
+	if name not in backends:
+		backends[name] = RATELIMIT_BACKENDS[name](current_app)
+	return backends[name]
+
 class Ratelimit:
 	def __init__(self, name, interval, limit):
 		self.name = name
@@ -31,22 +182,17 @@ class Ratelimit:
 		self.base = interval**(1/limit)
 
 	def log(self, key=None):
-		db.session.add(RatelimitEvent(name=self.name, key=key, expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=self.interval)))
-		db.session.commit()
+		get_ratelimit_backend().log(self.name, key, self.interval)
 
 	def get_delay(self, key=None):
-		events = RatelimitEvent.query\
-				.filter(db.not_(RatelimitEvent.expired))\
-				.filter_by(name=self.name, key=key)\
-				.order_by(RatelimitEvent.timestamp)\
-				.all()
-		if not events:
+		count, first_timestamp = get_ratelimit_backend().get_stats(self.name, key, self.interval)
+		if not count:
 			return 0
-		delay = math.ceil(self.base**len(events))
+		delay = math.ceil(self.base**count)
 		if delay < 5:
 			delay = 0
 		delay = min(delay, 365*24*60*60) # prevent overflow of datetime objects
-		remaining = events[0].timestamp + datetime.timedelta(seconds=delay) - datetime.datetime.utcnow()
+		remaining = first_timestamp + datetime.timedelta(seconds=delay) - datetime.datetime.utcnow()
 		return max(0, math.ceil(remaining.total_seconds()))
 
 def get_addrkey(addr=None):
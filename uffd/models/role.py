@@ -1,9 +1,17 @@
+import itertools
+import threading
+import time
+
+from flask import current_app
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.collections import MappedCollection, collection
 
 from uffd.database import db
-from .user import User
+from .user import User, Group, user_groups
+from .mfa import MFAMethod, MFAType
+from .misc import GenerationCounter, Lock
+from .changelog import log_core_updates
 
 class RoleGroup(db.Model):
 	__tablename__ = 'role_groups'
@@ -36,24 +44,382 @@ def flatten_recursive(objs, attr):
 				new_objs.add(obj)
 	return objs
 
+class RoleGraph:
+	'''Precomputed role inclusion graph with the groups of each role
+
+	Loads all roles, role inclusions and role groups with a few queries and
+	answers "which roles/groups are effective for a set of directly assigned
+	roles" with memoized set operations. Groups are stored as bitsets (ints),
+	one for all groups and one for groups that do not require MFA.
+
+	Use RoleGraph.get() to get the graph of the current database session. It is
+	rebuilt after changes to roles, role groups or groups and at the end of
+	each transaction. Unflushed changes are detected with attribute and session
+	events (see reset_role_graph), so get() does not need to scan the session.'''
+	def __init__(self):
+		# pylint: disable=no-member
+		self.roles = {role.id: role for role in Role.query.all()}
+		self.default_role_ids = frozenset(role_id for role_id, role in self.roles.items() if role.is_default)
+		self.included_role_ids = {role_id: set() for role_id in self.roles}
+		self.including_role_ids = {role_id: set() for role_id in self.roles}
+		for role_id, included_role_id in db.session.execute(db.select([role_inclusion.c.role_id, role_inclusion.c.included_role_id])):
+			self.included_role_ids[role_id].add(included_role_id)
+			self.including_role_ids[included_role_id].add(role_id)
+		self.groups = Group.query.filter(Group.id.in_(db.select([RoleGroup.group_id]))).all()
+		group_bits = {group.id: 1 << index for index, group in enumerate(self.groups)}
+		self.role_group_bits = {role_id: [0, 0] for role_id in self.roles}
+		for role_id, group_id, requires_mfa in db.session.execute(db.select([RoleGroup.role_id, RoleGroup.group_id, RoleGroup.requires_mfa])):
+			self.role_group_bits[role_id][0] |= group_bits[group_id]
+			if not requires_mfa:
+				self.role_group_bits[role_id][1] |= group_bits[group_id]
+		self.closures = {}
+		self.including_closures = {}
+		self.effective_role_ids = {}
+		self.effective_group_bits = {}
+		self.group_ids_by_bits = {}
+
+	@classmethod
+	def get(cls):
+		session = db.session()
+		# Session.delete does not emit any event before the flush
+		if any(isinstance(obj, (Role, RoleGroup, Group)) for obj in session.deleted):
+			session.info.pop('uffd_role_graph', None)
+		if 'uffd_role_graph' not in session.info:
+			session.info['uffd_role_graph'] = cls()
+		return session.info['uffd_role_graph']
+
+	@staticmethod
+	def compute_closure(role_id, edges):
+		closure = {role_id}
+		pending = [role_id]
+		while pending:
+			for other_role_id in edges[pending.pop()]:
+				if other_role_id not in closure:
+					closure.add(other_role_id)
+					pending.append(other_role_id)
+		return frozenset(closure)
+
+	def get_closure(self, role_id):
+		'''Return ids of role and all roles included by it (recursively)'''
+		if role_id not in self.closures:
+			self.closures[role_id] = self.compute_closure(role_id, self.included_role_ids)
+		return self.closures[role_id]
+
+	def get_including_closure(self, role_id):
+		'''Return ids of role and all roles that include it (recursively)'''
+		if role_id not in self.including_closures:
+			self.including_closures[role_id] = self.compute_closure(role_id, self.including_role_ids)
+		return self.including_closures[role_id]
+
+	def get_effective_role_ids(self, role_ids, include_default=True):
+		key = (frozenset(role_ids), include_default)
+		if key not in self.effective_role_ids:
+			base = key[0] | self.default_role_ids if include_default else key[0]
+			self.effective_role_ids[key] = frozenset().union(*[self.get_closure(role_id) for role_id in base])
+		return self.effective_role_ids[key]
+
+	def get_effective_group_bits(self, role_ids, include_default=True, mfa=True):
+		key = (frozenset(role_ids), include_default)
+		if key not in self.effective_group_bits:
+			bits = [0, 0]
+			for role_id in self.get_effective_role_ids(*key):
+				bits[0] |= self.role_group_bits[role_id][0]
+				bits[1] |= self.role_group_bits[role_id][1]
+			self.effective_group_bits[key] = tuple(bits)
+		return self.effective_group_bits[key][0 if mfa else 1]
+
+	def get_effective_groups(self, role_ids, include_default=True, mfa=True):
+		bits = self.get_effective_group_bits(role_ids, include_default, mfa)
+		return {group for index, group in enumerate(self.groups) if bits & (1 << index)}
+
+	def get_effective_group_ids(self, role_ids, include_default=True, mfa=True):
+		bits = self.get_effective_group_bits(role_ids, include_default, mfa)
+		if bits not in self.group_ids_by_bits:
+			self.group_ids_by_bits[bits] = frozenset(group.id for index, group in enumerate(self.groups) if bits & (1 << index))
+		return self.group_ids_by_bits[bits]
+
+ROLE_GRAPH_ROLE_ATTRIBUTES = ('included_roles', 'including_roles', 'groups', 'is_default')
+
+def role_graph_changed(session):
+	for obj in itertools.chain(session.new, session.deleted):
+		if isinstance(obj, (Role, RoleGroup, Group)):
+			return True
+	for obj in session.dirty:
+		if isinstance(obj, RoleGroup) and session.is_modified(obj):
+			return True
+		if isinstance(obj, Role):
+			state = db.inspect(obj)
+			if any(state.attrs[name].history.has_changes() for name in ROLE_GRAPH_ROLE_ATTRIBUTES):
+				return True
+	return False
+
+def reset_role_graph(target, *args): # pylint: disable=unused-argument
+	session = db.inspect(target).session
+	if session is not None:
+		session.info.pop('uffd_role_graph', None)
+
+@db.event.listens_for(db.Session, 'transient_to_pending') # pylint: disable=no-member
+def reset_role_graph_on_add(session, instance):
+	if isinstance(instance, (Role, RoleGroup, Group)):
+		session.info.pop('uffd_role_graph', None)
+
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def reset_role_graph_after_flush(session, flush_context): # pylint: disable=unused-argument
+	if role_graph_changed(session):
+		session.info.pop('uffd_role_graph', None)
+
+@db.event.listens_for(db.Session, 'after_commit') # pylint: disable=no-member
+def reset_role_graph_after_commit(session):
+	session.info.pop('uffd_role_graph', None)
+
+@db.event.listens_for(db.Session, 'after_soft_rollback') # pylint: disable=no-member
+def reset_role_graph_after_rollback(session, previous_transaction): # pylint: disable=unused-argument
+	session.info.pop('uffd_role_graph', None)
+
+def get_user_role_ids(user, graph):
+	role_ids = [role.id for role in user.roles]
+	# Roles that are not known to the graph (i.e. not flushed)
+	if None in role_ids or not graph.roles.keys() >= set(role_ids):
+		return None
+	return role_ids
+
 def get_user_roles_effective(user):
-	base = set(user.roles)
-	if not user.is_service_user:
-		base.update(Role.query.filter_by(is_default=True))
-	return flatten_recursive(base, 'included_roles')
+	graph = RoleGraph.get()
+	role_ids = get_user_role_ids(user, graph)
+	if role_ids is None:
+		base = set(user.roles)
+		if not user.is_service_user:
+			base.update(graph.roles[role_id] for role_id in graph.default_role_ids)
+		return flatten_recursive(base, 'included_roles')
+	return {graph.roles[role_id] for role_id in graph.get_effective_role_ids(role_ids, include_default=not user.is_service_user)}
 
 User.roles_effective = property(get_user_roles_effective)
 
 def compute_user_groups(user, ignore_mfa=False):
-	groups = set()
-	for role in user.roles_effective:
-		for group in role.groups:
-			if ignore_mfa or not role.groups[group].requires_mfa or user.mfa_enabled:
-				groups.add(group)
-	return groups
+	graph = RoleGraph.get()
+	role_ids = get_user_role_ids(user, graph)
+	if role_ids is None:
+		groups = set()
+		for role in user.roles_effective:
+			for group in role.groups:
+				if ignore_mfa or not role.groups[group].requires_mfa or user.mfa_enabled:
+					groups.add(group)
+		return groups
+	mfa = ignore_mfa or user.mfa_enabled
+	return graph.get_effective_groups(role_ids, include_default=not user.is_service_user, mfa=mfa)
 
 User.compute_groups = compute_user_groups
 
+class UserGroupChanges:
+	def __init__(self, user_id, loginname, group_ids_added, group_ids_removed):
+		self.user_id = user_id
+		self.loginname = loginname
+		self.group_ids_added = group_ids_added
+		self.group_ids_removed = group_ids_removed
+
+def compute_all_user_group_changes(user_filter=None, batch_size=1000):
+	'''Yield UserGroupChanges for all users with groups that are not consistent
+	with their roles
+
+	Equivalent to calling User.update_groups for all users, but users, role
+	memberships, MFA state and current groups are read in batches with Core
+	queries and no ORM objects are constructed. `user_filter` is an optional
+	SQL expression to restrict the users (e.g. to partition the work).'''
+	# pylint: disable=no-member
+	graph = RoleGraph.get()
+	mfa_types = [MFAType.TOTP, MFAType.WEBAUTHN]
+	min_id = None
+	while True:
+		query = db.select([User.id, User.loginname, User.is_service_user]).order_by(User.id).limit(batch_size)
+		if user_filter is not None:
+			query = query.where(user_filter)
+		if min_id is not None:
+			query = query.where(User.id > min_id)
+		users = db.session.execute(query).fetchall()
+		if not users:
+			break
+		min_id, max_id = users[0].id, users[-1].id
+		# Range queries instead of IN lists to stay within bind parameter limits
+		def in_range(column):
+			return db.and_(column >= min_id, column <= max_id)
+		role_ids = {}
+		for user_id, role_id in db.session.execute(db.select([role_members.c.user_id, role_members.c.role_id]).where(in_range(role_members.c.user_id))):
+			role_ids.setdefault(user_id, set()).add(role_id)
+		current_group_ids = {}
+		for user_id, group_id in db.session.execute(db.select([user_groups.c.user_id, user_groups.c.group_id]).where(in_range(user_groups.c.user_id))):
+			current_group_ids.setdefault(user_id, set()).add(group_id)
+		mfa_user_ids = {row[0] for row in db.session.execute(
+			db.select([MFAMethod.user_id]).where(in_range(MFAMethod.user_id)).where(MFAMethod.type.in_(mfa_types)).distinct()
+		)}
+		for user in users:
+			group_ids = graph.get_effective_group_ids(
+				role_ids.get(user.id, ()),
+				include_default=not user.is_service_user,
+				mfa=user.id in mfa_user_ids,
+			)
+			current = current_group_ids.get(user.id, set())
+			if group_ids != current:
+				yield UserGroupChanges(user.id, user.loginname, group_ids - current, current - group_ids)
+		min_id = max_id
+
+def apply_user_group_changes(changes):
+	'''Apply UserGroupChanges with bulk INSERT/DELETE statements
+
+	Core statements bypass the ORM hooks, so changelog entries and the
+	directory generation counter are updated explicitly.'''
+	added = [{'user_id': change.user_id, 'group_id': group_id} for change in changes for group_id in change.group_ids_added]
+	removed = [{'_user_id': change.user_id, '_group_id': group_id} for change in changes for group_id in change.group_ids_removed]
+	if removed:
+		db.session.execute(db.delete(user_groups).where(db.and_(
+			user_groups.c.user_id == db.bindparam('_user_id'),
+			user_groups.c.group_id == db.bindparam('_group_id'),
+		)), removed)
+	if added:
+		db.session.execute(db.insert(user_groups), added)
+	if added or removed:
+		log_core_updates(
+			user_ids={change.user_id for change in changes},
+			group_ids={row['group_id'] for row in added} | {row['_group_id'] for row in removed},
+		)
+		GenerationCounter.directory.bump()
+		db.session.expire_all()
+
+def update_users_groups(user_ids, chunk_size=500):
+	'''Batched equivalent of calling User.update_groups for users with `user_ids`
+
+	Changes are computed with compute_all_user_group_changes in chunks and
+	applied with apply_user_group_changes. Pending ORM changes are flushed and
+	all objects are expired afterwards.'''
+	db.session.flush()
+	user_ids = sorted(user_ids)
+	changes = []
+	for index in range(0, len(user_ids), chunk_size):
+		chunk = user_ids[index:index + chunk_size]
+		changes += compute_all_user_group_changes(user_filter=User.id.in_(chunk), batch_size=chunk_size)
+	apply_user_group_changes(changes)
+
+class PendingGroupUpdate(db.Model):
+	'''Queue of users whose group memberships need to be recomputed
+
+	Role changes add the affected users with enqueue_group_updates. The queue
+	is processed with process_group_updates depending on GROUP_UPDATE_WORKER:
+	"inline" before the transaction that enqueued the users is committed,
+	"thread" by a background thread of the process after the commit and
+	"external" only by the "group-updates" CLI commands.'''
+	__tablename__ = 'pending_group_update'
+	user_id = Column(Integer(), ForeignKey('user.id', onupdate='CASCADE', ondelete='CASCADE'), primary_key=True)
+	# Incremented when an already queued user is enqueued again, so that a
+	# worker that is processing the old entry does not remove it
+	version = Column(Integer(), default=0, nullable=False)
+
+	lock = Lock('pending_group_update')
+
+def enqueue_group_updates(user_filter):
+	'''Add all users matching the SQL expression `user_filter` to the queue'''
+	# pylint: disable=no-member
+	table = PendingGroupUpdate.__table__
+	db.session.flush()
+	db.session.execute(db.update(table).where(
+		table.c.user_id.in_(db.select([User.id]).where(user_filter))
+	).values(version=table.c.version + 1))
+	db.session.execute(db.insert(table).from_select(
+		['user_id', 'version'],
+		db.select([User.id, db.literal(0)]).where(user_filter).where(
+			~db.select([table.c.user_id]).where(table.c.user_id == User.id).exists()
+		)
+	))
+	db.session.info['uffd_group_updates_enqueued'] = True
+
+def process_group_updates(batch_size=500, commit=True):
+	'''Process the queue in batches until it is empty
+
+	Each batch is committed separately unless `commit` is False. Returns the
+	number of processed queue entries.'''
+	table = PendingGroupUpdate.__table__
+	count = 0
+	while True:
+		PendingGroupUpdate.lock.acquire()
+		rows = db.session.execute(db.select([table.c.user_id, table.c.version]).order_by(table.c.user_id).limit(batch_size)).fetchall()
+		if rows:
+			update_users_groups([row.user_id for row in rows], chunk_size=batch_size)
+			db.session.execute(db.delete(table).where(db.and_(
+				table.c.user_id == db.bindparam('_user_id'),
+				table.c.version == db.bindparam('_version'),
+			)), [{'_user_id': row.user_id, '_version': row.version} for row in rows])
+			count += len(rows)
+		if commit:
+			db.session.commit()
+		if not rows:
+			break
+	return count
+
+def get_group_update_queue_length():
+	return db.session.execute(db.select([db.func.count()]).select_from(PendingGroupUpdate.__table__)).scalar()
+
+def wait_for_group_updates(timeout=None, poll_interval=0.5):
+	'''Commit and wait until the queue is empty
+
+	Returns False if the timeout (in seconds) is exceeded.'''
+	deadline = None if timeout is None else time.monotonic() + timeout
+	while True:
+		db.session.commit()
+		if not get_group_update_queue_length():
+			return True
+		if deadline is not None and time.monotonic() > deadline:
+			return False
+		time.sleep(poll_interval)
+
+class GroupUpdateWorker:
+	'''Background thread that processes the queue (GROUP_UPDATE_WORKER="thread")
+
+	The thread is started lazily and woken up after each commit that enqueued
+	users. It also processes the queue every minute to pick up entries left
+	over from failed attempts or other processes.'''
+	def __init__(self, app):
+		self.app = app
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.thread = None
+
+	@classmethod
+	def get(cls):
+		if 'uffd_group_update_worker' not in current_app.extensions:
+			current_app.extensions['uffd_group_update_worker'] = cls(current_app._get_current_object()) # pylint: disable=protected-access
+		return current_app.extensions['uffd_group_update_worker']
+
+	def notify(self):
+		with self.lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+		self.event.set()
+
+	def run(self):
+		while True:
+			self.event.wait(timeout=60)
+			self.event.clear()
+			with self.app.app_context():
+				try:
+					process_group_updates()
+				except Exception: # pylint: disable=broad-except
+					db.session.rollback()
+					self.app.logger.exception('Processing group updates failed')
+
+@db.event.listens_for(db.Session, 'before_commit') # pylint: disable=no-member
+def process_group_updates_inline(session):
+	if session.info.get('uffd_group_updates_enqueued') and current_app.config['GROUP_UPDATE_WORKER'] == 'inline':
+		session.info.pop('uffd_group_updates_enqueued')
+		process_group_updates(commit=False)
+
+@db.event.listens_for(db.Session, 'after_commit') # pylint: disable=no-member
+def notify_group_update_worker(session):
+	if session.info.pop('uffd_group_updates_enqueued', False) and current_app.config['GROUP_UPDATE_WORKER'] == 'thread':
+		GroupUpdateWorker.get().notify()
+
+@db.event.listens_for(db.Session, 'after_soft_rollback') # pylint: disable=no-member
+def reset_group_updates_enqueued(session, previous_transaction): # pylint: disable=unused-argument
+	session.info.pop('uffd_group_updates_enqueued', None)
+
 def update_user_groups(user):
 	current_groups = set(user.groups)
 	groups = user.compute_groups()
@@ -105,12 +471,29 @@ class Role(db.Model):
 
 	@property
 	def members_effective(self):
-		members = set()
-		for role in flatten_recursive([self], 'including_roles'):
-			members.update(role.members)
-			if role.is_default:
-				members.update([user for user in User.query.all() if not user.is_service_user])
-		return members
+		return set(User.query.filter(self.get_members_effective_filter()).all())
+
+	@property
+	def members_effective_ids(self):
+		return {row[0] for row in db.session.execute(db.select([User.id]).where(self.get_members_effective_filter()))}
+
+	def get_members_effective_filter(self):
+		'''Return SQL expression that matches all effective members of the role'''
+		# Roles and memberships must be flushed to be visible in SQL queries
+		db.session.flush()
+		if self.id is None:
+			# Role was not added to the session, so it is unknown to the graph
+			roles = flatten_recursive([self], 'including_roles')
+			expr = User.id.in_([user.id for role in roles for user in role.members])
+			is_default = any(role.is_default for role in roles)
+		else:
+			graph = RoleGraph.get()
+			role_ids = graph.get_including_closure(self.id)
+			expr = User.roles.any(Role.id.in_(role_ids))
+			is_default = bool(role_ids & graph.default_role_ids)
+		if is_default:
+			expr = db.or_(expr, db.not_(User.is_service_user))
+		return expr
 
 	@property
 	def included_roles_recursive(self):
@@ -124,5 +507,12 @@ class Role(db.Model):
 		return groups
 
 	def update_member_groups(self):
-		for user in self.members_effective:
-			user.update_groups()
+		enqueue_group_updates(self.get_members_effective_filter())
+
+# Changes to the attributes in ROLE_GRAPH_ROLE_ATTRIBUTES and RoleGroup. Changes
+# to Role.including_roles also fire events for Role.included_roles (backref).
+for _attribute in (Role.included_roles, Role.groups):
+	db.event.listen(_attribute, 'append', reset_role_graph) # pylint: disable=no-member
+	db.event.listen(_attribute, 'remove', reset_role_graph) # pylint: disable=no-member
+for _attribute in (Role.is_default, RoleGroup.role, RoleGroup.group, RoleGroup.requires_mfa):
+	db.event.listen(_attribute, 'set', reset_role_graph) # pylint: disable=no-member
@@ -1,4 +1,5 @@
 import enum
+import itertools
 
 from flask import current_app
 from flask_babel import get_locale
@@ -8,7 +9,9 @@ from sqlalchemy.orm import relationship, validates
 from uffd.database import db
 from uffd.remailer import remailer
 from uffd.tasks import cleanup_task
-from .user import User, UserEmail, user_groups
+from uffd.cache import LRUCache
+from .user import User, UserEmail, Group, user_groups
+from .misc import GenerationCounter
 
 class RemailerMode(enum.Enum):
 	DISABLED = 0
@@ -67,14 +70,18 @@ class ServiceUser(db.Model):
 
 	@property
 	def effective_remailer_mode(self):
+		if self.remailer_overwrite_mode is not None:
+			return self.get_effective_remailer_mode(self.remailer_overwrite_mode)
+		return self.get_effective_remailer_mode(self.service.remailer_mode)
+
+	def get_effective_remailer_mode(self, remailer_mode):
+		'''Apply global remailer config to remailer_mode (overwrite or service mode)'''
 		if not remailer.configured:
 			return RemailerMode.DISABLED
 		if current_app.config['REMAILER_LIMIT_TO_USERS'] is not None:
 			if self.user.loginname not in current_app.config['REMAILER_LIMIT_TO_USERS']:
 				return RemailerMode.DISABLED
-		if self.remailer_overwrite_mode is not None:
-			return self.remailer_overwrite_mode
-		return self.service.remailer_mode
+		return remailer_mode
 
 	service_email_id = Column(Integer(), ForeignKey('user_email.id', onupdate='CASCADE', ondelete='SET NULL'))
 	service_email = relationship('UserEmail')
@@ -107,6 +114,37 @@ class ServiceUser(db.Model):
 		# result is (service_id, user_id), i.e. our primary key
 		return cls.query.get(result)
 
+	@classmethod
+	def get_by_remailer_emails(cls, addresses):
+		'''Batch version of get_by_remailer_email
+
+		Returns a dict that maps each address to a ServiceUser object or None.
+		Everything required for real_email is loaded with a constant number of
+		queries.'''
+		# pylint: disable=no-member
+		results = {address: None for address in addresses}
+		if not remailer.configured:
+			return results
+		keys = {address: remailer.parse_address(address) for address in addresses}
+		keys = {address: key for address, key in keys.items() if key is not None}
+		if not keys:
+			return results
+		# Filtering for both id sets returns a superset of the requested pairs,
+		# but works on all databases and with indexes.
+		query = cls.query.filter(
+			cls.service_id.in_({service_id for service_id, _ in keys.values()}),
+			cls.user_id.in_({user_id for _, user_id in keys.values()}),
+		).options(
+			db.joinedload(cls.service),
+			db.joinedload(cls.service_email),
+			db.joinedload(cls.user).joinedload(User.primary_email),
+			db.joinedload(cls.user).selectinload(User.groups),
+		)
+		service_users = {(service_user.service_id, service_user.user_id): service_user for service_user in query}
+		for address, key in keys.items():
+			results[address] = service_users.get(tuple(key))
+		return results
+
 	# E-Mail address as seen by the service
 	@property
 	def email(self):
@@ -116,6 +154,15 @@ class ServiceUser(db.Model):
 			return remailer.build_v2_address(self.service_id, self.user_id)
 		return self.real_email
 
+	def get_email(self, remailer_mode, real_email):
+		'''Same as email, but based on the columns added by add_email_columns'''
+		remailer_mode = self.get_effective_remailer_mode(remailer_mode)
+		if remailer_mode == RemailerMode.ENABLED_V1:
+			return remailer.build_v1_address(self.service_id, self.user_id)
+		if remailer_mode == RemailerMode.ENABLED_V2:
+			return remailer.build_v2_address(self.service_id, self.user_id)
+		return real_email
+
 	# User.primary_email and ServiceUser.service_email can only be set to
 	# verified addresses, so this should always return True
 	@property
@@ -127,14 +174,15 @@ class ServiceUser(db.Model):
 		return self.user.primary_email.verified
 
 	@classmethod
-	def filter_query_by_email(cls, query, email):
-		'''Filter query of ServiceUser by ServiceUser.email'''
+	def join_email_expressions(cls, query):
+		'''Join everything required to compute email-related attributes in SQL
+
+		Returns the modified query of ServiceUser and a dict with SQL
+		expressions for "remailer_mode" (coalesce of remailer_overwrite_mode and
+		the service's remailer_mode), "has_access", "has_email_preferences" and
+		"real_email".'''
 		# pylint completely fails to understand SQLAlchemy's query functions
 		# pylint: disable=no-member,invalid-name,singleton-comparison
-		service_user = cls.get_by_remailer_email(email)
-		if service_user and service_user.email == email:
-			return query.filter(cls.user_id == service_user.user_id, cls.service_id == service_user.service_id)
-
 		AliasedUser = db.aliased(User)
 		AliasedPrimaryEmail = db.aliased(UserEmail)
 		AliasedServiceEmail = db.aliased(UserEmail)
@@ -146,18 +194,6 @@ class ServiceUser(db.Model):
 		query = query.outerjoin(cls.service_email.of_type(AliasedServiceEmail))
 		query = query.join(cls.service.of_type(AliasedService))
 
-		remailer_enabled = db.case(
-			whens=[
-				(db.not_(remailer.configured), False),
-				(
-					db.not_(AliasedUser.loginname.in_(current_app.config['REMAILER_LIMIT_TO_USERS']))
-						if current_app.config['REMAILER_LIMIT_TO_USERS'] is not None else db.and_(False),
-					False
-				),
-				(cls.remailer_overwrite_mode != None, cls.remailer_overwrite_mode != RemailerMode.DISABLED)
-			],
-			else_=(AliasedService.remailer_mode != RemailerMode.DISABLED)
-		)
 		has_access = db.or_(
 			db.not_(AliasedService.limit_access),
 			db.exists().where(db.and_(
@@ -169,14 +205,57 @@ class ServiceUser(db.Model):
 			has_access,
 			AliasedService.enable_email_preferences,
 		)
-		real_email_matches = db.case(
+		real_email = db.case(
 			whens=[
-				# pylint: disable=singleton-comparison
-				(db.and_(has_email_preferences, cls.service_email != None), AliasedServiceEmail.address == email),
+				(db.and_(has_email_preferences, cls.service_email != None), AliasedServiceEmail.address),
 			],
-			else_=(AliasedPrimaryEmail.address == email)
+			else_=AliasedPrimaryEmail.address
+		)
+		return query, {
+			'user': AliasedUser,
+			'service': AliasedService,
+			'remailer_mode': db.func.coalesce(cls.remailer_overwrite_mode, AliasedService.remailer_mode),
+			'has_access': has_access,
+			'has_email_preferences': has_email_preferences,
+			'real_email': real_email,
+		}
+
+	@classmethod
+	def add_email_columns(cls, query):
+		'''Add columns "remailer_mode", "has_access" and "real_email" to query of ServiceUser
+
+		Pass the values to get_email to get the same result as with email, but
+		without loading relationships or scanning group lists per object.'''
+		query, expressions = cls.join_email_expressions(query)
+		return query.add_columns(
+			expressions['remailer_mode'].label('remailer_mode'),
+			expressions['has_access'].label('has_access'),
+			expressions['real_email'].label('real_email'),
 		)
-		return query.filter(db.and_(db.not_(remailer_enabled), real_email_matches))
+
+	@classmethod
+	def filter_query_by_email(cls, query, email):
+		'''Filter query of ServiceUser by ServiceUser.email'''
+		# pylint completely fails to understand SQLAlchemy's query functions
+		# pylint: disable=no-member,singleton-comparison
+		service_user = cls.get_by_remailer_email(email)
+		if service_user and service_user.email == email:
+			return query.filter(cls.user_id == service_user.user_id, cls.service_id == service_user.service_id)
+
+		query, expressions = cls.join_email_expressions(query)
+		remailer_enabled = db.case(
+			whens=[
+				(db.not_(remailer.configured), False),
+				(
+					db.not_(expressions['user'].loginname.in_(current_app.config['REMAILER_LIMIT_TO_USERS']))
+						if current_app.config['REMAILER_LIMIT_TO_USERS'] is not None else db.and_(False),
+					False
+				),
+				(cls.remailer_overwrite_mode != None, cls.remailer_overwrite_mode != RemailerMode.DISABLED)
+			],
+			else_=(expressions['service'].remailer_mode != RemailerMode.DISABLED)
+		)
+		return query.filter(db.and_(db.not_(remailer_enabled), expressions['real_email'] == email))
 
 @db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
 def create_service_users(session, flush_context): # pylint: disable=unused-argument
@@ -194,8 +273,18 @@ def create_service_users(session, flush_context): # pylint: disable=unused-argum
 		))
 	))
 
+# Bump GenerationCounter.directory on any change to data exposed via the
+# getusers/getgroups API endpoints. Changes to user_groups are covered by
+# User.groups/Group.members marking the respective objects as dirty.
+@db.event.listens_for(db.Session, 'after_flush') # pylint: disable=no-member
+def bump_directory_generation(session, flush_context): # pylint: disable=unused-argument
+	for obj in itertools.chain(session.new, session.dirty, session.deleted):
+		if isinstance(obj, (User, UserEmail, Group, Service, ServiceUser)):
+			GenerationCounter.directory.bump()
+			return
+
 # On databases with write concurrency (i.e. everything but SQLite), the
-# after_flush handler above is racy. So in rare cases ServiceUser objects
+# create_service_users handler above is racy. So in rare cases ServiceUser objects
 # might be missing.
 @cleanup_task.handler
 def create_missing_service_users():
@@ -215,73 +304,152 @@ def create_missing_service_users():
 # the SERVICES config key. It is planned to gradually extend the Service model
 # in order to finally replace the config-defined services.
 
-def get_language_specific(data, field_name, default =''):
-	return data.get(field_name + '_' + get_locale().language, data.get(field_name, default))
+def get_language_specific(data, field_name, default ='', language=None):
+	if language is None:
+		language = get_locale().language
+	return data.get(field_name + '_' + language, data.get(field_name, default))
+
+def compile_required_group(required_group):
+	'''Convert a required_group value (see User.has_permission) to a tuple of
+	frozensets (any set must be a subset of the user's groups) or None'''
+	if not required_group:
+		return None
+	if isinstance(required_group, str):
+		required_group = [required_group]
+	return tuple(frozenset([group_set] if isinstance(group_set, str) else group_set) for group_set in required_group)
+
+def check_required_group(requirement, group_names):
+	if requirement is None:
+		return True
+	if group_names is None:
+		return False
+	return any(group_set <= group_names for group_set in requirement)
 
 # pylint: disable=too-many-branches
-def get_services(user=None):
-	if not user and not current_app.config['SERVICES_PUBLIC']:
-		return []
-	services = []
-	for service_data in current_app.config['SERVICES']:
-		service_title = get_language_specific(service_data, 'title')
+def compile_services(services_config, language):
+	'''Precompile SERVICES config for a language
+
+	Language-specific fields are resolved, entries that are never displayed
+	are dropped and required_group values are converted with
+	compile_required_group.'''
+	compiled = []
+	for service_data in services_config:
+		service_title = get_language_specific(service_data, 'title', language=language)
 		if not service_title:
 			continue
-		service_description = get_language_specific(service_data, 'description')
 		service = {
 			'title': service_title,
 			'subtitle': service_data.get('subtitle', ''),
-			'description': service_description,
+			'description': get_language_specific(service_data, 'description', language=language),
 			'url': service_data.get('url', ''),
 			'logo_url': service_data.get('logo_url', ''),
-			'has_access': True,
-			'permission': '',
+			'required_group': compile_required_group(service_data.get('required_group')),
+			'confidential': service_data.get('confidential', False),
+			'permission_levels': [],
 			'groups': [],
 			'infos': [],
 			'links': [],
 		}
-		if service_data.get('required_group'):
-			if not user or not user.has_permission(service_data['required_group']):
-				service['has_access'] = False
 		for permission_data in service_data.get('permission_levels', []):
-			if permission_data.get('required_group'):
-				if not user or not user.has_permission(permission_data['required_group']):
-					continue
-			if not permission_data.get('name'):
-				continue
-			service['has_access'] = True
-			service['permission'] = permission_data['name']
-		if service_data.get('confidential', False) and not service['has_access']:
-			continue
+			if permission_data.get('name'):
+				service['permission_levels'].append((compile_required_group(permission_data.get('required_group')), permission_data['name']))
 		for group_data in service_data.get('groups', []):
-			if group_data.get('required_group'):
-				if not user or not user.has_permission(group_data['required_group']):
-					continue
-			if not group_data.get('name'):
-				continue
-			service['groups'].append(group_data)
+			if group_data.get('name'):
+				service['groups'].append((compile_required_group(group_data.get('required_group')), group_data))
 		for info_data in service_data.get('infos', []):
-			if info_data.get('required_group'):
-				if not user or not user.has_permission(info_data['required_group']):
-					continue
-			info_title = get_language_specific(info_data, 'title')
-			info_html = get_language_specific(info_data, 'html')
+			info_title = get_language_specific(info_data, 'title', language=language)
+			info_html = get_language_specific(info_data, 'html', language=language)
 			if not info_title or not info_html:
 				continue
-			info_button_text = get_language_specific(info_data, 'button_text', info_title)
-			info = {
+			service['infos'].append((compile_required_group(info_data.get('required_group')), {
 				'title': info_title,
-				'button_text': info_button_text,
+				'button_text': get_language_specific(info_data, 'button_text', info_title, language=language),
 				'html': info_html,
-				'id': '%d-%d'%(len(services), len(service['infos'])),
-			}
-			service['infos'].append(info)
+			}))
 		for link_data in service_data.get('links', []):
-			if link_data.get('required_group'):
-				if not user or not user.has_permission(link_data['required_group']):
-					continue
-			if not link_data.get('url') or not link_data.get('title'):
-				continue
-			service['links'].append(link_data)
+			if link_data.get('url') and link_data.get('title'):
+				service['links'].append((compile_required_group(link_data.get('required_group')), link_data))
+		compiled.append(service)
+	return compiled
+
+def get_required_group_names(compiled_services):
+	'''Return the names of all groups that affect the result of evaluate_services'''
+	requirements = []
+	for service in compiled_services:
+		requirements.append(service['required_group'])
+		for key in ('permission_levels', 'groups', 'infos', 'links'):
+			requirements += [requirement for requirement, _ in service[key]]
+	return frozenset(
+		group_name
+		for requirement in requirements if requirement is not None
+		for group_set in requirement
+		for group_name in group_set
+	)
+
+def evaluate_services(compiled_services, group_names):
+	services = []
+	for compiled_service in compiled_services:
+		has_access = check_required_group(compiled_service['required_group'], group_names)
+		permission = ''
+		for requirement, name in compiled_service['permission_levels']:
+			if check_required_group(requirement, group_names):
+				has_access = True
+				permission = name
+		if compiled_service['confidential'] and not has_access:
+			continue
+		service = {
+			key: compiled_service[key]
+			for key in ('title', 'subtitle', 'description', 'url', 'logo_url')
+		}
+		service['has_access'] = has_access
+		service['permission'] = permission
+		service['groups'] = [group_data for requirement, group_data in compiled_service['groups'] if check_required_group(requirement, group_names)]
+		service['infos'] = []
+		for requirement, info in compiled_service['infos']:
+			if check_required_group(requirement, group_names):
+				service['infos'].append(dict(info, id='%d-%d'%(len(services), len(service['infos']))))
+		service['links'] = [link_data for requirement, link_data in compiled_service['links'] if check_required_group(requirement, group_names)]
 		services.append(service)
 	return services
+
+class ServicesCache:
+	'''Per-app cache for get_services
+
+	Holds the compiled SERVICES config per language and an LRU cache of
+	get_services results keyed by language and the user's relevant groups
+	(i.e. the intersection with groups referenced in SERVICES). The cache is
+	reset if the SERVICES config object is replaced.'''
+	def __init__(self, services_config):
+		self.services_config = services_config
+		self.compiled = {}
+		self.required_group_names = {}
+		self.results = LRUCache(maxsize=256)
+
+	@classmethod
+	def get(cls):
+		services_config = current_app.config['SERVICES']
+		cache = current_app.extensions.get('uffd_services_cache')
+		if cache is None or cache.services_config is not services_config:
+			if cache is not None:
+				cache.results.discard()
+			cache = current_app.extensions['uffd_services_cache'] = cls(services_config)
+		return cache
+
+	def get_services(self, language, group_names):
+		if language not in self.compiled:
+			self.compiled[language] = compile_services(self.services_config, language)
+			self.required_group_names[language] = get_required_group_names(self.compiled[language])
+		if group_names is not None:
+			group_names = group_names & self.required_group_names[language]
+		key = (language, group_names)
+		services = self.results.get(key)
+		if services is None:
+			services = evaluate_services(self.compiled[language], group_names)
+			self.results.set(key, services)
+		return services
+
+# The returned list is shared between requests and must not be modified
+def get_services(user=None):
+	if not user and not current_app.config['SERVICES_PUBLIC']:
+		return []
+	return ServicesCache.get().get_services(get_locale().language, user.group_names if user else None)
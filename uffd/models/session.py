@@ -1,6 +1,8 @@
 import datetime
 import secrets
 import enum
+import threading
+import time
 
 from flask import current_app
 from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Enum, Text, Boolean
@@ -91,6 +93,76 @@ class Session(db.Model):
 				return platform
 		return _('Unknown')
 
+class SessionActivityWriter:
+	'''Write-behind buffer for Session.last_used/ip_address/user_agent
+
+	Updates are collected in memory and written with a single executemany
+	UPDATE every SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS by a background
+	thread. This keeps write transactions out of the request path. If the
+	interval is 0, updates are written immediately.
+
+	Since last_used is only used for session expiry (with a lifetime of days
+	by default), the delay is not relevant. Updates that are still pending
+	when the process is killed are lost.'''
+	def __init__(self, app):
+		self.app = app
+		self.lock = threading.Lock()
+		self.pending = {}
+		self.thread = None
+
+	@classmethod
+	def get(cls):
+		if 'uffd_session_activity_writer' not in current_app.extensions:
+			current_app.extensions['uffd_session_activity_writer'] = cls(current_app._get_current_object()) # pylint: disable=protected-access
+		return current_app.extensions['uffd_session_activity_writer']
+
+	def record(self, session_id, ip_address, user_agent):
+		update = {'_id': session_id, 'last_used': datetime.datetime.utcnow(), 'ip_address': ip_address, 'user_agent': user_agent}
+		if not self.app.config['SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS']:
+			self.write([update])
+			return
+		with self.lock:
+			self.pending[session_id] = update
+			# Started lazily, so that processes forked after app creation (e.g.
+			# uWSGI workers) get their own thread
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+
+	def get_pending_last_used(self, session_id):
+		with self.lock:
+			update = self.pending.get(session_id)
+		return update['last_used'] if update else None
+
+	def flush(self):
+		with self.lock:
+			updates = list(self.pending.values())
+			self.pending.clear()
+		if updates:
+			self.write(updates)
+
+	@staticmethod
+	def write(updates):
+		db.session.execute(
+			db.update(Session.__table__).where(Session.__table__.c.id == db.bindparam('_id')).values(
+				last_used=db.bindparam('last_used'),
+				ip_address=db.bindparam('ip_address'),
+				user_agent=db.bindparam('user_agent'),
+			),
+			updates
+		)
+		db.session.commit()
+
+	def run(self):
+		while True:
+			time.sleep(self.app.config['SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS'])
+			with self.app.app_context():
+				try:
+					self.flush()
+				except Exception: # pylint: disable=broad-except
+					db.session.rollback()
+					self.app.logger.exception('Writing session activity failed')
+
 # Device login provides a convenient and secure way to log into SSO-enabled
 # services on a secondary device without entering the user password or
 # completing 2FA challenges.
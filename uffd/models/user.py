@@ -181,29 +181,61 @@ class User(db.Model):
 		if primary_email_address is not None:
 			self.primary_email = UserEmail(address=primary_email_address, verified=True)
 
+	@classmethod
+	def list_options(cls):
+		'''Query options to eager-load everything the user list (user.index) shows'''
+		return [db.selectinload(cls.roles)]
+
 	@property
 	def unix_gid(self):
 		return current_app.config['USER_GID']
 
+	# (frozenset of group ids, frozenset of group names) or None, see
+	# _get_group_sets. Not a column, so objects loaded from the database do not
+	# have it until it is set.
+	_group_sets = None
+
+	def _get_group_sets(self):
+		'''Return frozensets of ids and names of the user's groups
+
+		The result is kept on the object until User.groups, Group.members or a
+		group name is modified or the object is expired (e.g. on commit). Since
+		objects are scoped to the request's database session, repeated ACL checks
+		within a request do not require any further queries.'''
+		if self._group_sets is not None:
+			return self._group_sets
+		if self.id is None or 'groups' not in db.inspect(self).unloaded:
+			rows = [(group.id, group.name) for group in self.groups]
+		else:
+			# Unlike loading self.groups this does not construct Group objects
+			rows = db.session.query(Group.id, Group.name).join(user_groups).filter(user_groups.c.user_id == self.id).all()
+		self._group_sets = (frozenset(row[0] for row in rows), frozenset(row[1] for row in rows))
+		return self._group_sets
+
+	@property
+	def group_ids(self):
+		return self._get_group_sets()[0]
+
+	@property
+	def group_names(self):
+		return self._get_group_sets()[1]
+
 	def is_in_group(self, name):
 		if not name:
 			return True
-		for group in self.groups:
-			if group.name == name:
-				return True
-		return False
+		return name in self.group_names
 
 	def has_permission(self, required_group=None):
 		if not required_group:
 			return True
-		group_names = {group.name for group in self.groups}
+		group_names = self.group_names
 		group_sets = required_group
 		if isinstance(group_sets, str):
 			group_sets = [group_sets]
 		for group_set in group_sets:
 			if isinstance(group_set, str):
 				group_set = [group_set]
-			if set(group_set) - group_names == set():
+			if group_names.issuperset(group_set):
 				return True
 		return False
 
@@ -407,3 +439,37 @@ class Group(db.Model):
 				return False
 		self.name = value
 		return True
+
+# Replacing a collection also triggers append/remove events for the changed
+# items, including the ones of the backref on the other side.
+def reset_group_sets(user):
+	# Expire events may be emitted for objects that were already garbage collected
+	if user is not None:
+		user._group_sets = None # pylint: disable=protected-access
+
+@db.event.listens_for(User.groups, 'append')
+@db.event.listens_for(User.groups, 'remove')
+def user_groups_changed(target, value, initiator): # pylint: disable=unused-argument
+	reset_group_sets(target)
+
+@db.event.listens_for(Group.members, 'append')
+@db.event.listens_for(Group.members, 'remove')
+def group_members_changed(target, value, initiator): # pylint: disable=unused-argument
+	reset_group_sets(value)
+
+@db.event.listens_for(Group.name, 'set')
+def group_name_changed(target, value, oldvalue, initiator): # pylint: disable=unused-argument
+	session = db.object_session(target)
+	if session is None:
+		return
+	for obj in session.identity_map.values():
+		if isinstance(obj, User):
+			reset_group_sets(obj)
+
+@db.event.listens_for(User, 'expire')
+def user_expired(target, attrs): # pylint: disable=unused-argument
+	reset_group_sets(target)
+
+@db.event.listens_for(User, 'refresh')
+def user_refreshed(target, context, attrs): # pylint: disable=unused-argument
+	reset_group_sets(target)
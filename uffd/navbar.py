@@ -1,7 +1,34 @@
+import functools
+
+from flask import request, has_request_context
+
+def request_memoized(func):
+	'''Decorator that caches the result of a function without arguments for
+	the current request
+
+	Used for ACL checks that are evaluated by before_request hooks as well as
+	(multiple times) for rendering the navbar. Results are keyed by
+	request.user, so logins and logouts within a request are handled.'''
+	@functools.wraps(func)
+	def wrapper():
+		if not has_request_context():
+			return func()
+		results = request.__dict__.setdefault('memoized_results', {})
+		key = (func, getattr(request, 'user', None))
+		if key not in results:
+			results[key] = func()
+		return results[key]
+	return wrapper
+
 def setup_navbar(app, positions):
 	app.navbarPositions = positions
 	app.navbarList = []
-	app.jinja_env.globals['getnavbar'] = lambda: [n for n in app.navbarList if n['visible']()]
+
+	@request_memoized
+	def getnavbar():
+		return [n for n in app.navbarList if n['visible']()]
+
+	app.jinja_env.globals['getnavbar'] = getnavbar
 
 # iconlib can be 'bootstrap'
 # ( see: http://getbootstrap.com/components/#glyphicons )
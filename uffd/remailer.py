@@ -1,8 +1,39 @@
+import functools
+
 from flask import current_app
 import itsdangerous
 
 from uffd.utils import nopad_b32decode, nopad_b32encode, nopad_urlsafe_b64decode, nopad_urlsafe_b64encode
 
+class KeyCachingSigner(itsdangerous.Signer):
+	'''Signer that derives each key only once instead of on every call'''
+	def derive_key(self, *args): # pylint: disable=arguments-differ
+		# itsdangerous>=2.0 passes the secret_key argument when verifying
+		# signatures, older versions (Debian Bullseye) do not have it
+		derived_keys = self.__dict__.setdefault('_derived_keys', {})
+		if args not in derived_keys:
+			derived_keys[args] = super().derive_key(*args)
+		return derived_keys[args]
+
+class CachingURLSafeSerializer(itsdangerous.URLSafeSerializer):
+	'''URLSafeSerializer that reuses its signer objects'''
+	def make_signer(self, salt=None):
+		signers = self.__dict__.setdefault('_signers', {})
+		if salt not in signers:
+			signers[salt] = super().make_signer(salt)
+		return signers[salt]
+
+@functools.lru_cache(maxsize=8)
+def get_cached_serializer(secret):
+	return CachingURLSafeSerializer(secret, salt='remailer_address_v1', signer=KeyCachingSigner)
+
+@functools.lru_cache(maxsize=8)
+def get_normalized_domains(domain, old_domains):
+	domains = {domain.lower().strip() for domain in old_domains}
+	if domain:
+		domains.add(domain.lower().strip())
+	return frozenset(domains)
+
 class Remailer:
 	'''The remailer feature improves user privacy by hiding real mail addresses
 	from services and instead providing them with autogenerated pseudonymous
@@ -18,25 +49,33 @@ class Remailer:
 	def configured(self):
 		return bool(current_app.config['REMAILER_DOMAIN'])
 
+	# Serializers and the domain set are cached per config value, so changes to
+	# the config (e.g. in tests) are still picked up.
 	def get_serializer(self):
 		secret = current_app.config['REMAILER_SECRET_KEY'] or current_app.secret_key
-		return itsdangerous.URLSafeSerializer(secret, salt='remailer_address_v1')
+		return get_cached_serializer(secret)
 
 	def build_v1_address(self, service_id, user_id):
 		payload = self.get_serializer().dumps([service_id, user_id])
 		return 'v1-' + payload + '@' + current_app.config['REMAILER_DOMAIN']
 
 	def build_v2_address(self, service_id, user_id):
-		data, sign = self.get_serializer().dumps([service_id, user_id]).split('.', 1)
-		data = nopad_b32encode(nopad_urlsafe_b64decode(data)).decode().lower()
-		sign = nopad_b32encode(nopad_urlsafe_b64decode(sign)).decode().lower()
-		payload = data + '-' + sign
-		return 'v2-' + payload + '@' + current_app.config['REMAILER_DOMAIN']
+		return self.build_v2_addresses([(service_id, user_id)])[0]
+
+	def build_v2_addresses(self, pairs):
+		'''Return list of v2 addresses for a list of (service_id, user_id) pairs'''
+		serializer = self.get_serializer()
+		suffix = '@' + current_app.config['REMAILER_DOMAIN']
+		addresses = []
+		for service_id, user_id in pairs:
+			data, sign = serializer.dumps([service_id, user_id]).split('.', 1)
+			data = nopad_b32encode(nopad_urlsafe_b64decode(data)).decode().lower()
+			sign = nopad_b32encode(nopad_urlsafe_b64decode(sign)).decode().lower()
+			addresses.append('v2-' + data + '-' + sign + suffix)
+		return addresses
 
 	def is_remailer_domain(self, domain):
-		domains = {domain.lower().strip() for domain in current_app.config['REMAILER_OLD_DOMAINS']}
-		if current_app.config['REMAILER_DOMAIN']:
-			domains.add(current_app.config['REMAILER_DOMAIN'].lower().strip())
+		domains = get_normalized_domains(current_app.config['REMAILER_DOMAIN'], tuple(current_app.config['REMAILER_OLD_DOMAINS']))
 		return domain.lower().strip() in domains
 
 	def parse_v1_payload(self, payload):
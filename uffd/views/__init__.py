@@ -3,9 +3,11 @@ from werkzeug.exceptions import Forbidden
 
 from uffd.secure_redirect import secure_local_redirect
 
-from . import session, selfservice, signup, oauth2, user, group, service, role, invite, api, mail, rolemod
+from . import session, selfservice, signup, oauth2, user, group, service, role, invite, api, apiv2, mail, rolemod
 
 def init_app(app):
+	app.request_class = session.LazySessionRequest
+
 	@app.errorhandler(403)
 	def handle_403(error):
 		return render_template('403.html', description=error.description if error.description != Forbidden.description else None), 403
@@ -33,6 +35,7 @@ def init_app(app):
 	app.register_blueprint(role.bp)
 	app.register_blueprint(invite.bp)
 	app.register_blueprint(api.bp)
+	app.register_blueprint(apiv2.bp)
 	app.register_blueprint(mail.bp)
 	app.register_blueprint(rolemod.bp)
 
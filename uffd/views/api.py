@@ -1,17 +1,55 @@
 import functools
+import hashlib
+import hmac
+import secrets
 
-from flask import Blueprint, jsonify, request, abort, Response
+from flask import Blueprint, jsonify, request, abort, Response, json, stream_with_context
 
 from uffd.database import db
+from uffd.cache import LRUCache
 from uffd.models import (
 	User, ServiceUser, Group, Mail, MailReceiveAddress, MailDestinationAddress, APIClient,
-	RecoveryCodeMethod, TOTPMethod, WebauthnMethod, Invite, Role, Service )
+	RecoveryCodeMethod, TOTPMethod, WebauthnMethod, Invite, Role, Service, GenerationCounter,
+	ChangelogEntry, ChangelogObjectType, ChangelogAction )
 from .session import login_ratelimit
 
 bp = Blueprint('api', __name__, template_folder='templates', url_prefix='/api/v1/')
 
+# Maps (auth_username, HMAC of the password) to (client id, permissions) of
+# successfully authenticated clients. This skips the lookup and the (slow)
+# password verification for clients that make many requests. Changes to
+# API clients clear the cache of the current process on commit. Other
+# processes pick up changes after the ttl.
+auth_cache = LRUCache(maxsize=256, ttl=30)
+auth_cache.clear_on_commit(APIClient, Service)
+# Random per-process key, so cache keys are useless outside of the process
+auth_cache_key = secrets.token_bytes(32)
+
+def get_auth_cache_key():
+	password = request.authorization.password
+	return (request.authorization.username, hmac.new(auth_cache_key, password.encode(), hashlib.sha256).digest())
+
+def authenticate_api_client():
+	'''Return (client id, permissions) for the credentials of the current request or None'''
+	username = request.authorization.username
+	password = request.authorization.password
+	cache_key = get_auth_cache_key()
+	result = auth_cache.get(cache_key)
+	if result is not None:
+		return result
+	client = APIClient.query.filter_by(auth_username=username).first()
+	if not client:
+		return None
+	if not client.auth_password.verify(password):
+		return None
+	if client.auth_password.needs_rehash:
+		client.auth_password = password
+		db.session.commit()
+	result = (client.id, client.permissions)
+	auth_cache.set(cache_key, result)
+	return result
+
 def apikey_required(permission=None):
-	# pylint: disable=too-many-return-statements
 	if permission is not None:
 		assert APIClient.permission_exists(permission)
 	def wrapper(func):
@@ -19,21 +57,63 @@ def apikey_required(permission=None):
 		def decorator(*args, **kwargs):
 			if not request.authorization or not request.authorization.password:
 				return 'Unauthorized', 401, {'WWW-Authenticate': ['Basic realm="api"']}
-			client = APIClient.query.filter_by(auth_username=request.authorization.username).first()
-			if not client:
+			result = authenticate_api_client()
+			if result is None:
 				return 'Unauthorized', 401, {'WWW-Authenticate': ['Basic realm="api"']}
-			if not client.auth_password.verify(request.authorization.password):
+			client_id, permissions = result
+			request.api_client = APIClient.query.get(client_id)
+			if request.api_client is None:
+				# Client was deleted by another process after it was cached
+				auth_cache.pop(get_auth_cache_key())
 				return 'Unauthorized', 401, {'WWW-Authenticate': ['Basic realm="api"']}
-			if client.auth_password.needs_rehash:
-				client.auth_password = request.authorization.password
-				db.session.commit()
-			if permission is not None and not client.has_permission(permission):
+			if permission is not None and permission not in permissions:
 				return 'Forbidden', 403
-			request.api_client = client
 			return func(*args, **kwargs)
 		return decorator
 	return wrapper
 
+snapshot_cache = LRUCache(maxsize=256)
+
+def directory_snapshot(func):
+	'''Cache unfiltered responses per service until the directory changes
+
+	Responses get a strong ETag, so unchanged polls are answered with 304
+	based on the cached snapshot without any ORM queries. Snapshots are
+	invalidated by GenerationCounter.directory. Filtered requests are passed
+	through unmodified.'''
+	@functools.wraps(func)
+	def decorator(*args, **kwargs):
+		if request.values:
+			return func(*args, **kwargs)
+		# Read the generation before building the response, so that concurrent
+		# changes cause the snapshot to be rebuilt on the next request.
+		generation = GenerationCounter.directory.value
+		key = (request.endpoint, request.api_client.service_id)
+		snapshot = snapshot_cache.get(key)
+		if snapshot is None or snapshot[0] != generation:
+			data = func(*args, **kwargs).get_data()
+			snapshot = (generation, data, hashlib.sha256(data).hexdigest())
+			snapshot_cache.set(key, snapshot)
+		_, data, etag = snapshot
+		resp = Response(data, mimetype='application/json')
+		resp.set_etag(etag)
+		return resp.make_conditional(request)
+	return decorator
+
+def stream_json_list(query, generate_func, yield_per=500):
+	'''Return a streaming response with a JSON list of generate_func(obj) for each object in query
+
+	Objects are loaded in batches of yield_per, so memory usage does not
+	depend on the size of the result. Queries must not eager-load collections
+	with joinedload (use selectinload instead).'''
+	def generate():
+		prefix = '['
+		for obj in query.yield_per(yield_per):
+			yield prefix + json.dumps(generate_func(obj))
+			prefix = ','
+		yield '[]' if prefix == '[' else ']'
+	return Response(stream_with_context(generate()), mimetype='application/json')
+
 def generate_group_dict(group):
 	return {
 		'id': group.unix_gid,
@@ -47,6 +127,7 @@ def generate_group_dict(group):
 
 @bp.route('/getgroups', methods=['GET', 'POST'])
 @apikey_required('users')
+@directory_snapshot
 def getgroups():
 	if len(request.values) > 1:
 		abort(400)
@@ -68,19 +149,20 @@ def getgroups():
 	# Single-result queries perform better without eager loading
 	if key is None or key == 'member':
 		query = query.options(db.selectinload(Group.members))
-	return jsonify([generate_group_dict(group) for group in query])
+	return stream_json_list(query, generate_group_dict)
 
-def generate_user_dict(service_user):
+def generate_user_dict(service_user, email=None):
 	return {
 		'id': service_user.user.unix_uid,
 		'loginname': service_user.user.loginname,
-		'email': service_user.email,
+		'email': service_user.email if email is None else email,
 		'displayname': service_user.user.displayname,
 		'groups': [group.name for group in service_user.user.groups]
 	}
 
 @bp.route('/getusers', methods=['GET', 'POST'])
 @apikey_required('users')
+@directory_snapshot
 def getusers():
 	if len(request.values) > 1:
 		abort(400)
@@ -105,8 +187,10 @@ def getusers():
 	if key is None or key == 'group':
 		# pylint: disable=no-member
 		query = query.options(db.joinedload(ServiceUser.user).selectinload(User.groups))
-		query = query.options(db.joinedload(ServiceUser.user).joinedload(User.primary_email))
-	return jsonify([generate_user_dict(user) for user in query])
+	# Computing emails in SQL avoids loading service, emails and groups (for
+	# the access check) of each user
+	query = ServiceUser.add_email_columns(query)
+	return stream_json_list(query, lambda row: generate_user_dict(row[0], row[0].get_email(row.remailer_mode, row.real_email)))
 
 @bp.route('/checkpassword', methods=['POST'])
 @apikey_required('checkpassword')
@@ -157,7 +241,115 @@ def getmails():
 		query = query.filter(Mail.destinations.any(MailDestinationAddress.address==values[0]))
 	else:
 		abort(400)
-	return jsonify([generate_mail_dict(mail) for mail in query])
+	query = query.options(db.selectinload(Mail._receivers), db.selectinload(Mail._destinations)) # pylint: disable=protected-access
+	return stream_json_list(query, generate_mail_dict)
+
+def summarize_changes(entries):
+	'''Reduce changelog entries (ordered by id) to created/updated object ids and deleted keys'''
+	states = {}
+	for entry in entries:
+		state = states.setdefault(entry.object_id, {'created': False, 'exists': True, 'deleted_keys': []})
+		if entry.action == ChangelogAction.CREATED:
+			state['created'] = True
+			state['exists'] = True
+		elif entry.action == ChangelogAction.DELETED:
+			# Objects created and deleted since the cursor were never seen by the client
+			if not state['created']:
+				state['deleted_keys'].append(entry.object_key)
+			state['created'] = False
+			state['exists'] = False
+	created_ids = [object_id for object_id, state in states.items() if state['exists'] and state['created']]
+	updated_ids = [object_id for object_id, state in states.items() if state['exists'] and not state['created']]
+	deleted_keys = [key for state in states.values() for key in state['deleted_keys']]
+	return created_ids, updated_ids, deleted_keys
+
+def query_in_chunks(query, column, values, chunksize=500):
+	for i in range(0, len(values), chunksize):
+		yield from query.filter(column.in_(values[i:i+chunksize]))
+
+def generate_user_changes(created_ids, updated_ids, deleted_keys):
+	# pylint: disable=no-member
+	result = {'created': [], 'updated': [], 'deleted': [int(key) for key in deleted_keys]}
+	query = ServiceUser.query.filter_by(service=request.api_client.service).join(ServiceUser.user)
+	query = query.options(db.joinedload(ServiceUser.user).selectinload(User.groups))
+	query = query.options(db.joinedload(ServiceUser.user).joinedload(User.primary_email))
+	created_ids = set(created_ids)
+	# Users deleted after the cursor was determined are missing here. They
+	# are reported on the next request.
+	for service_user in query_in_chunks(query, ServiceUser.user_id, sorted(created_ids) + updated_ids):
+		if service_user.user.is_deactivated and request.api_client.service.hide_deactivated_users:
+			result['deleted'].append(service_user.user.unix_uid)
+		elif service_user.user_id in created_ids:
+			result['created'].append(generate_user_dict(service_user))
+		else:
+			result['updated'].append(generate_user_dict(service_user))
+	return result
+
+def generate_group_changes(created_ids, updated_ids, deleted_keys):
+	result = {'created': [], 'updated': [], 'deleted': [int(key) for key in deleted_keys]}
+	query = Group.query.options(db.selectinload(Group.members))
+	created_ids = set(created_ids)
+	for group in query_in_chunks(query, Group.id, sorted(created_ids) + updated_ids):
+		result['created' if group.id in created_ids else 'updated'].append(generate_group_dict(group))
+	return result
+
+def generate_mail_changes(created_ids, updated_ids, deleted_keys):
+	result = {'created': [], 'updated': [], 'deleted': deleted_keys}
+	query = Mail.query.options(db.selectinload(Mail._receivers), db.selectinload(Mail._destinations)) # pylint: disable=protected-access
+	created_ids = set(created_ids)
+	for mail in query_in_chunks(query, Mail.id, sorted(created_ids) + updated_ids):
+		result['created' if mail.id in created_ids else 'updated'].append(generate_mail_dict(mail))
+	return result
+
+# Incremental synchronization of users, groups and mails
+#
+# Clients first request the current cursor without the "since" parameter and
+# perform a full sync with getusers/getgroups/getmails. Afterwards they pass
+# the cursor of the previous response as "since" to receive all changes since
+# then. Deletions should be applied before creations/updates and creations and
+# updates should both be treated as upserts. Sections are only included if the
+# client has the respective permission ("users" for users and groups,
+# "mail_aliases" for mails).
+#
+# Changelog entries are deleted after API_CHANGES_RETENTION_DAYS. If entries
+# after the passed cursor were already deleted, 410 Gone is returned and the
+# client must perform a full sync.
+@bp.route('/changes', methods=['GET', 'POST'])
+@apikey_required()
+def changes():
+	# pylint: disable=no-member
+	sections = []
+	if request.api_client.has_permission('users'):
+		sections += [
+			('users', ChangelogObjectType.USER, generate_user_changes),
+			('groups', ChangelogObjectType.GROUP, generate_group_changes),
+		]
+	if request.api_client.has_permission('mail_aliases'):
+		sections.append(('mails', ChangelogObjectType.MAIL, generate_mail_changes))
+	if not sections:
+		return 'Forbidden', 403
+	if set(request.values.keys()) - {'since'} or len(request.values.getlist('since')) > 1:
+		abort(400)
+	cursor = ChangelogEntry.get_cursor()
+	if 'since' not in request.values:
+		return jsonify(cursor=cursor)
+	try:
+		since = int(request.values['since'])
+	except ValueError:
+		abort(400)
+	if since < 0:
+		abort(400)
+	if since > cursor or not ChangelogEntry.is_valid_cursor(since):
+		abort(410)
+	result = {'cursor': cursor}
+	for name, object_type, generate_func in sections:
+		entries = ChangelogEntry.query.filter(
+			ChangelogEntry.object_type == object_type,
+			ChangelogEntry.id > since,
+			ChangelogEntry.id <= cursor,
+		).order_by(ChangelogEntry.id)
+		result[name] = generate_func(*summarize_changes(entries))
+	return jsonify(result)
 
 @bp.route('/resolve-remailer', methods=['GET', 'POST'])
 @apikey_required('remailer')
@@ -172,6 +364,25 @@ def resolve_remailer():
 		return jsonify(address=None)
 	return jsonify(address=service_user.real_email)
 
+# Batch version of resolve-remailer: Pass up to REMAILER_BATCH_MAX_ADDRESSES
+# "orig_address" values and get an object that maps each of them to the real
+# address (or null). Larger batches are rejected with 400, since the lookup
+# loads all service users of the requested services and users combined.
+REMAILER_BATCH_MAX_ADDRESSES = 100
+
+@bp.route('/resolve-remailer-batch', methods=['GET', 'POST'])
+@apikey_required('remailer')
+def resolve_remailer_batch():
+	if list(request.values.keys()) != ['orig_address']:
+		abort(400)
+	if len(request.values.getlist('orig_address')) > REMAILER_BATCH_MAX_ADDRESSES:
+		abort(400)
+	service_users = ServiceUser.get_by_remailer_emails(request.values.getlist('orig_address'))
+	return jsonify(addresses={
+		address: service_user.real_email if service_user else None
+		for address, service_user in service_users.items()
+	})
+
 @bp.route('/metrics_prometheus', methods=['GET'])
 @apikey_required('metrics')
 def prometheus_metrics():
@@ -0,0 +1,166 @@
+from flask import Blueprint, jsonify, request, abort
+
+from uffd.database import db
+from uffd.models import User, ServiceUser, Group, Mail, MailReceiveAddress, MailDestinationAddress
+from .api import apikey_required
+
+bp = Blueprint('apiv2', __name__, template_folder='templates', url_prefix='/api/v2/')
+
+# Version 2 of the list endpoints with keyset pagination, combinable filters
+# and field selection. Parameters:
+#
+# - Filter parameters: All filters must match. Filters may be passed multiple
+#   times (except for "email"), in which case any of the values must match.
+# - after: Only return objects with a key greater than this value. Set this to
+#   "next" of the previous response to get the next page.
+# - limit: Maximum number of objects per page (default and maximum: 1000)
+# - fields: Comma-separated list of attributes to include (default: all)
+#
+# Responses have the form {"results": [...], "next": KEY}. "next" is null on
+# the last page. Results are ordered by their key (unix_uid for users,
+# unix_gid for groups and an internal id for mails).
+
+MAX_PAGE_SIZE = 1000
+
+def get_single_int_param(name, default=None, min_value=0):
+	values = request.values.getlist(name)
+	if not values:
+		return default
+	if len(values) != 1:
+		abort(400)
+	try:
+		value = int(values[0])
+	except ValueError:
+		abort(400)
+	if value < min_value:
+		abort(400)
+	return value
+
+def get_int_values(name):
+	try:
+		return [int(value) for value in request.values.getlist(name)]
+	except ValueError:
+		abort(400)
+
+def parse_params(filters, fields):
+	if not set(request.values.keys()) <= set(filters) | {'after', 'limit', 'fields'}:
+		abort(400)
+	if len(request.values.getlist('fields')) > 1:
+		abort(400)
+	if 'fields' not in request.values:
+		return fields
+	selected_fields = request.values['fields'].split(',')
+	if not set(selected_fields) <= set(fields):
+		abort(400)
+	return [name for name in fields if name in selected_fields]
+
+def paginate(query, key_column, key_func, generate_func):
+	after = get_single_int_param('after')
+	limit = get_single_int_param('limit', default=MAX_PAGE_SIZE, min_value=1)
+	if limit > MAX_PAGE_SIZE:
+		abort(400)
+	if after is not None:
+		query = query.filter(key_column > after)
+	# Fetching one additional object tells us if there is a next page
+	objs = query.order_by(key_column).limit(limit + 1).all()
+	next_key = key_func(objs[limit - 1]) if len(objs) > limit else None
+	return jsonify(results=[generate_func(obj) for obj in objs[:limit]], next=next_key)
+
+USER_FIELDS = ['id', 'loginname', 'email', 'displayname', 'groups']
+
+def generate_user_dict(service_user, fields):
+	getters = {
+		'id': lambda: service_user.user.unix_uid,
+		'loginname': lambda: service_user.user.loginname,
+		'email': lambda: service_user.email,
+		'displayname': lambda: service_user.user.displayname,
+		'groups': lambda: [group.name for group in service_user.user.groups],
+	}
+	return {name: getters[name]() for name in fields}
+
+@bp.route('/users', methods=['GET', 'POST'])
+@apikey_required('users')
+def users():
+	# pylint: disable=no-member
+	fields = parse_params(['id', 'loginname', 'email', 'group'], USER_FIELDS)
+	query = ServiceUser.query.filter_by(service=request.api_client.service).join(ServiceUser.user)
+	if request.api_client.service.hide_deactivated_users:
+		query = query.filter(db.not_(User.is_deactivated))
+	if 'id' in request.values:
+		query = query.filter(User.unix_uid.in_(get_int_values('id')))
+	if 'loginname' in request.values:
+		query = query.filter(User.loginname.in_(request.values.getlist('loginname')))
+	if 'group' in request.values:
+		query = query.filter(User.groups.any(Group.name.in_(request.values.getlist('group'))))
+	if 'email' in request.values:
+		if len(request.values.getlist('email')) != 1:
+			abort(400)
+		query = ServiceUser.filter_query_by_email(query, request.values['email'])
+	query = query.options(db.contains_eager(ServiceUser.user))
+	if 'groups' in fields:
+		query = query.options(db.contains_eager(ServiceUser.user).selectinload(User.groups))
+	if 'email' in fields:
+		query = query.options(db.contains_eager(ServiceUser.user).joinedload(User.primary_email))
+	return paginate(query, User.unix_uid, lambda service_user: service_user.user.unix_uid, lambda service_user: generate_user_dict(service_user, fields))
+
+GROUP_FIELDS = ['id', 'name', 'members']
+
+def generate_group_dict(group, fields):
+	getters = {
+		'id': lambda: group.unix_gid,
+		'name': lambda: group.name,
+		'members': lambda: [
+			user.loginname
+			for user in group.members
+			if not user.is_deactivated or not request.api_client.service.hide_deactivated_users
+		],
+	}
+	return {name: getters[name]() for name in fields}
+
+@bp.route('/groups', methods=['GET', 'POST'])
+@apikey_required('users')
+def groups():
+	fields = parse_params(['id', 'name', 'member'], GROUP_FIELDS)
+	query = Group.query
+	if 'id' in request.values:
+		query = query.filter(Group.unix_gid.in_(get_int_values('id')))
+	if 'name' in request.values:
+		query = query.filter(Group.name.in_(request.values.getlist('name')))
+	if 'member' in request.values:
+		member_filter = User.loginname.in_(request.values.getlist('member'))
+		if request.api_client.service.hide_deactivated_users:
+			member_filter = db.and_(member_filter, db.not_(User.is_deactivated))
+		query = query.filter(Group.members.any(member_filter))
+	if 'members' in fields:
+		query = query.options(db.selectinload(Group.members))
+	return paginate(query, Group.unix_gid, lambda group: group.unix_gid, lambda group: generate_group_dict(group, fields))
+
+MAIL_FIELDS = ['name', 'receive_addresses', 'destination_addresses']
+
+def generate_mail_dict(mail, fields):
+	getters = {
+		'name': lambda: mail.uid,
+		'receive_addresses': lambda: list(mail.receivers),
+		'destination_addresses': lambda: list(mail.destinations),
+	}
+	return {name: getters[name]() for name in fields}
+
+@bp.route('/mails', methods=['GET', 'POST'])
+@apikey_required('mail_aliases')
+def mails():
+	# pylint: disable=protected-access
+	fields = parse_params(['name', 'receive_address', 'destination_address'], MAIL_FIELDS)
+	query = Mail.query
+	if 'name' in request.values:
+		query = query.filter(Mail.uid.in_(request.values.getlist('name')))
+	if 'receive_address' in request.values:
+		addresses = [address.lower() for address in request.values.getlist('receive_address')]
+		query = query.filter(Mail._receivers.any(MailReceiveAddress.address.in_(addresses)))
+	if 'destination_address' in request.values:
+		addresses = request.values.getlist('destination_address')
+		query = query.filter(Mail._destinations.any(MailDestinationAddress.address.in_(addresses)))
+	if 'receive_addresses' in fields:
+		query = query.options(db.selectinload(Mail._receivers))
+	if 'destination_addresses' in fields:
+		query = query.options(db.selectinload(Mail._destinations))
+	return paginate(query, Mail.id, lambda mail: mail.id, lambda mail: generate_mail_dict(mail, fields))
@@ -2,7 +2,7 @@ from flask import Blueprint, render_template, current_app, request, flash, redir
 from flask_babel import lazy_gettext, gettext as _
 import sqlalchemy
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.database import db
 from uffd.models import Group
@@ -10,6 +10,7 @@ from .session import login_required
 
 bp = Blueprint("group", __name__, template_folder='templates', url_prefix='/group/')
 
+@request_memoized
 def group_acl_check():
 	return request.user and request.user.is_in_group(current_app.config['ACL_ADMIN_GROUP'])
 
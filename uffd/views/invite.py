@@ -7,15 +7,17 @@ import sqlalchemy
 
 from uffd.csrf import csrf_protect
 from uffd.sendmail import sendmail
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.database import db
 from uffd.models import Role, User, Group, Invite, InviteSignup, InviteGrant, host_ratelimit, format_delay
 from .session import login_required
 from .signup import signup_ratelimit
 from .selfservice import selfservice_acl_check
+from .rolemod import user_is_rolemod
 
 bp = Blueprint('invite', __name__, template_folder='templates', url_prefix='/invite/')
 
+@request_memoized
 def invite_acl_check():
 	if not request.user:
 		return False
@@ -23,15 +25,13 @@ def invite_acl_check():
 		return True
 	if request.user.is_in_group(current_app.config['ACL_SIGNUP_GROUP']):
 		return True
-	if Role.query.join(Role.moderator_group).join(Group.members).filter(User.id==request.user.id).count():
-		return True
-	return False
+	return user_is_rolemod()
 
 def view_acl_filter(user):
 	if user.is_in_group(current_app.config['ACL_ADMIN_GROUP']):
 		return sqlalchemy.true()
 	creator_filter = (Invite.creator == user)
-	rolemod_filter = Invite.roles.any(Role.moderator_group.has(Group.id.in_([group.id for group in user.groups])))
+	rolemod_filter = Invite.roles.any(Role.moderator_group.has(Group.id.in_(list(user.group_ids))))
 	return creator_filter | rolemod_filter
 
 def reset_acl_filter(user):
@@ -43,7 +43,7 @@ def reset_acl_filter(user):
 @register_navbar(lazy_gettext('Invites'), icon='link', blueprint=bp, visible=invite_acl_check)
 @login_required(invite_acl_check)
 def index():
-	invites = Invite.query.filter(view_acl_filter(request.user)).all()
+	invites = Invite.query.filter(view_acl_filter(request.user)).options(*Invite.list_options()).all()
 	return render_template('invite/list.html', invites=invites)
 
 @bp.route('/new')
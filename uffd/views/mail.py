@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app
 from flask_babel import gettext as _, lazy_gettext
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.database import db
 from uffd.models import Mail
@@ -9,6 +9,7 @@ from .session import login_required
 
 bp = Blueprint("mail", __name__, template_folder='templates', url_prefix='/mail/')
 
+@request_memoized
 def mail_acl_check():
 	return request.user and request.user.is_in_group(current_app.config['ACL_ADMIN_GROUP'])
 
@@ -20,7 +21,7 @@ def mail_acl():
 @bp.route("/")
 @register_navbar(lazy_gettext('Forwardings'), icon='envelope', blueprint=bp, visible=mail_acl_check)
 def index():
-	return render_template('mail/list.html', mails=Mail.query.all())
+	return render_template('mail/list.html', mails=Mail.query.options(*Mail.list_options()).all())
 
 @bp.route("/<int:mail_id>")
 @bp.route("/new")
@@ -1,8 +1,9 @@
 import urllib.parse
 import time
 import json
+import datetime
 
-from flask import Blueprint, request, jsonify, render_template, session, redirect, url_for, flash, abort
+from flask import Blueprint, request, jsonify, render_template, session, redirect, url_for, flash, abort, current_app
 from flask_babel import gettext as _
 from sqlalchemy.exc import IntegrityError
 import jwt
@@ -11,8 +12,9 @@ from uffd.secure_redirect import secure_local_redirect
 from uffd.database import db
 from uffd.models import (
 	DeviceLoginConfirmation, OAuth2Client, OAuth2Grant, OAuth2Token, OAuth2DeviceLoginInitiation,
-	host_ratelimit, format_delay, OAuth2Key,
+	host_ratelimit, format_delay, OAuth2Key, GenerationCounter,
 )
+from uffd.models.oauth2 import OAuth2KeyRing, StatelessOAuth2Grant, OAuth2ClientRegistry
 
 def get_issuer():
 	return request.host_url.rstrip('/')
@@ -72,6 +74,49 @@ def render_claims(scopes, claims, service_user):
 			res[claim] = func(service_user=service_user)
 	return res
 
+# Claims returned by the userinfo endpoint for tokens without "openid" scope
+LEGACY_USERINFO_CLAIMS = {
+	'id': lambda service_user: service_user.user.unix_uid,
+	'name': lambda service_user: service_user.user.displayname,
+	'nickname': lambda service_user: service_user.user.loginname,
+	'email': lambda service_user: service_user.email,
+	'groups': lambda service_user: [group.name for group in service_user.user.groups],
+}
+
+def render_userinfo(scopes, claims, service_user):
+	if 'openid' in scopes:
+		return render_claims(scopes, (claims or {}).get('userinfo', {}), service_user)
+	return {claim: func(service_user=service_user) for claim, func in LEGACY_USERINFO_CLAIMS.items()}
+
+def get_access_token_generation():
+	return GenerationCounter.get_values(GenerationCounter.directory, GenerationCounter.oauth2_tokens)
+
+def encode_jwt_access_token(tok, client):
+	'''Return JWT access token (RFC 9068 profile) for tok issued to client
+
+	The token contains the userinfo response as top-level claims, so resource
+	servers can validate it and get the user's data without calling back.
+	Since JWT access tokens cannot be revoked, resource servers that do not
+	use the userinfo endpoint must accept that revocations, logouts and
+	changes to user data only take effect when the token expires.'''
+	service_user = tok.service_user
+	payload = render_userinfo(tok.scopes, tok.claims, service_user)
+	payload.update({
+		'iss': get_issuer(),
+		'sub': str(service_user.user.unix_uid),
+		'aud': client.client_id,
+		'client_id': client.client_id,
+		'iat': int(time.time()),
+		'exp': int(tok.jwt_expires.replace(tzinfo=datetime.timezone.utc).timestamp()),
+		'jti': str(tok.id),
+		'scope': ' '.join(tok.scopes),
+		# Allows the userinfo endpoint to answer without database lookups
+		# (other than the generation counters) as long as no tokens were revoked
+		# and no user data changed since the token was issued.
+		'uffd_generation': get_access_token_generation(),
+	})
+	return client.get_id_token_key().encode_jwt(payload, headers={'typ': 'at+jwt'})
+
 bp = Blueprint('oauth2', __name__, template_folder='templates')
 
 @bp.route('/.well-known/openid-configuration')
@@ -95,9 +140,8 @@ def discover():
 
 @bp.route('/oauth2/keys')
 def keys():
-	return jsonify({
-		'keys': [key.public_key_jwks_dict for key in OAuth2Key.query.filter_by(active=True)],
-	}), 200, {'Cache-Control': ['max-age=86400, public, must-revalidate, no-transform=true']}
+	return current_app.response_class(OAuth2KeyRing.get().jwks, mimetype='application/json'), \
+		200, {'Cache-Control': ['max-age=86400, public, must-revalidate, no-transform=true']}
 
 def oauth2_redirect(**extra_args):
 	urlparts = urllib.parse.urlparse(request.oauth2_redirect_uri)
@@ -168,6 +212,7 @@ class RequestURINotSupportedError(OAuth2Error):
 	ERROR = 'request_uri_not_supported'
 
 def authorize_validate_request():
+	request.oauth2_client = None
 	request.oauth2_redirect_uri = None
 	for param in request.args:
 		if len(request.args.getlist(param)) > 1:
@@ -176,9 +221,10 @@ def authorize_validate_request():
 	if 'client_id' not in request.args:
 		raise InvalidRequestError(error_description='Required parameter client_id missing')
 	client_id = request.args['client_id']
-	client = OAuth2Client.query.filter_by(client_id=client_id).one_or_none()
+	client = OAuth2ClientRegistry.get().get_client(client_id)
 	if not client:
 		raise InvalidRequestError(error_description=f'Unknown client {client_id}')
+	request.oauth2_client = client
 
 	redirect_uri = request.args.get('redirect_uri')
 	if redirect_uri and redirect_uri not in client.redirect_uris:
@@ -206,7 +252,7 @@ def authorize_validate_request():
 		raise InvalidScopeError(error_description='Unknown scope')
 
 	return OAuth2Grant(
-		client=client,
+		client_db_id=client.db_id,
 		# redirect_uri is None if not present in request! This affects token request validation.
 		redirect_uri=redirect_uri,
 		scopes=scopes,
@@ -269,7 +315,7 @@ def authorize_user(client):
 				response=redirect(url_for('session.login', ref=request.full_path, devicelogin=True))
 			)
 		host_ratelimit.log()
-		initiation = OAuth2DeviceLoginInitiation(client=client)
+		initiation = OAuth2DeviceLoginInitiation(client_db_id=client.db_id)
 		db.session.add(initiation)
 		try:
 			db.session.commit()
@@ -285,7 +331,7 @@ def authorize_user(client):
 		initiation = OAuth2DeviceLoginInitiation.query.filter_by(
 			id=session['devicelogin_id'],
 			secret=session['devicelogin_secret'],
-			client=client
+			client_db_id=client.db_id
 		).one_or_none()
 		confirmation = DeviceLoginConfirmation.query.get(session['devicelogin_confirmation'])
 		del session['devicelogin_id']
@@ -325,16 +371,16 @@ def authorize():
 		return render_template('oauth2/error.html', **err.params), 400
 
 	try:
-		_session = authorize_user(grant.client)
+		_session = authorize_user(request.oauth2_client)
 		if sub_value is not None and str(_session.user.unix_uid) != sub_value:
 			# We only reach this point in OIDC requests with prompt=none, see
 			# authorize_validate_request_oidc. So this LoginRequiredError is
 			# always returned as a redirect back to the client.
 			raise LoginRequiredError()
-		if not grant.client.access_allowed(_session.user):
+		if not request.oauth2_client.access_allowed(_session.user):
 			raise AccessDeniedError(flash_message=_(
 				"You don't have the permission to access the service <b>%(service_name)s</b>.",
-				service_name=grant.client.service.name
+				service_name=request.oauth2_client.service_name
 			))
 		grant.session = _session
 	except LoginRequiredError as err:
@@ -350,6 +396,8 @@ def authorize():
 			return oauth2_redirect(**err.params)
 		abort(403, description=err.flash_message)
 
+	if current_app.config['OAUTH2_STATELESS_CODES']:
+		return oauth2_redirect(code=StatelessOAuth2Grant.from_grant(grant, request.oauth2_client).code)
 	db.session.add(grant)
 	db.session.commit()
 	return oauth2_redirect(code=grant.code)
@@ -371,11 +419,11 @@ def token_authenticate_client():
 	else:
 		raise InvalidClientError()
 
-	client = OAuth2Client.query.filter_by(client_id=client_id).one_or_none()
+	client = OAuth2ClientRegistry.get().get_client(client_id)
 	if client is None or not client.client_secret.verify(client_secret):
 		raise InvalidClientError()
 	if client.client_secret.needs_rehash:
-		client.client_secret = client_secret
+		OAuth2Client.query.get(client.db_id).client_secret = client_secret
 		db.session.commit()
 	return client
 
@@ -393,7 +441,7 @@ def token_validate_request(client):
 	code = request.form['code']
 
 	grant = OAuth2Grant.get_by_authorization_code(code)
-	if not grant or grant.client != client:
+	if not grant or grant.client_db_id != client.db_id:
 		raise InvalidGrantError()
 	if grant.redirect_uri and grant.redirect_uri != request.form.get('redirect_uri'):
 		raise InvalidRequestError(error_description='Parameter redirect_uri missing or invalid')
@@ -411,22 +459,30 @@ def token():
 
 	tok = grant.make_token()
 	db.session.add(tok)
-	db.session.delete(grant)
-	db.session.commit()
-
+	grant.invalidate()
+	try:
+		db.session.commit()
+	except IntegrityError:
+		# StatelessOAuth2Grant code was redeemed concurrently or before
+		db.session.rollback()
+		return jsonify(InvalidGrantError().params), 400
+
+	access_token = tok.access_token
+	if current_app.config['OAUTH2_JWT_ACCESS_TOKENS']:
+		access_token = encode_jwt_access_token(tok, client)
 	resp = {
 		'token_type': 'Bearer',
-		'access_token': tok.access_token,
+		'access_token': access_token,
 		'expires_in': tok.EXPIRES_IN,
 		'scope': ' '.join(tok.scopes),
 	}
 	if 'openid' in tok.scopes:
-		key = OAuth2Key.get_preferred_key()
+		key = client.get_id_token_key()
 		id_token = render_claims(['openid'], (grant.claims or {}).get('id_token', {}), tok.service_user)
 		id_token['iss'] = get_issuer()
-		id_token['aud'] = tok.client.client_id
+		id_token['aud'] = client.client_id
 		id_token['iat'] = int(time.time())
-		id_token['at_hash'] = key.oidc_hash(tok.access_token.encode('ascii'))
+		id_token['at_hash'] = key.oidc_hash(access_token.encode('ascii'))
 		id_token['exp'] = id_token['iat'] + tok.EXPIRES_IN
 
 		service_user = tok.service_user
@@ -434,7 +490,7 @@ def token():
 
 		if grant.nonce:
 			id_token['nonce'] = grant.nonce
-		resp['id_token'] = OAuth2Key.get_preferred_key().encode_jwt(id_token)
+		resp['id_token'] = key.encode_jwt(id_token)
 	else:
 		# We don't support the refresh_token grant type. Due to limitations of
 		# oauthlib we always returned (disfunctional) refresh tokens in the past.
@@ -444,25 +500,46 @@ def token():
 
 	return jsonify(resp), 200, {'Cache-Control': ['no-store']}
 
-def validate_access_token():
+def get_access_token():
 	if len(request.headers.getlist('Authorization')) == 1 and 'access_token' not in request.values:
 		auth_type, auth_value = (request.headers['Authorization'].split(' ', 1) + [''])[:2]
 		if auth_type.lower() != 'bearer':
 			raise InvalidRequestError()
-		access_token = auth_value
-	elif len(request.values.getlist('access_token')) == 1 and 'Authorization' not in request.headers:
-		access_token = request.values['access_token']
-	else:
-		raise InvalidClientError()
+		return auth_value
+	if len(request.values.getlist('access_token')) == 1 and 'Authorization' not in request.headers:
+		return request.values['access_token']
+	raise InvalidClientError()
+
+def validate_access_token(access_token):
 	tok = OAuth2Token.get_by_access_token(access_token)
 	if not tok:
 		raise InvalidTokenError()
 	return tok
 
+def get_jwt_access_token_userinfo(access_token):
+	'''Return userinfo response embedded in a JWT access token
+
+	Returns None if the response might be outdated or if access_token is not a
+	valid JWT access token. The token must then be validated the regular way.'''
+	if access_token.count('.') != 2:
+		return None
+	payload = OAuth2Token.decode_jwt_access_token(access_token)
+	if payload is None or payload.get('uffd_generation') != get_access_token_generation():
+		return None
+	if 'openid' in payload.get('scope', '').split(' '):
+		claims = OIDC_CLAIMS
+	else:
+		claims = LEGACY_USERINFO_CLAIMS
+	return {claim: payload[claim] for claim in claims if claim in payload}
+
 @bp.route('/oauth2/userinfo', methods=['GET', 'POST'])
 def userinfo():
 	try:
-		tok = validate_access_token()
+		access_token = get_access_token()
+		resp = get_jwt_access_token_userinfo(access_token)
+		if resp is not None:
+			return jsonify(resp), 200, {'Cache-Control': ['private']}
+		tok = validate_access_token(access_token)
 	except OAuth2Error as err:
 		# RFC 6750:
 		# If the request lacks any authentication information (e.g., the client
@@ -474,24 +551,18 @@ def userinfo():
 			header += f' error="{err.ERROR}"'
 		return '', 401, {'WWW-Authenticate': [header]}
 
-	service_user = tok.service_user
-	if 'openid' in tok.scopes:
-		resp = render_claims(tok.scopes, (tok.claims or {}).get('userinfo', {}), service_user)
-	else:
-		resp = {
-			'id': service_user.user.unix_uid,
-			'name': service_user.user.displayname,
-			'nickname': service_user.user.loginname,
-			'email': service_user.email,
-			'groups': [group.name for group in service_user.user.groups],
-		}
+	resp = render_userinfo(tok.scopes, tok.claims, tok.service_user)
 	return jsonify(resp), 200, {'Cache-Control': ['private']}
 
 @bp.app_url_defaults
 def inject_logout_params(endpoint, values):
 	if endpoint != 'oauth2.logout' or not request.session:
 		return
-	client_ids = set(token.client.client_id for token in request.session.oauth2_tokens)
+	tokens = request.session.oauth2_tokens
+	if not tokens:
+		return
+	clients_by_db_id = OAuth2ClientRegistry.get().clients_by_db_id
+	client_ids = set(clients_by_db_id[token.client_db_id].client_id for token in tokens if token.client_db_id in clients_by_db_id)
 	if client_ids:
 		values['client_ids'] = ','.join(client_ids)
 
@@ -500,5 +571,8 @@ def logout():
 	if not request.values.get('client_ids'):
 		return secure_local_redirect(request.values.get('ref', '/'))
 	client_ids = request.values['client_ids'].split(',')
-	clients = [OAuth2Client.query.filter_by(client_id=client_id).one() for client_id in client_ids]
+	registry = OAuth2ClientRegistry.get()
+	clients = [registry.get_client(client_id) for client_id in client_ids]
+	if None in clients:
+		abort(404)
 	return render_template('oauth2/logout.html', clients=clients)
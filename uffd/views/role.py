@@ -1,14 +1,16 @@
 from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app
 from flask_babel import gettext as _, lazy_gettext
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.database import db
 from uffd.models import Role, RoleGroup, Group
+from uffd.models.role import enqueue_group_updates, get_group_update_queue_length
 from .session import login_required
 
 bp = Blueprint("role", __name__, template_folder='templates', url_prefix='/role/')
 
+@request_memoized
 def role_acl_check():
 	return request.user and request.user.is_in_group(current_app.config['ACL_ADMIN_GROUP'])
 
@@ -20,7 +22,7 @@ def role_acl():
 @bp.route("/")
 @register_navbar(lazy_gettext('Roles'), icon='key', blueprint=bp, visible=role_acl_check)
 def index():
-	return render_template('role/list.html', roles=Role.query.all())
+	return render_template('role/list.html', roles=Role.query.all(), pending_group_updates=get_group_update_queue_length())
 
 @bp.route("/new")
 def new():
@@ -29,7 +31,7 @@ def new():
 @bp.route("/<int:roleid>")
 def show(roleid=None):
 	role = Role.query.get(roleid)
-	return render_template('role/show.html', role=role, groups=Group.query.all(), roles=Role.query.all())
+	return render_template('role/show.html', role=role, groups=Group.query.all(), roles=Role.query.all(), pending_group_updates=get_group_update_queue_length())
 
 @bp.route("/<int:roleid>/update", methods=['POST'])
 @bp.route("/new", methods=['POST'])
@@ -67,11 +69,9 @@ def delete(roleid):
 	if role.locked:
 		flash(_('Locked roles cannot be deleted'))
 		return redirect(url_for('role.show', roleid=role.id))
-	old_members = set(role.members_effective)
+	enqueue_group_updates(role.get_members_effective_filter())
 	role.members.clear()
 	db.session.delete(role)
-	for user in old_members:
-		user.update_groups()
 	db.session.commit()
 	return redirect(url_for('role.index'))
 
@@ -103,10 +103,7 @@ def unset_default(roleid):
 	role = Role.query.get(roleid)
 	if not role.is_default:
 		return redirect(url_for('role.show', roleid=role.id))
-	old_members = set(role.members_effective)
+	enqueue_group_updates(role.get_members_effective_filter())
 	role.is_default = False
-	for user in old_members:
-		if not user.is_service_user:
-			user.update_groups()
 	db.session.commit()
 	return redirect(url_for('role.show', roleid=role.id))
@@ -1,16 +1,20 @@
 from flask import Blueprint, render_template, request, url_for, redirect, flash, abort
 from flask_babel import gettext as _, lazy_gettext
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.database import db
 from uffd.models import Role, User, Group
+from uffd.models.role import enqueue_group_updates
 from .session import login_required
 
 bp = Blueprint('rolemod', __name__, template_folder='templates', url_prefix='/rolemod/')
 
+@request_memoized
 def user_is_rolemod():
-	return request.user and Role.query.join(Role.moderator_group).join(Group.members).filter(User.id==request.user.id).count()
+	if not request.user or not request.user.group_ids:
+		return False
+	return db.session.query(Role.query.filter(Role.moderator_group_id.in_(list(request.user.group_ids))).exists()).scalar()
 
 @bp.before_request
 @login_required()
@@ -27,7 +31,7 @@ def index():
 @bp.route("/<int:role_id>")
 def show(role_id):
 	role = Role.query.get_or_404(role_id)
-	if role.moderator_group not in request.user.groups:
+	if role.moderator_group_id not in request.user.group_ids:
 		abort(403)
 	return render_template('rolemod/show.html', role=role)
 
@@ -35,7 +39,7 @@ def show(role_id):
 @csrf_protect(blueprint=bp)
 def update(role_id):
 	role = Role.query.get_or_404(role_id)
-	if role.moderator_group not in request.user.groups:
+	if role.moderator_group_id not in request.user.group_ids:
 		abort(403)
 	if request.form['description'] != role.description:
 		if len(request.form['description']) > 256:
@@ -49,12 +53,12 @@ def update(role_id):
 @csrf_protect(blueprint=bp)
 def delete_member(role_id, member_id):
 	role = Role.query.get_or_404(role_id)
-	if role.moderator_group not in request.user.groups:
+	if role.moderator_group_id not in request.user.group_ids:
 		abort(403)
 	member = User.query.get_or_404(member_id)
 	if member in role.members:
 		role.members.remove(member)
-	member.update_groups()
+	enqueue_group_updates(User.id == member.id)
 	db.session.commit()
 	flash(_('Member removed'))
 	return redirect(url_for('.show', role_id=role.id))
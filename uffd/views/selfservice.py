@@ -4,7 +4,7 @@ from flask import Blueprint, render_template, session, request, url_for, redirec
 from flask_babel import gettext as _, lazy_gettext
 from sqlalchemy.exc import IntegrityError
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.sendmail import sendmail
 from uffd.database import db
@@ -20,6 +20,7 @@ bp = Blueprint("selfservice", __name__, template_folder='templates', url_prefix=
 
 reset_ratelimit = Ratelimit('passwordreset', 1*60*60, 3)
 
+@request_memoized
 def selfservice_acl_check():
 	return request.user and request.user.is_in_group(current_app.config['ACL_SELFSERVICE_GROUP'])
 
@@ -3,10 +3,10 @@ import functools
 from flask import Blueprint, render_template, request, url_for, redirect, current_app, abort
 from flask_babel import lazy_gettext
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.database import db
-from uffd.models import User, Service, ServiceUser, get_services, Group, OAuth2Client, OAuth2LogoutURI, APIClient, RemailerMode
+from uffd.models import User, Service, ServiceUser, get_services, Group, OAuth2Client, OAuth2LogoutURI, OAuth2Key, APIClient, RemailerMode
 
 from .session import login_required
 
@@ -14,6 +14,7 @@ bp = Blueprint('service', __name__, template_folder='templates')
 
 bp.add_app_template_global(RemailerMode, 'RemailerMode')
 
+@request_memoized
 def admin_acl():
 	return request.user and request.user.is_in_group(current_app.config['ACL_ADMIN_GROUP'])
 
@@ -27,6 +28,7 @@ def overview_login_maybe_required(func):
 		return func(*args, **kwargs)
 	return decorator
 
+@request_memoized
 def overview_navbar_visible():
 	return get_services(request.user) or admin_acl()
 
@@ -119,7 +121,7 @@ def delete(id):
 def oauth2_show(service_id, db_id=None):
 	service = Service.query.get_or_404(service_id)
 	client = OAuth2Client() if db_id is None else OAuth2Client.query.filter_by(service_id=service_id, db_id=db_id).first_or_404()
-	return render_template('service/oauth2.html', service=service, client=client)
+	return render_template('service/oauth2.html', service=service, client=client, algorithms=OAuth2Key.ALGORITHMS, available_algorithms=OAuth2Key.get_available_algorithms())
 
 @bp.route('/service/<int:service_id>/oauth2/new', methods=['POST'])
 @bp.route('/service/<int:service_id>/oauth2/<int:db_id>', methods=['POST'])
@@ -138,6 +140,13 @@ def oauth2_submit(service_id, db_id=None):
 	if not client.client_secret:
 		abort(400)
 	client.redirect_uris = [x.strip() for x in request.form['redirect_uris'].split('\n') if x.strip()]
+	id_token_signed_response_alg = request.form.get('id_token_signed_response_alg') or None
+	# Keeping an algorithm without active key is allowed, so that other
+	# settings of the client can still be changed
+	if id_token_signed_response_alg != client.id_token_signed_response_alg and \
+			id_token_signed_response_alg not in [None] + OAuth2Key.get_available_algorithms():
+		abort(400)
+	client.id_token_signed_response_alg = id_token_signed_response_alg
 	client.logout_uris = []
 	for line in request.form['logout_uris'].split('\n'):
 		line = line.strip()
@@ -1,14 +1,18 @@
 import datetime
 import secrets
 import functools
+import hashlib
+import hmac
 
-from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app, session, abort
+from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app, session, abort, Request
 from flask_babel import gettext as _
 
 from uffd.database import db
+from uffd.cache import LRUCache
 from uffd.csrf import csrf_protect
 from uffd.secure_redirect import secure_local_redirect
-from uffd.models import User, DeviceLoginInitiation, DeviceLoginConfirmation, Ratelimit, host_ratelimit, format_delay, Session
+from uffd.models import User, DeviceLoginInitiation, DeviceLoginConfirmation, Ratelimit, host_ratelimit, format_delay, Session, GenerationCounter
+from uffd.models.session import SessionActivityWriter
 from uffd.fido2_compat import * # pylint: disable=wildcard-import,unused-wildcard-import
 
 bp = Blueprint("session", __name__, template_folder='templates', url_prefix='/')
@@ -16,6 +20,42 @@ bp = Blueprint("session", __name__, template_folder='templates', url_prefix='/')
 login_ratelimit = Ratelimit('login', 1*60, 3)
 mfa_ratelimit = Ratelimit('mfa', 1*60, 3)
 
+def lazy_request_attribute(name):
+	def getter(self):
+		if name not in self.__dict__:
+			loader = self.__dict__.get('lazy_loaders', {}).get(name)
+			self.__dict__[name] = loader() if loader else None
+		return self.__dict__[name]
+	def setter(self, value):
+		self.__dict__[name] = value
+	return property(getter, setter)
+
+class LazySessionRequest(Request):
+	'''Request class that supports loading request.user/session lazily
+
+	Set as app.request_class. See set_request_user.'''
+	user = lazy_request_attribute('user')
+	user_pre_mfa = lazy_request_attribute('user_pre_mfa')
+	session = lazy_request_attribute('session')
+	session_pre_mfa = lazy_request_attribute('session_pre_mfa')
+
+# Maps (session id, HMAC of the secret) of valid sessions to a dict with
+# user_id, mfa_done, group_names, generation, last_used and expires. Cache
+# hits skip the session lookup, the secret verification and the access group
+# check. request.user/session/... are then only loaded if actually used.
+#
+# Entries are only used while GenerationCounter.directory is unchanged, so
+# changes to users and groups (including group memberships updated by roles
+# with Core statements) take effect immediately in all processes. Commits
+# that change sessions clear the cache of the current process. Other
+# processes pick up logouts after SESSION_CACHE_TTL_SECONDS.
+session_cache = LRUCache(maxsize=4096)
+session_cache.clear_on_commit(Session)
+session_cache_key = secrets.token_bytes(32)
+
+def get_session_cache_key():
+	return (session['id'], hmac.new(session_cache_key, session['secret'].encode(), hashlib.sha256).digest())
+
 @bp.before_app_request
 def set_request_user():
 	request.user = None
@@ -26,14 +66,34 @@ def set_request_user():
 		return
 	if 'secret' not in session:
 		return
+	now = datetime.datetime.utcnow()
+	entry = session_cache.get(get_session_cache_key())
+	if entry is not None and entry['expires'] > now and entry['last_used'] > now - datetime.timedelta(seconds=60) \
+			and entry['generation'] == GenerationCounter.directory.value:
+		if current_app.config['ACL_ACCESS_GROUP'] and current_app.config['ACL_ACCESS_GROUP'] not in entry['group_names']:
+			return
+		session_id, user_id = session['id'], entry['user_id']
+		# Query.get returns the already loaded object on subsequent calls
+		loaders = {
+			'session_pre_mfa': lambda: Session.query.get(session_id),
+			'user_pre_mfa': lambda: User.query.get(user_id),
+		}
+		if entry['mfa_done']:
+			loaders['session'] = loaders['session_pre_mfa']
+			loaders['user'] = loaders['user_pre_mfa']
+		for name in loaders:
+			del request.__dict__[name]
+		request.lazy_loaders = loaders
+		return
+	generation = GenerationCounter.directory.value if current_app.config['SESSION_CACHE_TTL_SECONDS'] else None
 	_session = Session.query.get(session['id'])
 	if _session is None or not _session.secret.verify(session['secret']) or _session.expired:
 		return
-	if _session.last_used <= datetime.datetime.utcnow() - datetime.timedelta(seconds=60):
-		_session.last_used = datetime.datetime.utcnow()
-		_session.ip_address = request.remote_addr
-		_session.user_agent = request.user_agent.string
-		db.session.commit()
+	activity_writer = SessionActivityWriter.get()
+	last_used = max(_session.last_used, activity_writer.get_pending_last_used(_session.id) or _session.last_used)
+	if last_used <= datetime.datetime.utcnow() - datetime.timedelta(seconds=60):
+		activity_writer.record(_session.id, request.remote_addr, request.user_agent.string)
+		last_used = datetime.datetime.utcnow()
 	if _session.user.is_deactivated or not _session.user.is_in_group(current_app.config['ACL_ACCESS_GROUP']):
 		return
 	request.session_pre_mfa = _session
@@ -41,6 +101,18 @@ def set_request_user():
 	if _session.mfa_done:
 		request.session = _session
 		request.user = _session.user
+	if current_app.config['SESSION_CACHE_TTL_SECONDS']:
+		session_cache.set(get_session_cache_key(), {
+			'user_id': _session.user_id,
+			'mfa_done': _session.mfa_done,
+			'group_names': _session.user.group_names,
+			'generation': generation,
+			'last_used': last_used,
+			'expires': min(
+				_session.created + datetime.timedelta(seconds=current_app.config['SESSION_LIFETIME_SECONDS']),
+				last_used + current_app.permanent_session_lifetime,
+			),
+		}, ttl=current_app.config['SESSION_CACHE_TTL_SECONDS'])
 
 @bp.route("/logout")
 def logout():
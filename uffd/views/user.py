@@ -5,7 +5,7 @@ from flask import Blueprint, render_template, request, url_for, redirect, flash,
 from flask_babel import gettext as _, lazy_gettext
 from sqlalchemy.exc import IntegrityError
 
-from uffd.navbar import register_navbar
+from uffd.navbar import register_navbar, request_memoized
 from uffd.csrf import csrf_protect
 from uffd.remailer import remailer
 from uffd.database import db
@@ -18,6 +18,7 @@ bp = Blueprint("user", __name__, template_folder='templates', url_prefix='/user/
 bp.add_app_template_global(User, 'User')
 bp.add_app_template_global(remailer, 'remailer')
 
+@request_memoized
 def user_acl_check():
 	return request.user and request.user.is_in_group(current_app.config['ACL_ADMIN_GROUP'])
 
@@ -29,7 +30,7 @@ def user_acl():
 @bp.route("/")
 @register_navbar(lazy_gettext('Users'), icon='users', blueprint=bp, visible=user_acl_check)
 def index():
-	return render_template('user/list.html', users=User.query.all())
+	return render_template('user/list.html', users=User.query.options(*User.list_options()).all())
 
 @bp.route("/<int:id>")
 @bp.route("/new")